@@ -1,8 +1,5 @@
 import argparse
 import pickle
-import spacy
-from tqdm import tqdm
-from transformer.modern_data import Vocabulary
 import transformer.Constants as Constants
 from collections import Counter
 
@@ -14,12 +11,14 @@ def load_data(path_src, path_trg):
     return src_lines, trg_lines
 
 def tokenize(lines, nlp):
+    from tqdm import tqdm
     tokenized = []
     for doc in tqdm(nlp.pipe(lines, batch_size=1000, n_process=4), total=len(lines)):
         tokenized.append([tok.text.lower() for tok in doc])
     return tokenized
 
 def build_vocab(tokenized_lines, min_freq):
+    from transformer.modern_data import Vocabulary
     counter = Counter()
     for tokens in tokenized_lines:
         counter.update(tokens)
@@ -46,7 +45,10 @@ def main():
     parser.add_argument('-share_vocab', action='store_true')
     
     opt = parser.parse_args()
-    
+
+    # Heavy dependencies are imported only once the arguments are valid.
+    import spacy
+
     print('[Info] Loading SpaCy models...')
     nlp_src = spacy.load('de_core_news_sm')
     nlp_trg = spacy.load('en_core_web_sm')
@@ -0,0 +1,114 @@
+from __future__ import annotations
+
+import argparse
+import json
+import multiprocessing as mp
+
+import torch
+
+from transformer.Models import get_subsequent_mask
+from transformer.Modules import ScaledDotProductAttention
+from transformer.telemetry import peak_rss_mb
+
+
+MODES = {
+    "dense": (0, 0),
+    "q_chunk": (128, 0),
+    "qk_chunk": (128, 128),
+}
+
+
+def _inputs(sz_b: int, n_head: int, len_s: int, d_k: int, causal: bool, device: str, requires_grad: bool):
+    q, k, v = (torch.randn(sz_b, n_head, len_s, d_k, device=device, requires_grad=requires_grad) for _ in range(3))
+    seq = torch.ones(sz_b, len_s, dtype=torch.long, device=device)
+    seq[:, len_s - len_s // 8:] = 0   # padded tail
+    mask = (seq != 0).unsqueeze(-2)
+    if causal:
+        mask = mask & get_subsequent_mask(seq)
+    return q, k, v, mask.unsqueeze(1)
+
+
+def _attention(mode: str, d_k: int, device: str) -> ScaledDotProductAttention:
+    attn = ScaledDotProductAttention(temperature=d_k ** 0.5, attn_dropout=0.0).to(device)
+    attn.q_chunk_size, attn.k_chunk_size = MODES[mode]
+    return attn
+
+
+def _measure(args: argparse.Namespace, mode: str, len_s: int, results) -> None:
+    """Runs in a fresh process, so ru_maxrss only reflects this measurement."""
+    torch.manual_seed(1)
+    q, k, v, mask = _inputs(args.batch, args.n_head, len_s, args.d_k, args.causal, args.device, args.backward)
+    attn = _attention(mode, args.d_k, args.device)
+    if args.device == "cuda":
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+        base = torch.cuda.memory_allocated()
+    else:
+        base = peak_rss_mb()
+
+    output, _ = attn(q, k, v, mask=mask)
+    if args.backward:
+        output.sum().backward()
+
+    if args.device == "cuda":
+        torch.cuda.synchronize()
+        peak_mb = (torch.cuda.max_memory_allocated() - base) / 2 ** 20
+    else:
+        peak_mb = peak_rss_mb() - base
+    results.put(peak_mb)
+
+
+def max_abs_error(args: argparse.Namespace, mode: str, len_s: int) -> float:
+    """Largest difference between the chunked and the dense output (and input gradients with --backward)."""
+    torch.manual_seed(1)
+    q, k, v, mask = _inputs(args.batch, args.n_head, len_s, args.d_k, args.causal, args.device, args.backward)
+    outputs = []
+    for name in ("dense", mode):
+        output, _ = _attention(name, args.d_k, args.device)(q, k, v, mask=mask)
+        grads: tuple[torch.Tensor, ...] = ()
+        if args.backward:
+            grads = torch.autograd.grad(output.sum(), (q, k, v))
+        outputs.append((output.detach(),) + tuple(grads))
+    return max(float((a - b).abs().max()) for a, b in zip(*outputs))
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description="Peak memory of dense vs chunked attention against sequence length")
+    parser.add_argument("--lengths", type=int, nargs="+", default=[256, 512, 1024, 2048, 4096])
+    parser.add_argument("--modes", nargs="+", choices=list(MODES), default=list(MODES))
+    parser.add_argument("--batch", type=int, default=1)
+    parser.add_argument("--n-head", type=int, default=8)
+    parser.add_argument("--d-k", type=int, default=64)
+    parser.add_argument("--causal", action="store_true", help="Decoder self-attention mask instead of padding only")
+    parser.add_argument("--backward", action="store_true", help="Include the backward pass")
+    parser.add_argument("--device", choices=["cpu", "cuda"], default="cpu")
+    parser.add_argument("--output", default=None, help="Also write the results as JSON")
+    args = parser.parse_args(argv)
+
+    if args.device == "cpu" and peak_rss_mb() is None:
+        parser.error("Peak RSS is not available on this platform; use --device cuda")
+
+    errors = {mode: max_abs_error(args, mode, 257) for mode in args.modes if mode != "dense"}
+    for mode, error in errors.items():
+        print(f"  {mode:10s} max abs error vs dense (len 257): {error:.2e}")
+
+    ctx = mp.get_context("spawn")
+    peaks: dict[str, dict[int, float]] = {mode: {} for mode in args.modes}
+    print(f"  {'length':>8s}" + "".join(f"{mode + ' MB':>14s}" for mode in args.modes))
+    for len_s in args.lengths:
+        for mode in args.modes:
+            results = ctx.Queue()
+            proc = ctx.Process(target=_measure, args=(args, mode, len_s, results))
+            proc.start()
+            peaks[mode][len_s] = results.get()
+            proc.join()
+        print(f"  {len_s:8d}" + "".join(f"{peaks[mode][len_s]:14.1f}" for mode in args.modes))
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"settings": vars(args), "max_abs_error": errors, "peak_mb": peaks}, f, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
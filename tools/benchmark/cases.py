@@ -0,0 +1,203 @@
+from __future__ import annotations
+
+import random
+from dataclasses import dataclass
+from typing import Callable, Iterable
+
+import torch
+import torch.nn.functional as F
+
+from transformer.Layers import DecoderLayer, EncoderLayer
+from transformer.Models import Transformer, get_subsequent_mask
+from transformer.Modules import ScaledDotProductAttention
+from transformer.Optim import ScheduledOptim
+from transformer.Translator import Translator
+from transformer.modern_data import collate_fn, collate_fn_packed
+
+
+# (batch, length, d_model)
+SHAPES = [(8, 32, 256), (32, 32, 512), (8, 128, 512)]
+QUICK_SHAPES = [(8, 32, 256)]
+
+PAD, BOS, EOS = 0, 2, 3
+VOCAB_SIZE = 8000
+
+
+@dataclass(frozen=True)
+class Case:
+    """A benchmark: `setup()` builds the inputs and returns (step, n_items per step)."""
+
+    name: str
+    unit: str
+    setup: Callable[[], tuple[Callable[[], object], int]]
+
+
+def _n_head(d_model: int) -> int:
+    return max(1, d_model // 64)
+
+
+def _attention_case(sz_b: int, len_s: int, d_model: int, backward: bool) -> Case:
+    def setup():
+        n_head = _n_head(d_model)
+        d_k = d_model // n_head
+        attn = ScaledDotProductAttention(temperature=d_k ** 0.5)
+        q, k, v = (torch.randn(sz_b, n_head, len_s, d_k, requires_grad=backward) for _ in range(3))
+        mask = torch.ones(sz_b, 1, 1, len_s, dtype=torch.bool)
+
+        def step():
+            output, _ = attn(q, k, v, mask=mask)
+            if backward:
+                output.sum().backward()
+            return output
+
+        return step, sz_b * len_s
+
+    kind = "fwd_bwd" if backward else "fwd"
+    return Case(f"attention_{kind}/b{sz_b}_l{len_s}_d{d_model}", "tokens/s", setup)
+
+
+def _layer_case(layer_type: str, sz_b: int, len_s: int, d_model: int) -> Case:
+    def setup():
+        n_head = _n_head(d_model)
+        d_k = d_model // n_head
+        x = torch.randn(sz_b, len_s, d_model, requires_grad=True)
+        if layer_type == "encoder":
+            layer = EncoderLayer(d_model, d_model * 4, n_head, d_k, d_k)
+            mask = torch.ones(sz_b, 1, len_s, dtype=torch.bool)
+
+            def forward():
+                return layer(x, slf_attn_mask=mask)[0]
+        else:
+            layer = DecoderLayer(d_model, d_model * 4, n_head, d_k, d_k)
+            enc_output = torch.randn(sz_b, len_s, d_model)
+            slf_mask = get_subsequent_mask(torch.zeros(sz_b, len_s, dtype=torch.long))
+            src_mask = torch.ones(sz_b, 1, len_s, dtype=torch.bool)
+
+            def forward():
+                return layer(x, enc_output, slf_attn_mask=slf_mask, dec_enc_attn_mask=src_mask)[0]
+
+        def step():
+            output = forward()
+            output.sum().backward()
+            return output
+
+        return step, sz_b * len_s
+
+    return Case(f"{layer_type}_layer_fwd_bwd/b{sz_b}_l{len_s}_d{d_model}", "tokens/s", setup)
+
+
+def _small_model(d_model: int = 256, n_layers: int = 3) -> Transformer:
+    n_head = _n_head(d_model)
+    return Transformer(
+        VOCAB_SIZE, VOCAB_SIZE, src_pad_idx=PAD, trg_pad_idx=PAD,
+        d_word_vec=d_model, d_model=d_model, d_inner=d_model * 4,
+        n_layers=n_layers, n_head=n_head, d_k=d_model // n_head, d_v=d_model // n_head)
+
+
+def _random_insts(n: int, min_len: int, max_len: int) -> list[list[int]]:
+    return [
+        [BOS] + [random.randrange(4, VOCAB_SIZE) for _ in range(random.randint(min_len, max_len))] + [EOS]
+        for _ in range(n)]
+
+
+def _train_step_case(sz_b: int, len_s: int, d_model: int) -> Case:
+    def setup():
+        model = _small_model(d_model)
+        model.train()
+        optimizer = ScheduledOptim(
+            torch.optim.Adam(model.parameters(), betas=(0.9, 0.98), eps=1e-09), 2.0, d_model, 4000)
+        src_seq = torch.randint(4, VOCAB_SIZE, (sz_b, len_s))
+        trg_seq = torch.randint(4, VOCAB_SIZE, (sz_b, len_s + 1))
+        gold = trg_seq[:, 1:].contiguous().view(-1)
+
+        def step():
+            optimizer.zero_grad()
+            pred = model(src_seq, trg_seq[:, :-1])
+            loss = F.cross_entropy(pred, gold, ignore_index=PAD, reduction="sum")
+            loss.backward()
+            optimizer.step_and_update_lr()
+            return loss
+
+        return step, sz_b * len_s
+
+    return Case(f"train_step/b{sz_b}_l{len_s}_d{d_model}", "tokens/s", setup)
+
+
+def _variable_length_train_case(sz_b: int, pack_max_len: int) -> Case:
+    """One training step over the same variable-length sentence pairs, padded or packed.
+    Throughput counts real target tokens, so the two variants compare directly."""
+    def setup():
+        model = _small_model()
+        model.train()
+        optimizer = ScheduledOptim(
+            torch.optim.Adam(model.parameters(), betas=(0.9, 0.98), eps=1e-09), 2.0, 256, 4000)
+        insts = list(zip(_random_insts(sz_b, 5, 50), _random_insts(sz_b, 5, 50)))
+        if pack_max_len:
+            src_seq, trg_seq, gold, src_seg, trg_seg = collate_fn_packed(insts, PAD, PAD, pack_max_len)
+            segments = (src_seg, trg_seg)
+        else:
+            src_seq, trg_seq = collate_fn(insts, PAD, PAD)
+            trg_seq, gold = trg_seq[:, :-1], trg_seq[:, 1:]
+            segments = ()
+        gold = gold.contiguous().view(-1)
+
+        def step():
+            optimizer.zero_grad()
+            pred = model(src_seq, trg_seq, *segments)
+            loss = F.cross_entropy(pred, gold, ignore_index=PAD, reduction="sum")
+            loss.backward()
+            optimizer.step_and_update_lr()
+            return loss
+
+        return step, int((gold != PAD).sum())
+
+    kind = f"packed_p{pack_max_len}" if pack_max_len else "padded"
+    return Case(f"train_step_{kind}/b{sz_b}_l5-50", "tokens/s", setup)
+
+
+def _collate_case(sz_b: int, pack_max_len: int = 0) -> Case:
+    def setup():
+        insts = list(zip(_random_insts(sz_b, 5, 50), _random_insts(sz_b, 5, 50)))
+
+        def step():
+            if pack_max_len:
+                return collate_fn_packed(insts, PAD, PAD, pack_max_len)
+            return collate_fn(insts, PAD, PAD)
+
+        return step, sz_b
+
+    name = f"collate_packed_p{pack_max_len}" if pack_max_len else "collate"
+    return Case(f"{name}/b{sz_b}", "sentences/s", setup)
+
+
+def _beam_search_case(beam_size: int, src_len: int) -> Case:
+    def setup():
+        model = _small_model()
+        translator = Translator(
+            model, beam_size=beam_size, max_seq_len=src_len + 10,
+            src_pad_idx=PAD, trg_pad_idx=PAD, trg_bos_idx=BOS, trg_eos_idx=EOS)
+        src_seq = torch.LongTensor(_random_insts(1, src_len, src_len))
+
+        def step():
+            return translator.translate_sentence(src_seq)
+
+        return step, 1
+
+    return Case(f"beam_search/k{beam_size}_l{src_len}", "sentences/s", setup)
+
+
+def build_cases(quick: bool = False) -> Iterable[Case]:
+    shapes = QUICK_SHAPES if quick else SHAPES
+    for sz_b, len_s, d_model in shapes:
+        yield _attention_case(sz_b, len_s, d_model, backward=False)
+        yield _attention_case(sz_b, len_s, d_model, backward=True)
+        yield _layer_case("encoder", sz_b, len_s, d_model)
+        yield _layer_case("decoder", sz_b, len_s, d_model)
+    yield _train_step_case(16, 32, 256)
+    for pack_max_len in (0, 128):
+        yield _variable_length_train_case(64, pack_max_len)
+    yield _collate_case(256)
+    yield _collate_case(256, pack_max_len=128)
+    for beam_size in ((5,) if quick else (1, 5)):
+        yield _beam_search_case(beam_size, 15)
+
@@ -0,0 +1,125 @@
+from __future__ import annotations
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+from dataclasses import asdict, dataclass
+
+
+PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+DEFAULT_BUDGET = os.path.join(os.path.dirname(os.path.abspath(__file__)), "import_budget.json")
+
+
+@dataclass(frozen=True)
+class ImportResult:
+    name: str
+    statement: str
+    median_ms: float
+    min_ms: float
+    budget_ms: float
+    heavy_loaded: list[str]
+    forbidden_loaded: list[str]
+
+    @property
+    def ok(self) -> bool:
+        return self.median_ms <= self.budget_ms and not self.forbidden_loaded
+
+
+def _importtime(statement: str) -> list[tuple[int, int, str]]:
+    """Run `statement` in a fresh interpreter; returns (cumulative us, depth, module) per import."""
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", statement],
+        cwd=PROJECT_DIR, capture_output=True, text=True, check=True)
+    rows = []
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        depth = (len(name) - len(name.lstrip())) // 2
+        rows.append((int(cumulative), depth, name.strip()))
+    return rows
+
+
+def _interpreter_modules() -> set[str]:
+    """Top-level imports done by the bare interpreter (site, encodings, ...) are not charged to a target."""
+    return {name for _, depth, name in _importtime("pass") if depth == 0}
+
+
+def measure(name: str, target: dict, repeats: int, baseline: set[str], heavy: list[str]) -> ImportResult:
+    times: list[float] = []
+    loaded: set[str] = set()
+    for _ in range(repeats):
+        rows = _importtime(target["statement"])
+        times.append(sum(us for us, depth, mod in rows if depth == 0 and mod not in baseline) / 1e3)
+        loaded = {mod.split(".")[0] for _, _, mod in rows}
+
+    return ImportResult(
+        name=name,
+        statement=target["statement"],
+        median_ms=statistics.median(times),
+        min_ms=min(times),
+        budget_ms=target["budget_ms"],
+        heavy_loaded=sorted(loaded & set(heavy)),
+        forbidden_loaded=sorted(loaded & set(target.get("forbidden", []))),
+    )
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description="Cold-start import time of the entry points against a stored budget")
+    parser.add_argument("--budget", default=DEFAULT_BUDGET, help="JSON file with the targets and their budgets")
+    parser.add_argument("--repeats", type=int, default=5, help="Fresh interpreters per target")
+    parser.add_argument("--filter", action="append", default=[], help="Substring of target names to run (repeatable)")
+    parser.add_argument("--output", default=None, help="Also write the results as JSON")
+    parser.add_argument("--allow-missing", action="store_true",
+                        help="Skip targets whose import fails (e.g. optional dependencies not installed) "
+                             "instead of failing the gate")
+    args = parser.parse_args(argv)
+
+    with open(args.budget) as f:
+        budget = json.load(f)
+
+    baseline = _interpreter_modules()
+    results: list[ImportResult] = []
+    import_failed: list[str] = []
+    skipped: list[str] = []
+    for name, target in budget["targets"].items():
+        if args.filter and not any(pattern in name for pattern in args.filter):
+            continue
+        try:
+            result = measure(name, target, args.repeats, baseline, budget["heavy_modules"])
+        except subprocess.CalledProcessError as e:
+            status = "SKIP" if args.allow_missing else "ERROR"
+            print(f"  {name:20s} {status}: import failed ({e.stderr.strip().splitlines()[-1]})")
+            (skipped if args.allow_missing else import_failed).append(name)
+            continue
+        results.append(result)
+        flag = "ok" if result.ok else "OVER BUDGET"
+        print(f"  {name:20s} {result.median_ms:9.1f} ms (budget {result.budget_ms:7.1f} ms)  "
+              f"heavy: {','.join(result.heavy_loaded) or '-':25s} {flag}")
+        if result.forbidden_loaded:
+            print(f"  {'':20s} ERROR: imports {', '.join(result.forbidden_loaded)} at module import time")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({r.name: asdict(r) for r in results}, f, indent=2)
+
+    failed = [r for r in results if not r.ok]
+    if failed:
+        print(f"  ERROR: {len(failed)} target(s) exceed the cold-start budget.")
+    if import_failed:
+        print(f"  ERROR: {len(import_failed)} target(s) failed to import: {', '.join(import_failed)} "
+              f"(--allow-missing skips them).")
+    if failed or import_failed:
+        return 1
+    if skipped:
+        print(f"  OK: all measured targets within budget; skipped {', '.join(skipped)}.")
+    else:
+        print("  OK: all targets within budget.")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,170 @@
+from __future__ import annotations
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import time
+from dataclasses import asdict, dataclass
+
+import torch
+
+from tools.benchmark.cases import Case, build_cases
+
+
+DEFAULT_THRESHOLD = 0.10
+
+
+@dataclass(frozen=True)
+class CaseResult:
+    name: str
+    unit: str
+    repeats: int
+    median_sec: float
+    mean_sec: float
+    min_sec: float
+    stdev_sec: float
+    throughput: float
+
+
+def _git_commit(project_dir: str) -> str | None:
+    try:
+        out = subprocess.run(
+            ["git", "rev-parse", "HEAD"], cwd=project_dir, capture_output=True, text=True, check=True)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return out.stdout.strip()
+
+
+def environment() -> dict[str, object]:
+    project_dir = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    return {
+        "timestamp": datetime.datetime.now().isoformat(timespec="seconds"),
+        "git_commit": _git_commit(project_dir),
+        "python": sys.version.split()[0],
+        "torch": torch.__version__,
+        "platform": platform.platform(),
+        "processor": platform.processor(),
+        "cpu_count": os.cpu_count(),
+        "torch_num_threads": torch.get_num_threads(),
+        "torch_num_interop_threads": torch.get_num_interop_threads(),
+    }
+
+
+def run_case(case: Case, warmup: int, repeats: int, min_time: float) -> CaseResult:
+    random.seed(1)
+    torch.manual_seed(1)
+    step, n_items = case.setup()
+    for _ in range(warmup):
+        step()
+
+    times: list[float] = []
+    start = time.perf_counter()
+    while len(times) < repeats or time.perf_counter() - start < min_time:
+        t0 = time.perf_counter()
+        step()
+        times.append(time.perf_counter() - t0)
+
+    median = statistics.median(times)
+    return CaseResult(
+        name=case.name,
+        unit=case.unit,
+        repeats=len(times),
+        median_sec=median,
+        mean_sec=statistics.fmean(times),
+        min_sec=min(times),
+        stdev_sec=statistics.stdev(times) if len(times) > 1 else 0.0,
+        throughput=n_items / median,
+    )
+
+
+def run(args: argparse.Namespace) -> int:
+    if args.threads:
+        torch.set_num_threads(args.threads)
+
+    results: dict[str, dict[str, object]] = {}
+    for case in build_cases(quick=args.quick):
+        if args.filter and not any(pattern in case.name for pattern in args.filter):
+            continue
+        result = run_case(case, args.warmup, args.repeats, args.min_time)
+        results[result.name] = asdict(result)
+        print(f"  {result.name:45s} {result.median_sec * 1e3:10.3f} ms  {result.throughput:12.1f} {result.unit}")
+
+    report = {"environment": environment(), "results": results}
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"[Info] Results written to {args.output}")
+    return 0
+
+
+def compare_reports(baseline: dict, current: dict, threshold: float) -> list[str]:
+    """Return one line per case that is slower than the baseline by more than `threshold`."""
+    base_results = baseline["results"]
+    cur_results = current["results"]
+
+    regressions: list[str] = []
+    for name, cur in sorted(cur_results.items()):
+        base = base_results.get(name)
+        if base is None:
+            print(f"  {name:45s} (new case, no baseline)")
+            continue
+        ratio = cur["median_sec"] / base["median_sec"]
+        flag = "REGRESSION" if ratio > 1 + threshold else ("faster" if ratio < 1 - threshold else "ok")
+        line = f"  {name:45s} {base['median_sec'] * 1e3:10.3f} ms -> {cur['median_sec'] * 1e3:10.3f} ms  x{ratio:5.2f}  {flag}"
+        print(line)
+        if flag == "REGRESSION":
+            regressions.append(line)
+    return regressions
+
+
+def compare(args: argparse.Namespace) -> int:
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    with open(args.current) as f:
+        current = json.load(f)
+
+    for key in ("torch", "platform", "torch_num_threads"):
+        if baseline["environment"].get(key) != current["environment"].get(key):
+            print(f"  WARNING: environment differs in '{key}': "
+                  f"{baseline['environment'].get(key)} vs {current['environment'].get(key)}")
+
+    regressions = compare_reports(baseline, current, args.threshold)
+    if regressions:
+        print(f"  ERROR: {len(regressions)} case(s) regressed by more than {args.threshold:.0%}.")
+        return 1
+    print("  OK: no regressions.")
+    return 0
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description="CPU benchmark suite for model, data and decoding hot paths")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = sub.add_parser("run", help="Run the benchmarks and write a JSON report")
+    run_parser.add_argument("--output", default="bench_results.json")
+    run_parser.add_argument("--quick", action="store_true", help="Only the smallest shapes")
+    run_parser.add_argument("--filter", action="append", default=[], help="Substring of case names to run (repeatable)")
+    run_parser.add_argument("--warmup", type=int, default=3)
+    run_parser.add_argument("--repeats", type=int, default=10)
+    run_parser.add_argument("--min-time", type=float, default=1.0, help="Minimum measured seconds per case")
+    run_parser.add_argument("--threads", type=int, default=0, help="torch.set_num_threads; 0 keeps the default")
+    run_parser.set_defaults(func=run)
+
+    cmp_parser = sub.add_parser("compare", help="Flag regressions against a saved baseline report")
+    cmp_parser.add_argument("baseline")
+    cmp_parser.add_argument("current")
+    cmp_parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD,
+                            help="Relative slowdown of the median that counts as a regression")
+    cmp_parser.set_defaults(func=compare)
+
+    args = parser.parse_args(argv)
+    return args.func(args)
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
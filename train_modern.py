@@ -2,78 +2,69 @@ import argparse
 import math
 import time
 import pickle
-from tqdm import tqdm
-import numpy as np
 import random
 import os
 
-import torch
-import torch.nn.functional as F
-import torch.optim as optim
-from torch.utils.data import DataLoader
-
 import transformer.Constants as Constants
-from transformer.Models import Transformer
-from transformer.Optim import ScheduledOptim
-from transformer.modern_data import TransformerDataset, collate_fn
-
-def cal_performance(pred, gold, trg_pad_idx, smoothing=False):
-    loss = cal_loss(pred, gold, trg_pad_idx, smoothing=smoothing)
-    pred = pred.max(1)[1]
-    gold = gold.contiguous().view(-1)
-    non_pad_mask = gold.ne(trg_pad_idx)
-    n_correct = pred.eq(gold).masked_select(non_pad_mask).sum().item()
-    n_word = non_pad_mask.sum().item()
-    return loss, n_correct, n_word
-
-def cal_loss(pred, gold, trg_pad_idx, smoothing=False):
-    gold = gold.contiguous().view(-1)
-    if smoothing:
-        eps = 0.1
-        n_class = pred.size(1)
-        one_hot = torch.zeros_like(pred).scatter(1, gold.view(-1, 1), 1)
-        one_hot = one_hot * (1 - eps) + (1 - one_hot) * eps / (n_class - 1)
-        log_prb = F.log_softmax(pred, dim=1)
-        non_pad_mask = gold.ne(trg_pad_idx)
-        loss = -(one_hot * log_prb).sum(dim=1)
-        loss = loss.masked_select(non_pad_mask).sum()
-    else:
-        loss = F.cross_entropy(pred, gold, ignore_index=trg_pad_idx, reduction='sum')
-    return loss
 
-def train_epoch(model, training_data, optimizer, opt, device, smoothing):
+# torch, numpy, tqdm and the optional instrumentation modules are imported
+# where they are first needed, so argument errors and -h return immediately.
+
+def prepare_batch(batch, device):
+    ''' (src_seq, decoder input, flat gold, packing segments) on device, for padded or packed batches. '''
+    if len(batch) == 2:
+        src_seq, trg_seq = (t.to(device) for t in batch)
+        return src_seq, trg_seq[:, :-1], trg_seq[:, 1:].contiguous().view(-1), ()
+    src_seq, trg_seq, gold, src_seg, trg_seg = (t.to(device) for t in batch)
+    return src_seq, trg_seq, gold.view(-1), (src_seg, trg_seg)
+
+def train_epoch(model, training_data, optimizer, opt, device, smoothing, profiler=None, telemetry=None):
+    from tqdm import tqdm
+    from transformer.training.loss import cal_performance
+
     model.train()
     total_loss, n_word_total, n_word_correct = 0, 0, 0 
-    for src_seq, trg_seq in tqdm(training_data, mininterval=2, desc='  - (Training)   ', leave=False):
-        src_seq = src_seq.to(device)
-        trg_seq = trg_seq.to(device)
-        gold = trg_seq[:, 1:].contiguous().view(-1)
-        trg_seq = trg_seq[:, :-1]
+    if telemetry is not None:
+        telemetry.epoch_start()
+    for batch in tqdm(training_data, mininterval=2, desc='  - (Training)   ', leave=False):
+        if telemetry is not None:
+            telemetry.batch_ready(batch[0], batch[1])
+        src_seq, trg_seq, gold, segments = prepare_batch(batch, device)
 
         optimizer.zero_grad()
-        pred = model(src_seq, trg_seq)
+        pred = model(src_seq, trg_seq, *segments)
 
         loss, n_correct, n_word = cal_performance(pred, gold, opt.trg_pad_idx, smoothing=smoothing) 
         loss.backward()
+        if telemetry is not None:
+            telemetry.compute_done()
         optimizer.step_and_update_lr()
 
         n_word_total += n_word
         n_word_correct += n_correct
         total_loss += loss.item()
 
+        if telemetry is not None:
+            telemetry.step_done(optimizer.n_steps)
+        if profiler is not None:
+            profiler.step()
+
+    if telemetry is not None:
+        telemetry.flush(optimizer.n_steps)
     return total_loss/n_word_total, n_word_correct/n_word_total
 
 def eval_epoch(model, validation_data, device, opt):
+    import torch
+    from tqdm import tqdm
+    from transformer.training.loss import cal_performance
+
     model.eval()
     total_loss, n_word_total, n_word_correct = 0, 0, 0
     with torch.no_grad():
-        for src_seq, trg_seq in tqdm(validation_data, mininterval=2, desc='  - (Validation) ', leave=False):
-            src_seq = src_seq.to(device)
-            trg_seq = trg_seq.to(device)
-            gold = trg_seq[:, 1:].contiguous().view(-1)
-            trg_seq = trg_seq[:, :-1]
+        for batch in tqdm(validation_data, mininterval=2, desc='  - (Validation) ', leave=False):
+            src_seq, trg_seq, gold, segments = prepare_batch(batch, device)
 
-            pred = model(src_seq, trg_seq)
+            pred = model(src_seq, trg_seq, *segments)
             loss, n_correct, n_word = cal_performance(pred, gold, opt.trg_pad_idx, smoothing=False)
 
             n_word_total += n_word
@@ -82,7 +73,32 @@ def eval_epoch(model, validation_data, device, opt):
 
     return total_loss/n_word_total, n_word_correct/n_word_total
 
-def train(model, training_data, validation_data, optimizer, device, opt, start_epoch=0):
+def record_bleu(results, opt, log_valid_file, best_bleu, tb_writer=None):
+    ''' Log finished background BLEU results and keep the snapshot of a new best epoch. '''
+    import torch
+
+    for epoch_i, bleu, snapshot_path in sorted(results):
+        print(f'  - (BLEU)       epoch {epoch_i}: {bleu:3.2f}')
+        with open(log_valid_file, 'a') as log_vf:
+            log_vf.write(f'{epoch_i},,,,{bleu:3.2f}\n')
+        if tb_writer is not None:
+            tb_writer.add_scalar('bleu/val', bleu, epoch_i)
+
+        if opt.save_mode == 'best' and opt.best_metric == 'bleu' and bleu > best_bleu:
+            # -- record the score in the promoted checkpoint, so a resumed run keeps the best BLEU
+            snapshot = torch.load(snapshot_path, map_location='cpu', mmap=True, weights_only=False)
+            torch.save(dict(snapshot, best_bleu=bleu), os.path.join(opt.output_dir, 'model.chkpt'))
+            del snapshot
+            os.remove(snapshot_path)
+            print(f'    - [Info] The checkpoint file has been updated with epoch {epoch_i}.')
+        else:
+            os.remove(snapshot_path)
+        best_bleu = max(best_bleu, bleu)
+    return best_bleu
+
+def train(model, training_data, validation_data, optimizer, device, opt, start_epoch=0, best_bleu=-1.0):
+    import torch
+
     tb_writer = None
     if opt.use_tb:
         from torch.utils.tensorboard import SummaryWriter
@@ -91,21 +107,60 @@ def train(model, training_data, validation_data, optimizer, device, opt, start_e
     log_train_file = os.path.join(opt.output_dir, 'train.log')
     log_valid_file = os.path.join(opt.output_dir, 'valid.log')
 
+    bleu_validator = None
+    snapshot_dir = os.path.join(opt.output_dir, 'bleu_snapshots')
+    if opt.bleu_valid:
+        from transformer.bleu.worker import BleuValidator
+        bleu_validator = BleuValidator(
+            opt.data_pkl, device=opt.bleu_device, threads=opt.bleu_threads, decoding=opt.bleu_decoding,
+            beam_size=opt.bleu_beam_size, max_seq_len=opt.bleu_max_seq_len, batch_size=opt.bleu_batch_size)
+        os.makedirs(snapshot_dir, exist_ok=True)
+    # With BLEU enabled, valid.log gets a bleu column; the score arrives later in its own row.
+    bleu_field = ',' if bleu_validator is not None else ''
+
     if start_epoch == 0:
         with open(log_train_file, 'w') as log_tf, open(log_valid_file, 'w') as log_vf:
             log_tf.write('epoch,loss,ppl,accuracy\n')
-            log_vf.write('epoch,loss,ppl,accuracy\n')
+            log_vf.write(f'epoch,loss,ppl,accuracy{bleu_field and ",bleu"}\n')
+
+    layer_timer = None
+    if opt.profile_layers:
+        from transformer.profiling import LayerTimer
+        layer_timer = LayerTimer(model).attach()
+
+    profiler = None
+    if opt.profile_start_step >= 0:
+        from transformer.profiling import build_profiler
+        profiler = build_profiler(
+            opt.output_dir, opt.profile_start_step, opt.profile_num_steps, completed_steps=optimizer.n_steps)
+        profiler.start()
+
+    telemetry = None
+    if opt.telemetry_interval > 0:
+        from transformer.telemetry import StepTelemetry
+        telemetry = StepTelemetry(
+            os.path.join(opt.output_dir, 'telemetry.jsonl'), opt.telemetry_interval,
+            opt.src_pad_idx, opt.trg_pad_idx, tb_writer=tb_writer, device=device)
 
     valid_losses = []
     for epoch_i in range(start_epoch, opt.epoch):
         print(f'[ Epoch {epoch_i} ]')
 
+        if layer_timer is not None:
+            layer_timer.reset()   # drop the timings of the previous validation pass
+
         start = time.time()
-        train_loss, train_accu = train_epoch(model, training_data, optimizer, opt, device, opt.label_smoothing)
+        train_loss, train_accu = train_epoch(
+            model, training_data, optimizer, opt, device, opt.label_smoothing,
+            profiler=profiler, telemetry=telemetry)
         train_ppl = math.exp(min(train_loss, 100))
         lr = optimizer._optimizer.param_groups[0]['lr']
         print(f'  - (Training)   ppl: {train_ppl: 8.5f}, accuracy: {100*train_accu:3.3f} %, lr: {lr:8.5f}, elapse: {(time.time()-start)/60:3.3f} min')
 
+        if layer_timer is not None:
+            print(layer_timer.format_table())
+            layer_timer.write(os.path.join(opt.output_dir, 'layer_profile.log'), epoch_i)
+
         start = time.time()
         valid_loss, valid_accu = eval_epoch(model, validation_data, device, opt)
         valid_ppl = math.exp(min(valid_loss, 100))
@@ -118,22 +173,41 @@ def train(model, training_data, validation_data, optimizer, device, opt, start_e
             'model': model.state_dict(),
             'optimizer': optimizer._optimizer.state_dict(),
             'n_steps': optimizer.n_steps,
+            'best_bleu': best_bleu,
             'vocab': opt.vocab
         }
 
-        if opt.save_mode == 'best' and valid_loss <= min(valid_losses):
+        if opt.save_mode == 'best' and opt.best_metric == 'loss' and valid_loss <= min(valid_losses):
             torch.save(checkpoint, os.path.join(opt.output_dir, 'model.chkpt'))
             print('    - [Info] The checkpoint file has been updated.')
+        elif opt.save_mode == 'all':
+            torch.save(checkpoint, os.path.join(opt.output_dir, f'model_epoch_{epoch_i}.chkpt'))
+
+        if bleu_validator is not None:
+            snapshot_path = os.path.join(snapshot_dir, f'epoch_{epoch_i}.chkpt')
+            torch.save(checkpoint, snapshot_path)
+            if not bleu_validator.submit(epoch_i, snapshot_path):
+                os.remove(snapshot_path)
 
         with open(log_train_file, 'a') as log_tf, open(log_valid_file, 'a') as log_vf:
             log_tf.write(f'{epoch_i},{train_loss: 8.5f},{train_ppl: 8.5f},{100*train_accu:3.3f}\n')
-            log_vf.write(f'{epoch_i},{valid_loss: 8.5f},{valid_ppl: 8.5f},{100*valid_accu:3.3f}\n')
+            log_vf.write(f'{epoch_i},{valid_loss: 8.5f},{valid_ppl: 8.5f},{100*valid_accu:3.3f}{bleu_field}\n')
+
+        if bleu_validator is not None:
+            best_bleu = record_bleu(bleu_validator.poll(), opt, log_valid_file, best_bleu, tb_writer)
 
         if tb_writer is not None:
             tb_writer.add_scalars('ppl', {'train': train_ppl, 'val': valid_ppl}, epoch_i)
             tb_writer.add_scalars('accuracy', {'train': train_accu*100, 'val': valid_accu*100}, epoch_i)
             tb_writer.add_scalar('learning_rate', lr, epoch_i)
 
+    if profiler is not None:
+        profiler.stop()
+
+    if bleu_validator is not None:
+        print('[Info] Waiting for the pending BLEU validations...')
+        record_bleu(bleu_validator.close(), opt, log_valid_file, best_bleu, tb_writer)
+
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('-data_pkl', required=True)
@@ -145,6 +219,10 @@ def main():
     parser.add_argument('-d_v', type=int, default=64)
     parser.add_argument('-n_head', type=int, default=8)
     parser.add_argument('-n_layers', type=int, default=6)
+    parser.add_argument('-n_enc_layers', type=int, default=None, help='Encoder depth (default: -n_layers)')
+    parser.add_argument('-n_dec_layers', type=int, default=None, help='Decoder depth (default: -n_layers)')
+    parser.add_argument('-layerdrop', type=float, default=0.0,
+                        help='LayerDrop: skip each encoder / decoder layer with this probability while training')
     parser.add_argument('-warmup','--n_warmup_steps', type=int, default=4000)
     parser.add_argument('-lr_mul', type=float, default=2.0)
     parser.add_argument('-seed', type=int, default=1)
@@ -158,11 +236,59 @@ def main():
     parser.add_argument('-no_cuda', action='store_true')
     parser.add_argument('-label_smoothing', action='store_true')
     parser.add_argument('-checkpoint', type=str, default=None)
+    parser.add_argument('-profile_layers', action='store_true',
+                        help='Time forward/backward of every encoder/decoder layer and sublayer')
+    parser.add_argument('-profile_start_step', type=int, default=-1,
+                        help='Run torch.profiler from this global training step on, counting resumed steps (disabled if < 0)')
+    parser.add_argument('-profile_num_steps', type=int, default=5,
+                        help='Number of training steps recorded by torch.profiler')
+    parser.add_argument('-bleu_valid', action='store_true',
+                        help='Score every epoch with BLEU in a background worker process')
+    parser.add_argument('-best_metric', choices=['loss', 'bleu'], default='loss',
+                        help='Metric used to select model.chkpt when -save_mode is best')
+    parser.add_argument('-bleu_device', type=str, default='cpu')
+    parser.add_argument('-bleu_threads', type=int, default=2)
+    parser.add_argument('-bleu_decoding', choices=['greedy', 'beam'], default='greedy')
+    parser.add_argument('-bleu_beam_size', type=int, default=5)
+    parser.add_argument('-bleu_max_seq_len', type=int, default=100)
+    parser.add_argument('-bleu_batch_size', type=int, default=64)
+    parser.add_argument('-pack_max_len', type=int, default=0,
+                        help='Pack sentence pairs into rows of up to N tokens instead of padding (0 disables)')
+    parser.add_argument('-attn_q_chunk', type=int, default=0,
+                        help='Memory-bounded attention: process queries in blocks of N (0: dense attention)')
+    parser.add_argument('-attn_k_chunk', type=int, default=0,
+                        help='With -attn_q_chunk, also process keys in blocks of N with an online softmax')
+    parser.add_argument('-telemetry_interval', type=int, default=0,
+                        help='Log throughput / padding / timing / memory telemetry every N steps (0 disables)')
+    parser.add_argument('-max_tokens', type=int, default=0,
+                        help='Batch by padded tokens (rows x longest pair) instead of -batch_size (0 disables)')
+    parser.add_argument('-probe_max_tokens', choices=['print', 'use'], default=None,
+                        help='Measure the largest safe -max_tokens on synthetic worst-case batches, '
+                             'then print it and exit, or train with it')
+    parser.add_argument('-probe_safety_margin', type=float, default=0.15,
+                        help='Share of the memory limit the probed peak must stay below')
+    parser.add_argument('-probe_memory_mb', type=float, default=0,
+                        help='Memory limit of the probe (default: available RAM on CPU, device memory on CUDA)')
 
     opt = parser.parse_args()
+    if opt.attn_k_chunk > 0 and opt.attn_q_chunk <= 0:
+        parser.error('-attn_k_chunk requires -attn_q_chunk')
+    if opt.best_metric == 'bleu' and not opt.bleu_valid:
+        parser.error('-best_metric bleu requires -bleu_valid')
+    if (opt.max_tokens > 0 or opt.probe_max_tokens) and opt.pack_max_len > 0:
+        parser.error('-max_tokens / -probe_max_tokens cannot be combined with -pack_max_len')
     opt.cuda = not opt.no_cuda
     opt.d_word_vec = opt.d_model
 
+    import numpy as np
+    import torch
+    import torch.optim as optim
+    from torch.utils.data import DataLoader
+    from transformer.checkpoint import build_model, model_config
+    from transformer.modern_data import (
+        TokenBatchSampler, TransformerDataset, collate_fn, collate_fn_packed, pair_lengths)
+    from transformer.Optim import ScheduledOptim
+
     torch.manual_seed(opt.seed)
     np.random.seed(opt.seed)
     random.seed(opt.seed)
@@ -182,30 +308,46 @@ def main():
     opt.trg_pad_idx = data['vocab']['trg'].stoi[Constants.PAD_WORD]
     opt.vocab = data['vocab']
 
-    train_loader = DataLoader(
-        TransformerDataset(data['train']['src'], data['train']['trg']),
-        num_workers=2, batch_size=opt.batch_size, shuffle=True,
-        collate_fn=lambda x: collate_fn(x, opt.src_pad_idx, opt.trg_pad_idx))
-
-    valid_loader = DataLoader(
-        TransformerDataset(data['valid']['src'], data['valid']['trg']),
-        num_workers=2, batch_size=opt.batch_size,
-        collate_fn=lambda x: collate_fn(x, opt.src_pad_idx, opt.trg_pad_idx))
-
-    model = Transformer(
-        opt.src_vocab_size, opt.trg_vocab_size,
-        src_pad_idx=opt.src_pad_idx, trg_pad_idx=opt.trg_pad_idx,
-        trg_emb_prj_weight_sharing=opt.proj_share_weight,
-        emb_src_trg_weight_sharing=opt.embs_share_weight,
-        d_k=opt.d_k, d_v=opt.d_v, d_model=opt.d_model, d_word_vec=opt.d_word_vec,
-        d_inner=opt.d_inner_hid, n_layers=opt.n_layers, n_head=opt.n_head,
-        dropout=opt.dropout, scale_emb_or_prj=opt.scale_emb_or_prj).to(device)
+    if opt.probe_max_tokens:
+        from functools import partial
+        from transformer.memory_probe import find_max_tokens
+        from transformer.training.loss import cal_loss
+        opt.max_tokens = find_max_tokens(
+            model_config(opt), pair_lengths(data['train']['src'], data['train']['trg']),
+            partial(cal_loss, trg_pad_idx=opt.trg_pad_idx, smoothing=opt.label_smoothing),
+            device=device, safety_margin=opt.probe_safety_margin, limit_mb=opt.probe_memory_mb,
+            attn_q_chunk=opt.attn_q_chunk, attn_k_chunk=opt.attn_k_chunk)
+        print(f'[Info] Largest safe -max_tokens: {opt.max_tokens}')
+        if opt.probe_max_tokens == 'print':
+            return
+
+    if opt.pack_max_len > 0:
+        collate = lambda x: collate_fn_packed(x, opt.src_pad_idx, opt.trg_pad_idx, opt.pack_max_len)
+    else:
+        collate = lambda x: collate_fn(x, opt.src_pad_idx, opt.trg_pad_idx)
+
+    def loader(split, shuffle):
+        dataset = TransformerDataset(data[split]['src'], data[split]['trg'])
+        if opt.max_tokens > 0:
+            sampler = TokenBatchSampler(
+                pair_lengths(data[split]['src'], data[split]['trg']), opt.max_tokens, shuffle, opt.seed)
+            return DataLoader(dataset, num_workers=2, batch_sampler=sampler, collate_fn=collate)
+        return DataLoader(
+            dataset, num_workers=2, batch_size=opt.batch_size, shuffle=shuffle, collate_fn=collate)
+
+    train_loader = loader('train', shuffle=True)
+    valid_loader = loader('valid', shuffle=False)
+
+    model = build_model(model_config(opt), device)
+    if opt.attn_q_chunk > 0:
+        from transformer.Modules import set_attention_chunking
+        set_attention_chunking(model, opt.attn_q_chunk, opt.attn_k_chunk)
 
     optimizer = ScheduledOptim(
         optim.Adam(model.parameters(), betas=(0.9, 0.98), eps=1e-09),
         opt.lr_mul, opt.d_model, opt.n_warmup_steps)
 
-    start_epoch = 0
+    start_epoch, best_bleu = 0, -1.0
     if opt.checkpoint:
         print(f'[Info] Loading checkpoint from {opt.checkpoint}')
         checkpoint = torch.load(opt.checkpoint, weights_only=False)
@@ -216,8 +358,9 @@ def main():
             optimizer.n_steps = checkpoint['n_steps']
         if 'epoch' in checkpoint:
             start_epoch = checkpoint['epoch'] + 1
+        best_bleu = checkpoint.get('best_bleu', -1.0)
 
-    train(model, train_loader, valid_loader, optimizer, device, opt, start_epoch)
+    train(model, train_loader, valid_loader, optimizer, device, opt, start_epoch, best_bleu)
 
 if __name__ == '__main__':
     main()
@@ -20,6 +20,54 @@ def get_subsequent_mask(seq):
     return subsequent_mask
 
 
+def select_layers(layer_stack, active_layers=None, layerdrop=0.0, training=False):
+    ''' The layers to run in a forward pass: the active subset (all by default),
+    each skipped with probability layerdrop while training (LayerDrop). '''
+    layers = list(layer_stack) if active_layers is None else [layer_stack[i] for i in active_layers]
+    if training and layerdrop > 0:
+        keep = (torch.rand(len(layers)) >= layerdrop).tolist()
+        layers = [layer for layer, k in zip(layers, keep) if k]
+    return layers
+
+
+def evenly_spaced_layers(n_layers, n_keep):
+    ''' n_keep of n_layers layer indices, spread over the stack and always including the top layer. '''
+    if n_keep >= n_layers:
+        return list(range(n_layers))
+    return sorted({n_layers - 1 - round(i * n_layers / n_keep) for i in range(n_keep)})
+
+
+def set_active_layers(model, enc_layers=None, dec_layers=None):
+    ''' Run only the given encoder / decoder layer indices at inference (None: every layer). '''
+    for stack, indices in ((model.encoder, enc_layers), (model.decoder, dec_layers)):
+        if indices is not None:
+            indices = sorted(set(indices))
+            if not indices or indices[0] < 0 or indices[-1] >= len(stack.layer_stack):
+                raise ValueError(f'Layer indices {indices} out of range for {len(stack.layer_stack)} layers')
+        stack.active_layers = indices
+
+
+def get_packed_positions(seg):
+    ''' Position of every token within its segment (see collate_fn_packed); restarts at 0 per segment. '''
+    idx = torch.arange(seg.size(1), device=seg.device).expand_as(seg)
+    is_start = torch.ones_like(seg, dtype=torch.bool)
+    is_start[:, 1:] = seg[:, 1:] != seg[:, :-1]
+    start = torch.where(is_start, idx, torch.zeros_like(idx)).cummax(dim=1).values
+    return idx - start
+
+
+def get_packed_masks(src_seg, trg_seg):
+    ''' Masks for packed rows, where segment id 0 marks padding:
+    block-diagonal encoder self-attention, per-segment causal decoder
+    self-attention and cross-attention restricted to the same segment. '''
+    src_key = (src_seg != 0).unsqueeze(-2)
+    trg_key = (trg_seg != 0).unsqueeze(-2)
+    src_mask = (src_seg.unsqueeze(-1) == src_seg.unsqueeze(-2)) & src_key
+    trg_mask = (trg_seg.unsqueeze(-1) == trg_seg.unsqueeze(-2)) & trg_key & get_subsequent_mask(trg_seg)
+    cross_mask = (trg_seg.unsqueeze(-1) == src_seg.unsqueeze(-2)) & src_key
+    return src_mask, trg_mask, cross_mask
+
+
 class PositionalEncoding(nn.Module):
 
     def __init__(self, d_hid, n_position=200):
@@ -40,10 +88,13 @@ class PositionalEncoding(nn.Module):
         sinusoid_table[:, 0::2] = np.sin(sinusoid_table[:, 0::2])  # dim 2i
         sinusoid_table[:, 1::2] = np.cos(sinusoid_table[:, 1::2])  # dim 2i+1
 
-        return torch.FloatTensor(sinusoid_table).unsqueeze(0)
+        return torch.tensor(sinusoid_table, dtype=torch.float32).unsqueeze(0)
 
-    def forward(self, x):
+    def forward(self, x, pos=None):
         pos_table = self.pos_table
+        if pos is not None:
+            # -- explicit position ids (b x l), e.g. restarting per packed segment
+            return x + pos_table[0, pos].detach()
         return x + torch.clone(pos_table[:, :x.size(1)]).detach()
 
 
@@ -52,21 +103,26 @@ class Encoder(nn.Module):
 
     def __init__(
             self, n_src_vocab, d_word_vec, n_layers, n_head, d_k, d_v,
-            d_model, d_inner, pad_idx, dropout=0.1, n_position=200, scale_emb=False):
+            d_model, d_inner, pad_idx, dropout=0.1, n_position=200, scale_emb=False,
+            layer_heads=None, layerdrop=0.0):
 
         super().__init__()
 
+        # layer_heads: optional per-layer head counts (e.g. after head pruning)
+        layer_heads = layer_heads or [n_head] * n_layers
         self.src_word_emb = nn.Embedding(n_src_vocab, d_word_vec, padding_idx=pad_idx)
         self.position_enc = PositionalEncoding(d_word_vec, n_position=n_position)
         self.dropout = nn.Dropout(p=dropout)
         self.layer_stack = nn.ModuleList([
-            EncoderLayer(d_model, d_inner, n_head, d_k, d_v, dropout=dropout)
-            for _ in range(n_layers)])
+            EncoderLayer(d_model, d_inner, layer_heads[i], d_k, d_v, dropout=dropout)
+            for i in range(n_layers)])
         self.layer_norm = nn.LayerNorm(d_model, eps=1e-6)
         self.scale_emb = scale_emb
         self.d_model = d_model
+        self.layerdrop = layerdrop
+        self.active_layers = None   # see set_active_layers
 
-    def forward(self, src_seq, src_mask, return_attns=False):
+    def forward(self, src_seq, src_mask, return_attns=False, src_pos=None):
 
         enc_slf_attn_list = []
 
@@ -74,10 +130,10 @@ class Encoder(nn.Module):
         enc_output = self.src_word_emb(src_seq)
         if self.scale_emb:
             enc_output *= self.d_model ** 0.5
-        enc_output = self.dropout(self.position_enc(enc_output))
+        enc_output = self.dropout(self.position_enc(enc_output, src_pos))
         enc_output = self.layer_norm(enc_output)
 
-        for enc_layer in self.layer_stack:
+        for enc_layer in select_layers(self.layer_stack, self.active_layers, self.layerdrop, self.training):
             enc_output, enc_slf_attn = enc_layer(enc_output, slf_attn_mask=src_mask)
             enc_slf_attn_list += [enc_slf_attn] if return_attns else []
 
@@ -91,21 +147,27 @@ class Decoder(nn.Module):
 
     def __init__(
             self, n_trg_vocab, d_word_vec, n_layers, n_head, d_k, d_v,
-            d_model, d_inner, pad_idx, n_position=200, dropout=0.1, scale_emb=False):
+            d_model, d_inner, pad_idx, n_position=200, dropout=0.1, scale_emb=False,
+            layer_heads=None, layerdrop=0.0):
 
         super().__init__()
 
+        # layer_heads: optional per-layer (self-attention, cross-attention) head counts
+        layer_heads = layer_heads or [(n_head, n_head)] * n_layers
         self.trg_word_emb = nn.Embedding(n_trg_vocab, d_word_vec, padding_idx=pad_idx)
         self.position_enc = PositionalEncoding(d_word_vec, n_position=n_position)
         self.dropout = nn.Dropout(p=dropout)
         self.layer_stack = nn.ModuleList([
-            DecoderLayer(d_model, d_inner, n_head, d_k, d_v, dropout=dropout)
-            for _ in range(n_layers)])
+            DecoderLayer(
+                d_model, d_inner, layer_heads[i][0], d_k, d_v, dropout=dropout, n_cross_head=layer_heads[i][1])
+            for i in range(n_layers)])
         self.layer_norm = nn.LayerNorm(d_model, eps=1e-6)
         self.scale_emb = scale_emb
         self.d_model = d_model
+        self.layerdrop = layerdrop
+        self.active_layers = None   # see set_active_layers
 
-    def forward(self, trg_seq, trg_mask, enc_output, src_mask, return_attns=False):
+    def forward(self, trg_seq, trg_mask, enc_output, src_mask, return_attns=False, trg_pos=None):
 
         dec_slf_attn_list, dec_enc_attn_list = [], []
 
@@ -113,10 +175,10 @@ class Decoder(nn.Module):
         dec_output = self.trg_word_emb(trg_seq)
         if self.scale_emb:
             dec_output *= self.d_model ** 0.5
-        dec_output = self.dropout(self.position_enc(dec_output))
+        dec_output = self.dropout(self.position_enc(dec_output, trg_pos))
         dec_output = self.layer_norm(dec_output)
 
-        for dec_layer in self.layer_stack:
+        for dec_layer in select_layers(self.layer_stack, self.active_layers, self.layerdrop, self.training):
             dec_output, dec_slf_attn, dec_enc_attn = dec_layer(
                 dec_output, enc_output, slf_attn_mask=trg_mask, dec_enc_attn_mask=src_mask)
             dec_slf_attn_list += [dec_slf_attn] if return_attns else []
@@ -135,7 +197,8 @@ class Transformer(nn.Module):
             d_word_vec=512, d_model=512, d_inner=2048,
             n_layers=6, n_head=8, d_k=64, d_v=64, dropout=0.1, n_position=200,
             trg_emb_prj_weight_sharing=True, emb_src_trg_weight_sharing=True,
-            scale_emb_or_prj='prj'):
+            scale_emb_or_prj='prj', head_counts=None,
+            n_enc_layers=None, n_dec_layers=None, layerdrop=0.0):
 
         super().__init__()
 
@@ -159,14 +222,16 @@ class Transformer(nn.Module):
         self.encoder = Encoder(
             n_src_vocab=n_src_vocab, n_position=n_position,
             d_word_vec=d_word_vec, d_model=d_model, d_inner=d_inner,
-            n_layers=n_layers, n_head=n_head, d_k=d_k, d_v=d_v,
-            pad_idx=src_pad_idx, dropout=dropout, scale_emb=scale_emb)
+            n_layers=n_enc_layers or n_layers, n_head=n_head, d_k=d_k, d_v=d_v,
+            pad_idx=src_pad_idx, dropout=dropout, scale_emb=scale_emb,
+            layer_heads=head_counts and head_counts['encoder'], layerdrop=layerdrop)
 
         self.decoder = Decoder(
             n_trg_vocab=n_trg_vocab, n_position=n_position,
             d_word_vec=d_word_vec, d_model=d_model, d_inner=d_inner,
-            n_layers=n_layers, n_head=n_head, d_k=d_k, d_v=d_v,
-            pad_idx=trg_pad_idx, dropout=dropout, scale_emb=scale_emb)
+            n_layers=n_dec_layers or n_layers, n_head=n_head, d_k=d_k, d_v=d_v,
+            pad_idx=trg_pad_idx, dropout=dropout, scale_emb=scale_emb,
+            layer_heads=head_counts and head_counts['decoder'], layerdrop=layerdrop)
 
         self.trg_word_prj = nn.Linear(d_model, n_trg_vocab, bias=False)
 
@@ -186,13 +251,19 @@ class Transformer(nn.Module):
             self.encoder.src_word_emb.weight = self.decoder.trg_word_emb.weight
 
 
-    def forward(self, src_seq, trg_seq):
-
-        src_mask = get_pad_mask(src_seq, self.src_pad_idx)
-        trg_mask = get_pad_mask(trg_seq, self.trg_pad_idx) & get_subsequent_mask(trg_seq)
+    def forward(self, src_seq, trg_seq, src_seg=None, trg_seg=None):
 
-        enc_output, *_ = self.encoder(src_seq, src_mask)
-        dec_output, *_ = self.decoder(trg_seq, trg_mask, enc_output, src_mask)
+        if src_seg is None:
+            src_mask = get_pad_mask(src_seq, self.src_pad_idx)
+            trg_mask = get_pad_mask(trg_seq, self.trg_pad_idx) & get_subsequent_mask(trg_seq)
+            enc_output, *_ = self.encoder(src_seq, src_mask)
+            dec_output, *_ = self.decoder(trg_seq, trg_mask, enc_output, src_mask)
+        else:
+            # -- packed rows: several sentence pairs per row, separated by segment ids
+            src_mask, trg_mask, cross_mask = get_packed_masks(src_seg, trg_seg)
+            enc_output, *_ = self.encoder(src_seq, src_mask, src_pos=get_packed_positions(src_seg))
+            dec_output, *_ = self.decoder(
+                trg_seq, trg_mask, enc_output, cross_mask, trg_pos=get_packed_positions(trg_seg))
         seq_logit = self.trg_word_prj(dec_output)
         if self.scale_prj:
             seq_logit *= self.d_model ** -0.5
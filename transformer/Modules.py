@@ -1,19 +1,36 @@
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
 
 __author__ = "Yu-Hsiang Huang"
 
+def _narrow(mask, dim, start, length):
+    ''' Slice a broadcastable mask along dim, leaving broadcast (size 1) dimensions alone. '''
+    return mask if mask.size(dim) == 1 else mask.narrow(dim, start, length)
+
 class ScaledDotProductAttention(nn.Module):
-    ''' Scaled Dot-Product Attention '''
+    ''' Scaled Dot-Product Attention
+
+    By default the full len_q x len_k score matrix is materialized. With
+    q_chunk_size > 0 queries are processed in blocks, and with k_chunk_size > 0
+    keys are too, using an online-softmax accumulation; peak memory is then
+    bounded by the block sizes instead of the sequence lengths. The chunked
+    path returns None instead of the attention weights.
+    '''
 
     def __init__(self, temperature, attn_dropout=0.1):
         super().__init__()
         self.temperature = temperature
         self.dropout = nn.Dropout(attn_dropout)
+        self.q_chunk_size = 0
+        self.k_chunk_size = 0
 
     def forward(self, q, k, v, mask=None):
 
+        if self.q_chunk_size > 0:
+            return self._chunked_forward(q, k, v, mask), None
+
         attn = torch.matmul(q / self.temperature, k.transpose(2, 3))
 
         if mask is not None:
@@ -23,3 +40,51 @@ class ScaledDotProductAttention(nn.Module):
         output = torch.matmul(attn, v)
 
         return output, attn
+
+    def _chunked_forward(self, q, k, v, mask):
+        len_q = q.size(2)
+        outputs = []
+        for start in range(0, len_q, self.q_chunk_size):
+            length = min(self.q_chunk_size, len_q - start)
+            q_blk = q.narrow(2, start, length)
+            mask_blk = None if mask is None else _narrow(mask, 2, start, length)
+            if torch.is_grad_enabled() and (q.requires_grad or k.requires_grad or v.requires_grad):
+                # -- keep only the block inputs for backward and recompute the scores
+                outputs.append(checkpoint(self._attend_block, q_blk, k, v, mask_blk, use_reentrant=False))
+            else:
+                outputs.append(self._attend_block(q_blk, k, v, mask_blk))
+        return torch.cat(outputs, dim=2)
+
+    def _attend_block(self, q, k, v, mask):
+        ''' Attention of a block of queries, over key blocks of k_chunk_size with an online softmax. '''
+        len_k = k.size(2)
+        k_chunk_size = self.k_chunk_size if self.k_chunk_size > 0 else len_k
+        q = q / self.temperature
+
+        row_max = q.new_full(q.shape[:-1], float('-inf'))
+        row_sum = q.new_zeros(q.shape[:-1])
+        acc = q.new_zeros(q.shape[:-1] + (v.size(-1),))
+        for start in range(0, len_k, k_chunk_size):
+            length = min(k_chunk_size, len_k - start)
+            scores = torch.matmul(q, k.narrow(2, start, length).transpose(2, 3))
+            if mask is not None:
+                scores = scores.masked_fill(_narrow(mask, 3, start, length) == 0, -1e9)
+
+            new_max = torch.maximum(row_max, scores.amax(dim=-1))
+            rescale = torch.exp(row_max - new_max)
+            weights = torch.exp(scores - new_max.unsqueeze(-1))
+            row_sum = row_sum * rescale + weights.sum(dim=-1)
+            # -- dropout on the unnormalized weights equals dropout on the softmax output
+            acc = acc * rescale.unsqueeze(-1) + torch.matmul(self.dropout(weights), v.narrow(2, start, length))
+            row_max = new_max
+
+        return acc / row_sum.unsqueeze(-1)
+
+
+def set_attention_chunking(model, q_chunk_size=0, k_chunk_size=0):
+    ''' Switch every ScaledDotProductAttention in model to chunked (q_chunk_size > 0) or dense attention. '''
+    for module in model.modules():
+        if isinstance(module, ScaledDotProductAttention):
+            module.q_chunk_size = q_chunk_size
+            module.k_chunk_size = k_chunk_size
+    return model
@@ -1,4 +1,5 @@
 ''' Define the sublayers in encoder/decoder layer '''
+import torch
 import torch.nn as nn
 import torch.nn.functional as F
 from transformer.Modules import ScaledDotProductAttention
@@ -25,6 +26,33 @@ class MultiHeadAttention(nn.Module):
         self.dropout = nn.Dropout(dropout)
         self.layer_norm = nn.LayerNorm(d_model, eps=1e-6)
 
+        # Optional n_head gate on the head outputs; set by the head importance scorer.
+        self.head_mask = None
+
+
+    def prune_heads(self, heads):
+        ''' Physically remove the given head indices from the projections. '''
+        keep = [h for h in range(self.n_head) if h not in set(heads)]
+        if not keep:
+            raise ValueError('Cannot prune every head of a MultiHeadAttention')
+
+        def rows(weight, d_head):
+            idx = torch.cat([torch.arange(h * d_head, (h + 1) * d_head) for h in keep]).to(weight.device)
+            return weight.index_select(0, idx)
+
+        def sliced(weight):
+            linear = nn.Linear(weight.size(1), weight.size(0), bias=False, device=weight.device, dtype=weight.dtype)
+            linear.weight.data.copy_(weight)
+            return linear
+
+        with torch.no_grad():
+            self.w_qs = sliced(rows(self.w_qs.weight, self.d_k))
+            self.w_ks = sliced(rows(self.w_ks.weight, self.d_k))
+            self.w_vs = sliced(rows(self.w_vs.weight, self.d_v))
+            self.fc = sliced(rows(self.fc.weight.t(), self.d_v).t())
+        self.n_head = len(keep)
+        self.head_mask = None
+
 
     def forward(self, q, k, v, mask=None):
 
@@ -46,6 +74,8 @@ class MultiHeadAttention(nn.Module):
             mask = mask.unsqueeze(1)   # For head axis broadcasting.
 
         q, attn = self.attention(q, k, v, mask=mask)
+        if self.head_mask is not None:
+            q = q * self.head_mask.view(1, n_head, 1, 1)
 
         # Transpose to move the head dimension back: b x lq x n x dv
         # Combine the last two dimensions to concatenate all the heads together: b x lq x (n*dv)
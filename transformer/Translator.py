@@ -1,4 +1,4 @@
-''' This module will handle the text generation with beam search. '''
+''' This module will handle the text generation with beam search, greedy and sampling decoding. '''
 
 import torch
 import torch.nn as nn
@@ -11,79 +11,153 @@ class Translator(nn.Module):
 
     def __init__(
             self, model: Transformer, beam_size, max_seq_len,
-            src_pad_idx, trg_pad_idx, trg_bos_idx, trg_eos_idx):
-        
+            src_pad_idx, trg_pad_idx, trg_bos_idx, trg_eos_idx,
+            max_len_a=None, max_len_b=0):
+
 
         super(Translator, self).__init__()
 
         self.alpha = 0.7
         self.beam_size = beam_size
         self.max_seq_len = max_seq_len
+        # Per-sentence output budget max_len_a * src_len + max_len_b (capped at
+        # max_seq_len); None keeps max_seq_len for every sentence.
+        self.max_len_a = max_len_a
+        self.max_len_b = max_len_b
         self.src_pad_idx = src_pad_idx
+        self.trg_pad_idx = trg_pad_idx
         self.trg_bos_idx = trg_bos_idx
         self.trg_eos_idx = trg_eos_idx
 
         self.model = model
         self.model.eval()
 
+        # Optional transformer.decode_telemetry.DecodeTelemetry; beam search
+        # reports per-sentence / per-step timings to it when set.
+        self.telemetry = None
+        # Source deduplication counts of the last translate_corpus call.
+        self.corpus_stats = None
+
         self.init_seq: torch.Tensor
         self.blank_seqs: torch.Tensor
         self.len_map: torch.Tensor
         self.register_buffer('init_seq', torch.LongTensor([[trg_bos_idx]]))
         self.register_buffer(
-            'blank_seqs', 
+            'blank_seqs',
             torch.full((beam_size, max_seq_len), trg_pad_idx, dtype=torch.long))
         self.blank_seqs[:, 0] = self.trg_bos_idx
         self.register_buffer(
-            'len_map', 
+            'len_map',
             torch.arange(1, max_seq_len + 1, dtype=torch.long).unsqueeze(0))
 
 
     def _model_decode(self, trg_seq, enc_output, src_mask):
         trg_mask = get_subsequent_mask(trg_seq)
         dec_output, *_ = self.model.decoder(trg_seq, trg_mask, enc_output, src_mask)
-        return F.softmax(self.model.trg_word_prj(dec_output), dim=-1)
+        if self.telemetry is not None:
+            self.telemetry.lap('decoder')
+        dec_prob = F.softmax(self.model.trg_word_prj(dec_output), dim=-1)
+        if self.telemetry is not None:
+            self.telemetry.lap('projection')
+        return dec_prob
 
 
-    def _get_init_state(self, src_seq, src_mask):
-        beam_size = self.beam_size
+    # -- Decoding state hooks.
+    # The search loops below only touch the model through these methods,
+    # so a subclass can swap in another decoding backend (e.g. a cached or
+    # compiled decoder step) without duplicating the search logic.
 
+    def _init_decode_state(self, src_seq, src_mask, max_len):
+        ''' Encode the source and return the state consumed by _step_probs
+        for up to max_len target positions. '''
         enc_output, *_ = self.model.encoder(src_seq, src_mask)
-        dec_output = self._model_decode(self.init_seq, enc_output, src_mask)
-        
-        best_k_probs, best_k_idx = dec_output[:, -1, :].topk(beam_size)
+        return enc_output, src_mask
+
+
+    def _expand_decode_state(self, state, n_repeat):
+        ''' Repeat a single-sentence state for every beam. '''
+        enc_output, src_mask = state
+        return enc_output.repeat(n_repeat, 1, 1), src_mask
+
+
+    def _reorder_decode_state(self, state, beam_idx):
+        ''' Follow the surviving beams; the encoder state is identical across beams. '''
+        return state
+
+
+    def _select_decode_state(self, state, row_idx):
+        ''' Keep only the given sentences of a batched state. '''
+        enc_output, src_mask = state
+        return enc_output.index_select(0, row_idx), src_mask.index_select(0, row_idx)
+
+
+    def _step_probs(self, gen_seq, step, state):
+        ''' Return the next-word distribution given the first `step` tokens of gen_seq. '''
+        enc_output, src_mask = state
+        dec_output = self._model_decode(gen_seq[:, :step], enc_output, src_mask)
+        return dec_output[:, -1, :], state
+
+
+    def _vocab_ids(self, idx):
+        ''' Map indices into the _step_probs distribution back to target vocabulary ids. '''
+        return idx
+
+
+    def _length_budget(self, src_seq):
+        ''' Maximum output length (BOS included) of every sentence in a padded source batch. '''
+        if self.max_len_a is None:
+            return torch.full((src_seq.size(0),), self.max_seq_len, dtype=torch.long, device=src_seq.device)
+        src_lens = (src_seq != self.src_pad_idx).sum(1)
+        budget = (self.max_len_a * src_lens.float() + self.max_len_b).long()
+        return budget.clamp(2, self.max_seq_len)
+
+
+    def _get_init_state(self, src_seq, src_mask, max_len):
+        beam_size, telemetry = self.beam_size, self.telemetry
+
+        state = self._init_decode_state(src_seq, src_mask, max_len)
+        if telemetry is not None:
+            telemetry.lap('encoder')
+        dec_prob, state = self._step_probs(self.init_seq, 1, state)
+        if telemetry is not None:
+            telemetry.lap('decoder')
+
+        best_k_probs, best_k_idx = dec_prob.topk(beam_size)
 
         scores = torch.log(best_k_probs).view(beam_size)
-        gen_seq = torch.clone(self.blank_seqs).detach()
-        gen_seq[:, 1] = best_k_idx[0]
-        enc_output = enc_output.repeat(beam_size, 1, 1)
-        return enc_output, gen_seq, scores
+        gen_seq = torch.clone(self.blank_seqs[:, :max_len]).detach()
+        gen_seq[:, 1] = self._vocab_ids(best_k_idx[0])
+        state = self._expand_decode_state(state, beam_size)
+        if telemetry is not None:
+            telemetry.lap('topk')
+            telemetry.end_step()
+        return state, gen_seq, scores
 
 
-    def _get_the_best_score_and_idx(self, gen_seq, dec_output, scores, step):
+    def _get_the_best_score_and_idx(self, gen_seq, dec_prob, scores, step):
         assert len(scores.size()) == 1
-        
+
         beam_size = self.beam_size
 
         # Get k candidates for each beam, k^2 candidates in total.
-        best_k2_probs, best_k2_idx = dec_output[:, -1, :].topk(beam_size)
+        best_k2_probs, best_k2_idx = dec_prob.topk(beam_size)
 
         # Include the previous scores.
         scores = torch.log(best_k2_probs).view(beam_size, -1) + scores.view(beam_size, 1)
 
         # Get the best k candidates from k^2 candidates.
         scores, best_k_idx_in_k2 = scores.view(-1).topk(beam_size)
- 
+
         # Get the corresponding positions of the best k candidiates.
         best_k_r_idxs, best_k_c_idxs = best_k_idx_in_k2 // beam_size, best_k_idx_in_k2 % beam_size
-        best_k_idx = best_k2_idx[best_k_r_idxs, best_k_c_idxs]
+        best_k_idx = self._vocab_ids(best_k2_idx[best_k_r_idxs, best_k_c_idxs])
 
         # Copy the corresponding previous tokens.
         gen_seq[:, :step] = gen_seq[best_k_r_idxs, :step]
         # Set the best tokens in this beam search step
         gen_seq[:, step] = best_k_idx
 
-        return gen_seq, scores
+        return gen_seq, scores, best_k_r_idxs
 
 
     def translate_sentence(self, src_seq):
@@ -91,28 +165,254 @@ class Translator(nn.Module):
         # TODO: expand to batch operation.
         assert src_seq.size(0) == 1
 
-        src_pad_idx, trg_eos_idx = self.src_pad_idx, self.trg_eos_idx 
-        max_seq_len, beam_size, alpha = self.max_seq_len, self.beam_size, self.alpha 
+        src_pad_idx, trg_eos_idx = self.src_pad_idx, self.trg_eos_idx
+        beam_size, alpha, telemetry = self.beam_size, self.alpha, self.telemetry
+        max_seq_len = int(self._length_budget(src_seq)[0])
+        len_map = self.len_map[:, :max_seq_len]
+        if telemetry is not None:
+            telemetry.start_sentence(int((src_seq != src_pad_idx).sum()), max_seq_len)
 
         with torch.no_grad():
             src_mask = get_pad_mask(src_seq, src_pad_idx)
-            enc_output, gen_seq, scores = self._get_init_state(src_seq, src_mask)
+            state, gen_seq, scores = self._get_init_state(src_seq, src_mask, max_seq_len)
 
             ans_idx = 0   # default
             seq_lens = torch.full((beam_size,), max_seq_len, dtype=torch.long, device=src_seq.device)
-            for step in range(2, max_seq_len):    # decode up to max length
-                dec_output = self._model_decode(gen_seq[:, :step], enc_output, src_mask)
-                gen_seq, scores = self._get_the_best_score_and_idx(gen_seq, dec_output, scores, step)
+            for step in range(2, max_seq_len):    # decode up to the sentence's length budget
+                dec_prob, state = self._step_probs(gen_seq, step, state)
+                if telemetry is not None:
+                    telemetry.lap('decoder')
+                gen_seq, scores, beam_idx = self._get_the_best_score_and_idx(gen_seq, dec_prob, scores, step)
+                state = self._reorder_decode_state(state, beam_idx)
 
                 # Check if all path finished
                 # -- locate the eos in the generated sequences
-                eos_locs = gen_seq == trg_eos_idx   
+                eos_locs = gen_seq == trg_eos_idx
                 # -- replace the eos with its position for the length penalty use
-                seq_lens, _ = torch.min(self.len_map.masked_fill(~eos_locs, max_seq_len), dim=1)
+                seq_lens, _ = torch.min(len_map.masked_fill(~eos_locs, max_seq_len), dim=1)
                 # -- check if all beams contain eos
-                if (eos_locs.sum(1) > 0).sum(0).item() == beam_size:
+                all_finished = (eos_locs.sum(1) > 0).sum(0).item() == beam_size
+                if telemetry is not None:
+                    telemetry.lap('topk')
+                    telemetry.end_step()
+                if all_finished:
                     # TODO: Try different terminate conditions.
                     _, ans_idx = scores.div(seq_lens.float() ** alpha).max(0)
                     ans_idx = ans_idx.item()
                     break
+            if telemetry is not None:
+                self._report_beams(gen_seq)
         return gen_seq[ans_idx][:seq_lens[ans_idx]].tolist()
+
+
+    def _get_the_best_batch_scores_and_idx(self, gen_seq, dec_prob, scores, step):
+        ''' _get_the_best_score_and_idx for sentence-major rows, beam_size rows per sentence. '''
+        beam_size = self.beam_size
+
+        # Get k candidates for each beam, k^2 candidates per sentence.
+        best_k2_probs, best_k2_idx = dec_prob.topk(beam_size)
+
+        # Include the previous scores and keep the best k candidates of every sentence.
+        scores = torch.log(best_k2_probs) + scores.unsqueeze(1)
+        scores, best_k_idx_in_k2 = scores.view(-1, beam_size * beam_size).topk(beam_size)
+
+        # Get the rows of the parent beams and the chosen candidate of each.
+        first_rows = torch.arange(0, gen_seq.size(0), beam_size, device=gen_seq.device).unsqueeze(1)
+        best_k_r_idxs = (first_rows + best_k_idx_in_k2 // beam_size).view(-1)
+        best_k_c_idxs = (best_k_idx_in_k2 % beam_size).view(-1)
+        best_k_idx = self._vocab_ids(best_k2_idx[best_k_r_idxs, best_k_c_idxs])
+
+        gen_seq = gen_seq.index_select(0, best_k_r_idxs)
+        gen_seq[:, step] = best_k_idx
+
+        return gen_seq, scores.view(-1), best_k_r_idxs
+
+
+    def beam_search(self, src_seq):
+        ''' Batched beam search; returns the same hypothesis per sentence as translate_sentence.
+
+        Every sentence holds beam_size consecutive rows and leaves the batch as soon as
+        all its beams contain EOS or its length budget is used up.
+        '''
+        src_pad_idx, trg_eos_idx = self.src_pad_idx, self.trg_eos_idx
+        beam_size, alpha = self.beam_size, self.alpha
+        sz_b = src_seq.size(0)
+
+        with torch.no_grad():
+            budget = self._length_budget(src_seq)
+            max_len = int(budget.max())
+            len_map = self.len_map[:, :max_len]
+            src_mask = get_pad_mask(src_seq, src_pad_idx)
+            state = self._init_decode_state(src_seq, src_mask, max_len)
+            gen_seq = self.blank_seqs[:1, :max_len].repeat(sz_b, 1)
+            dec_prob, state = self._step_probs(gen_seq, 1, state)
+
+            best_k_probs, best_k_idx = dec_prob.topk(beam_size)
+            scores = torch.log(best_k_probs).view(-1)
+            gen_seq = gen_seq.repeat_interleave(beam_size, 0)
+            gen_seq[:, 1] = self._vocab_ids(best_k_idx).view(-1)
+            state = self._select_decode_state(
+                state, torch.arange(sz_b, device=src_seq.device).repeat_interleave(beam_size))
+
+            alive = list(range(sz_b))
+            results = [None] * sz_b
+            for step in range(1, max_len):
+                if step > 1:
+                    dec_prob, state = self._step_probs(gen_seq, step, state)
+                    gen_seq, scores, beam_idx = self._get_the_best_batch_scores_and_idx(
+                        gen_seq, dec_prob, scores, step)
+                    state = self._reorder_decode_state(state, beam_idx)
+
+                # -- a sentence is done once all its beams contain EOS, or after the last step of its budget
+                eos_locs = gen_seq == trg_eos_idx
+                seq_lens, _ = torch.min(len_map.masked_fill(~eos_locs, max_len), dim=1)
+                seq_lens = torch.minimum(seq_lens.view(-1, beam_size), budget.unsqueeze(1))
+                all_finished = eos_locs.any(1).view(-1, beam_size).all(1)
+                is_done = all_finished | (budget <= step + 1)
+                if not is_done.any():
+                    continue
+
+                # -- finished sentences take the best length-normalized beam, the others their first one
+                _, ans_idx = scores.view(-1, beam_size).div(seq_lens.float() ** alpha).max(1)
+                ans_idx = ans_idx.masked_fill(~all_finished, 0)
+                for row in is_done.nonzero().view(-1).tolist():
+                    ans = int(ans_idx[row])
+                    results[alive[row]] = gen_seq[row * beam_size + ans, :seq_lens[row, ans]].tolist()
+                keep = (~is_done).nonzero().view(-1)
+                if keep.numel() == 0:
+                    break
+                alive = [alive[row] for row in keep.tolist()]
+                budget = budget.index_select(0, keep)
+                rows = (keep.unsqueeze(1) * beam_size + torch.arange(beam_size, device=keep.device)).view(-1)
+                gen_seq, scores = gen_seq.index_select(0, rows), scores.index_select(0, rows)
+                state = self._select_decode_state(state, rows)
+        return results
+
+
+    def _report_beams(self, gen_seq):
+        ''' Close the telemetry record of a sentence: the step at which every final beam emitted EOS. '''
+        eos_locs = gen_seq == self.trg_eos_idx
+        finished = eos_locs.any(1)
+        first_eos = eos_locs.int().argmax(1)   # position p is produced by step p
+        finish_steps = [int(pos) if done else None for pos, done in zip(first_eos, finished)]
+        self.telemetry.end_sentence('eos' if bool(finished.all()) else 'max_len', finish_steps)
+
+
+    def _sample_next(self, dec_prob, top_k=0, top_p=1.0, temperature=1.0, generator=None):
+        ''' Draw one token per row after temperature, top-k and nucleus (top-p) filtering. '''
+        if temperature != 1.0:
+            dec_prob = dec_prob.pow(1.0 / temperature)
+        if top_k > 0:
+            kth_prob = dec_prob.topk(min(top_k, dec_prob.size(-1)))[0][:, -1:]
+            dec_prob = dec_prob.masked_fill(dec_prob < kth_prob, 0.0)
+        if top_p < 1.0:
+            sorted_prob, sorted_idx = dec_prob.sort(dim=-1, descending=True)
+            cum_prob = sorted_prob.cumsum(dim=-1)
+            # Drop a token once the mass before it already exceeds top_p (the best token always stays).
+            sorted_prob = sorted_prob.masked_fill(cum_prob - sorted_prob > top_p * cum_prob[:, -1:], 0.0)
+            dec_prob = torch.zeros_like(dec_prob).scatter_(1, sorted_idx, sorted_prob)
+        return torch.multinomial(dec_prob, 1, generator=generator).view(-1)
+
+
+    def _decode_batch(self, src_seq, pick_next):
+        ''' Decode one hypothesis per sentence; a sentence leaves the batch as soon as it
+        emits EOS or reaches its length budget. '''
+        src_pad_idx, trg_eos_idx = self.src_pad_idx, self.trg_eos_idx
+        sz_b = src_seq.size(0)
+
+        with torch.no_grad():
+            budget = self._length_budget(src_seq)
+            max_len = int(budget.max())   # buffers cover the batch's budget, not max_seq_len
+            src_mask = get_pad_mask(src_seq, src_pad_idx)
+            state = self._init_decode_state(src_seq, src_mask, max_len)
+            gen_seq = self.blank_seqs[:1, :max_len].repeat(sz_b, 1)
+            alive = list(range(sz_b))
+            results = [None] * sz_b
+
+            for t in range(1, max_len):
+                dec_prob, state = self._step_probs(gen_seq, t, state)
+                gen_seq[:, t] = self._vocab_ids(pick_next(dec_prob))
+
+                # -- every sentence is done by t = max_len - 1, the largest budget
+                is_done = (gen_seq[:, t] == trg_eos_idx) | (budget <= t + 1)
+                if not is_done.any():
+                    continue
+                for row in is_done.nonzero().view(-1).tolist():
+                    results[alive[row]] = gen_seq[row, :t + 1].tolist()
+                keep = (~is_done).nonzero().view(-1)
+                if keep.numel() == 0:
+                    break
+                alive = [alive[row] for row in keep.tolist()]
+                gen_seq = gen_seq.index_select(0, keep)
+                budget = budget.index_select(0, keep)
+                state = self._select_decode_state(state, keep)
+        return results
+
+
+    def greedy_decode(self, src_seq):
+        ''' Batched greedy decoding; matches translate_sentence with beam_size=1. '''
+        return self._decode_batch(src_seq, lambda dec_prob: dec_prob.topk(1)[1].view(-1))
+
+
+    def sample_decode(self, src_seq, top_k=0, top_p=1.0, temperature=1.0, generator=None):
+        ''' Batched ancestral sampling with optional top-k / nucleus filtering. '''
+        return self._decode_batch(
+            src_seq, lambda dec_prob: self._sample_next(dec_prob, top_k, top_p, temperature, generator))
+
+
+    def translate_batch(self, src_seq, decoding='beam', **kwargs):
+        ''' Translate a padded b x len_src batch; returns one list of token ids per sentence.
+
+        decoding: 'beam' (beam_search, or translate_sentence per sentence while
+        telemetry is attached, since it records sentence by sentence), 'greedy'
+        or 'sample' (kwargs are passed on to sample_decode).
+        '''
+        if decoding == 'greedy':
+            return self.greedy_decode(src_seq)
+        if decoding == 'sample':
+            return self.sample_decode(src_seq, **kwargs)
+        assert decoding == 'beam', f'Unknown decoding method {decoding!r}'
+        if self.telemetry is None:
+            return self.beam_search(src_seq)
+        return [
+            self.translate_sentence(row[row != self.src_pad_idx].unsqueeze(0))
+            for row in src_seq]
+
+
+    def translate_corpus(self, src_insts, batch_size=64, decoding='greedy', dedupe=None, **kwargs):
+        ''' Translate a list of token-id lists in length-sorted batches; results keep the input order.
+
+        Identical sources are encoded and decoded once and their translation is
+        copied to every occurrence (dedupe defaults to True except for sampling,
+        where each copy draws its own sample). The counts are left in self.corpus_stats.
+        '''
+        if dedupe is None:
+            dedupe = decoding != 'sample'
+        if dedupe:
+            first_of, unique, inverse = {}, [], []
+            for inst in src_insts:
+                j = first_of.setdefault(tuple(inst), len(unique))
+                if j == len(unique):
+                    unique.append(inst)
+                inverse.append(j)
+        else:
+            unique, inverse = src_insts, range(len(src_insts))
+
+        order = sorted(range(len(unique)), key=lambda i: len(unique[i]))
+        unique_results = [None] * len(unique)
+        for begin in range(0, len(order), batch_size):
+            batch_idx = order[begin:begin + batch_size]
+            max_len = max(len(unique[i]) for i in batch_idx)
+            src_seq = torch.LongTensor([
+                unique[i] + [self.src_pad_idx] * (max_len - len(unique[i])) for i in batch_idx
+            ]).to(self.init_seq.device)
+            for i, hyp in zip(batch_idx, self.translate_batch(src_seq, decoding, **kwargs)):
+                unique_results[i] = hyp
+
+        n_sentences = len(src_insts)
+        self.corpus_stats = {
+            'n_sentences': n_sentences,
+            'n_unique': len(unique),
+            'dedupe_ratio': 1 - len(unique) / n_sentences if n_sentences else 0.0,
+        }
+        return [list(unique_results[j]) for j in inverse]
@@ -1,10 +1,4 @@
-from . import Constants
-from . import Layers
-from . import Models
-from . import Modules
-from . import Optim
-from . import SubLayers
-from . import Translator
+import importlib
 
 __all__ = [
     'Constants',
@@ -15,3 +9,15 @@ __all__ = [
     'Optim',
     'Translator',
 ]
+
+
+# Submodules are imported on first attribute access (PEP 562), so importing
+# the package, or a light submodule such as Constants, does not load torch.
+def __getattr__(name):
+    if name in __all__:
+        return importlib.import_module(f'.{name}', __name__)
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
@@ -0,0 +1,8 @@
+from .config import RUNTIME_KEYS, apply_threads, load_runtime_config, save_runtime_config
+
+__all__ = [
+    'RUNTIME_KEYS',
+    'apply_threads',
+    'load_runtime_config',
+    'save_runtime_config',
+]
@@ -0,0 +1,35 @@
+''' The runtime config written by transformer.autotune.tune and read by the translation entry points. '''
+import json
+
+import torch
+
+
+# Keys of the 'recommended' section of a runtime config file.
+RUNTIME_KEYS = ('threads', 'interop_threads', 'workers', 'batch_size', 'beam_size', 'decoding')
+
+
+def decoding_for_beam(beam_size):
+    ''' beam_size 1 runs batched greedy decoding, which yields the same output as a beam of 1. '''
+    return 'greedy' if beam_size == 1 else 'beam'
+
+
+def save_runtime_config(path, recommended, **extra):
+    with open(path, 'w') as f:
+        json.dump({'recommended': {key: recommended[key] for key in RUNTIME_KEYS}, **extra}, f, indent=2)
+
+
+def load_runtime_config(path):
+    ''' The recommended settings of a runtime config file, as a dict with RUNTIME_KEYS. '''
+    with open(path) as f:
+        return json.load(f)['recommended']
+
+
+def apply_threads(config):
+    ''' Set the intra- and inter-op thread pools of this process. '''
+    torch.set_num_threads(config['threads'])
+    try:
+        torch.set_num_interop_threads(config['interop_threads'])
+    except RuntimeError:
+        # -- only possible before the first inter-op parallel work of the process
+        print('[Warning] inter-op threads already initialised; keeping '
+              f'{torch.get_num_interop_threads()} instead of {config["interop_threads"]}')
@@ -0,0 +1,209 @@
+''' Sweep the CPU runtime knobs of the Translator and write a recommended config.
+
+Usage:
+    python -m transformer.autotune.tune -model output/model.chkpt -data_pkl m30k.pkl -save runtime.json
+    python -m transformer.autotune.tune ... -objective latency -beam_sizes 1 4 5
+
+Every trial runs in freshly spawned processes, one per worker, so the thread
+pools are configured before any torch work, exactly as in a server process.
+The search is staged: threads x inter-op threads x workers at the first beam
+and batch size, then beam size x batch size with the best thread layout.
+Beam sizes whose BLEU on the sample is more than -max_bleu_drop below the
+best one are never recommended.
+'''
+import argparse
+import multiprocessing as mp
+import os
+import pickle
+import platform
+import queue
+import time
+
+import torch
+import transformer.Constants as Constants
+from transformer.autotune.config import decoding_for_beam, save_runtime_config
+from transformer.bleu.metric import corpus_bleu, strip_specials
+
+
+def _worker(settings, shard, rank, barrier, results):
+    from transformer.checkpoint import build_translator, load_model
+
+    torch.set_num_threads(settings['threads'])
+    torch.set_num_interop_threads(settings['interop_threads'])
+    model, _, _ = load_model(settings['model'])
+    translator = build_translator(model.eval(), settings['trg_vocab'], settings['beam_size'], settings['max_seq_len'])
+    decoding = decoding_for_beam(settings['beam_size'])
+    batch_size = settings['batch_size']
+    batches = [shard[i:i + batch_size] for i in range(0, len(shard), batch_size)]
+
+    for batch in batches[:settings['warmup']]:
+        translator.translate_corpus(batch, batch_size, decoding)
+    barrier.wait()
+
+    hyps, latencies = [], []
+    start = time.perf_counter()
+    for batch in batches:
+        batch_start = time.perf_counter()
+        hyps += translator.translate_corpus(batch, batch_size, decoding)
+        latencies.append(time.perf_counter() - batch_start)
+    results.put((rank, time.perf_counter() - start, latencies, hyps))
+
+
+def _percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def run_trial(opt, trial, sample, refs, trg_vocab, specials):
+    ''' Decode the sample with the knobs of `trial`; returns the trial extended with its metrics. '''
+    n_workers = trial['workers']
+    settings = dict(trial, model=opt.model, trg_vocab=trg_vocab, max_seq_len=opt.max_seq_len, warmup=opt.warmup)
+    ctx = mp.get_context('spawn')
+    # -- the barrier timeout releases the other workers if one dies before reaching it
+    barrier, results = ctx.Barrier(n_workers, timeout=opt.trial_timeout), ctx.Queue()
+    procs = [
+        ctx.Process(target=_worker, args=(settings, sample[rank::n_workers], rank, barrier, results))
+        for rank in range(n_workers)]
+    for proc in procs:
+        proc.start()
+
+    # -- poll the results and the workers, so a crashed worker fails the trial at once
+    outputs, error = [], None
+    deadline = time.monotonic() + opt.trial_timeout
+    while len(outputs) < n_workers and error is None:
+        try:
+            outputs.append(results.get(timeout=1.0))
+            continue
+        except queue.Empty:
+            pass
+        exitcodes = [proc.exitcode for proc in procs if proc.exitcode not in (None, 0)]
+        if exitcodes:
+            error = f'worker exited with code {exitcodes[0]}'
+        elif time.monotonic() > deadline:
+            error = 'timed out'
+    if error is not None:
+        for proc in procs:
+            proc.terminate()
+    for proc in procs:
+        proc.join()
+    if error is not None:
+        return dict(trial, ok=False, error=error)
+
+    hyps, latencies = [None] * len(sample), []
+    for rank, _, worker_latencies, worker_hyps in outputs:
+        hyps[rank::n_workers] = worker_hyps
+        latencies += worker_latencies
+    return dict(
+        trial, ok=True,
+        sentences_per_sec=len(sample) / max(elapsed for _, elapsed, _, _ in outputs),
+        p50_latency_ms=1e3 * _percentile(latencies, 0.5),
+        p90_latency_ms=1e3 * _percentile(latencies, 0.9),
+        bleu=corpus_bleu([strip_specials(hyp, specials) for hyp in hyps], refs))
+
+
+def select_best(results, opt):
+    ''' The best finished trial under the objective, the latency limit and the BLEU gate. '''
+    candidates = [r for r in results if r['ok']]
+    best_bleu = max(r['bleu'] for r in candidates)
+    candidates = [r for r in candidates if r['bleu'] >= best_bleu - opt.max_bleu_drop]
+    if opt.max_latency_ms:
+        within = [r for r in candidates if r['p90_latency_ms'] <= opt.max_latency_ms]
+        if not within:
+            print(f'[Warning] No trial meets p90 latency <= {opt.max_latency_ms} ms; ignoring the limit')
+        candidates = within or candidates
+    if opt.objective == 'throughput':
+        return max(candidates, key=lambda r: r['sentences_per_sec'])
+    return min(candidates, key=lambda r: r['p90_latency_ms'])
+
+
+def _thread_candidates(n_cpu):
+    candidates, n = [], 1
+    while n < n_cpu:
+        candidates.append(n)
+        n *= 2
+    return candidates + [n_cpu]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Autotune CPU threads, workers, batch and beam size for translation')
+    parser.add_argument('-model', required=True, help='Checkpoint or fastload export directory')
+    parser.add_argument('-data_pkl', required=True, help='Preprocessed data; its validation set is the sample')
+    parser.add_argument('-save', required=True, help='Output runtime config (JSON)')
+    parser.add_argument('-objective', choices=['throughput', 'latency'], default='throughput')
+    parser.add_argument('-max_latency_ms', type=float, default=0, help='p90 batch latency limit (0: none)')
+    parser.add_argument('-max_bleu_drop', type=float, default=0.5,
+                        help='Largest BLEU loss vs the best beam size that may be traded for speed')
+    parser.add_argument('-n_sentences', type=int, default=200)
+    parser.add_argument('-threads', type=int, nargs='+', default=None, help='Default: powers of two up to the CPU count')
+    parser.add_argument('-interop_threads', type=int, nargs='+', default=[1, 2])
+    parser.add_argument('-workers', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('-batch_sizes', type=int, nargs='+', default=[1, 8, 32, 64])
+    parser.add_argument('-beam_sizes', type=int, nargs='+', default=[5, 1])
+    parser.add_argument('-max_seq_len', type=int, default=100)
+    parser.add_argument('-warmup', type=int, default=2, help='Untimed batches per worker')
+    parser.add_argument('-trial_timeout', type=float, default=600)
+    opt = parser.parse_args(argv)
+
+    n_cpu = os.cpu_count() or 1
+    with open(opt.data_pkl, 'rb') as f:
+        data = pickle.load(f)
+    sample = data['valid']['src'][:opt.n_sentences]
+    trg_vocab = data['vocab']['trg']
+    specials = {
+        'bos': trg_vocab.stoi[Constants.BOS_WORD],
+        'eos': trg_vocab.stoi[Constants.EOS_WORD],
+        'pad': trg_vocab.stoi[Constants.PAD_WORD],
+    }
+    refs = [strip_specials(seq, specials) for seq in data['valid']['trg'][:opt.n_sentences]]
+    del data
+
+    results = []
+
+    def trial(**knobs):
+        result = run_trial(opt, knobs, sample, refs, trg_vocab, specials)
+        results.append(result)
+        if result['ok']:
+            print(f"  threads {knobs['threads']:3d} interop {knobs['interop_threads']:2d} workers {knobs['workers']:2d} "
+                  f"batch {knobs['batch_size']:3d} beam {knobs['beam_size']:2d}: "
+                  f"{result['sentences_per_sec']:8.2f} sent/s, p90 {result['p90_latency_ms']:8.1f} ms, "
+                  f"BLEU {result['bleu']:5.2f}")
+        else:
+            print(f"  {knobs}: {result['error']}")
+
+    print('[Info] Stage 1: threads x inter-op threads x workers')
+    beam_size = opt.beam_sizes[0]
+    batch_size = opt.batch_sizes[0]
+    for threads in opt.threads or _thread_candidates(n_cpu):
+        for interop_threads in opt.interop_threads:
+            for workers in opt.workers:
+                if threads * workers <= n_cpu:
+                    trial(threads=threads, interop_threads=interop_threads, workers=workers,
+                          batch_size=batch_size, beam_size=beam_size)
+    if not any(r['ok'] for r in results):
+        parser.error('No trial finished; check -threads / -workers against the CPU count and -trial_timeout')
+    layout = select_best(results, opt)
+
+    print('[Info] Stage 2: beam size x batch size')
+    for beam_size in opt.beam_sizes:
+        for batch_size in opt.batch_sizes:
+            if (beam_size, batch_size) != (layout['beam_size'], layout['batch_size']):
+                trial(threads=layout['threads'], interop_threads=layout['interop_threads'],
+                      workers=layout['workers'], batch_size=batch_size, beam_size=beam_size)
+
+    best = select_best(results, opt)
+    best = dict(best, decoding=decoding_for_beam(best['beam_size']))
+    save_runtime_config(
+        opt.save, best,
+        objective=opt.objective,
+        metrics={key: best[key] for key in ('sentences_per_sec', 'p50_latency_ms', 'p90_latency_ms', 'bleu')},
+        environment={
+            'cpu_count': n_cpu, 'torch': torch.__version__, 'platform': platform.platform(),
+            'model': opt.model, 'n_sentences': len(sample)},
+        trials=results)
+    print(f"[Info] Recommended: threads {best['threads']}, interop {best['interop_threads']}, "
+          f"workers {best['workers']}, batch {best['batch_size']}, beam {best['beam_size']} -> {opt.save}")
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,111 @@
+''' Average the model weights of several training checkpoints.
+
+Checkpoints are opened with torch.load(mmap=True), so optimizer state and
+tensors stay on disk until touched. Only the `model` state_dicts are read,
+one parameter at a time: the running sum for a single tensor is the only
+full-size temporary. Parameters that share storage (tied embeddings /
+projection) are averaged once and stay tied in the output, which is a slim
+inference checkpoint loadable with transformer.checkpoint.load_model.
+
+    python -m transformer.averaging -output_dir output -last 5 -save output/model_avg.chkpt
+'''
+import argparse
+import glob
+import os
+import re
+
+import torch
+from transformer.checkpoint import model_config
+
+
+def _load(path):
+    return torch.load(path, map_location='cpu', mmap=True, weights_only=False)
+
+
+def _storage_key(tensor):
+    return (tensor.untyped_storage().data_ptr(), tensor.storage_offset(), tuple(tensor.shape), tensor.stride())
+
+
+def tied_groups(state_dict):
+    ''' {name: name of the first entry sharing its storage} for every aliased entry. '''
+    first_by_storage, ties = {}, {}
+    for name, tensor in state_dict.items():
+        first = first_by_storage.setdefault(_storage_key(tensor), name)
+        if first != name:
+            ties[name] = first
+    return ties
+
+
+def average_checkpoints(paths):
+    ''' Returns (averaged state_dict, model config, vocab) of the checkpoints at `paths`. '''
+    checkpoints = [_load(path) for path in paths]
+    first = checkpoints[0]
+    config = model_config(first['settings'])
+    ties = tied_groups(first['model'])
+
+    for path, checkpoint in zip(paths[1:], checkpoints[1:]):
+        if model_config(checkpoint['settings']) != config:
+            raise ValueError(f'{path} has a different model configuration than {paths[0]}')
+        if checkpoint['model'].keys() != first['model'].keys():
+            raise ValueError(f'{path} has different parameter names than {paths[0]}')
+        if tied_groups(checkpoint['model']) != ties:
+            raise ValueError(f'{path} ties different parameters than {paths[0]}')
+
+    averaged = {}
+    for name, tensor in first['model'].items():
+        if name in ties:
+            averaged[name] = averaged[ties[name]]
+            continue
+        if not tensor.is_floating_point():
+            averaged[name] = checkpoints[-1]['model'][name].clone()
+            continue
+        total = tensor.to(torch.float64, copy=True)   # never accumulate into the mmapped storage
+        for checkpoint in checkpoints[1:]:
+            other = checkpoint['model'][name]
+            if other.shape != tensor.shape:
+                raise ValueError(f'Parameter {name} has shape {tuple(other.shape)}, expected {tuple(tensor.shape)}')
+            total += other
+        averaged[name] = total.div_(len(checkpoints)).to(tensor.dtype)
+
+    return averaged, config, first.get('vocab')
+
+
+def last_checkpoints(output_dir, n):
+    ''' The n latest per-epoch checkpoints written by train_modern.py -save_mode all. '''
+    def epoch_of(path):
+        return int(re.search(r'model_epoch_(\d+)\.chkpt$', path).group(1))
+    paths = sorted(glob.glob(os.path.join(output_dir, 'model_epoch_*.chkpt')), key=epoch_of)
+    return paths[-n:]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Average the weights of several checkpoints')
+    parser.add_argument('-inputs', nargs='+', default=[], help='Checkpoint files to average')
+    parser.add_argument('-output_dir', type=str, default=None,
+                        help='Training output directory; use its latest -last per-epoch checkpoints')
+    parser.add_argument('-last', type=int, default=5)
+    parser.add_argument('-save', required=True, help='Output (inference-only) checkpoint')
+    opt = parser.parse_args(argv)
+
+    paths = list(opt.inputs)
+    if opt.output_dir:
+        paths += last_checkpoints(opt.output_dir, opt.last)
+    if not paths:
+        parser.error('No checkpoints given: pass -inputs or -output_dir (trained with -save_mode all)')
+
+    print(f'[Info] Averaging {len(paths)} checkpoints:')
+    for path in paths:
+        print(f'    {path}')
+    state_dict, config, vocab = average_checkpoints(paths)
+    torch.save({
+        'settings': config,
+        'model': state_dict,
+        'vocab': vocab,
+        'averaged_from': [os.path.basename(path) for path in paths],
+    }, opt.save)
+    print(f'[Info] Averaged checkpoint saved to {opt.save}')
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
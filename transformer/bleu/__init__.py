@@ -0,0 +1,22 @@
+import importlib
+
+from .metric import corpus_bleu, ngram_stats, strip_specials
+
+__all__ = [
+    'corpus_bleu',
+    'ngram_stats',
+    'strip_specials',
+    'BleuValidator',
+]
+
+
+# The multiprocessing worker is imported on first access (PEP 562), so tools
+# that only score BLEU do not load it.
+def __getattr__(name):
+    if name == 'BleuValidator':
+        return importlib.import_module('.worker', __name__).BleuValidator
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
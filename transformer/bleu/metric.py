@@ -0,0 +1,86 @@
+''' Corpus BLEU over token ids with vectorized n-gram counting.
+
+All sentences are flattened into one token stream. The n-gram ids for order n
+are built from the ids of order n - 1 plus the next token and renumbered with
+torch.unique, so they never overflow. Clipped matches are then counted per
+(sentence, n-gram) pair with one unique/searchsorted pass per order instead of
+Python Counters per sentence.
+'''
+import math
+
+import torch
+
+
+def _flatten(seqs, sent_offset):
+    tokens = torch.LongTensor([tok for seq in seqs for tok in seq])
+    lens = torch.LongTensor([len(seq) for seq in seqs])
+    sent = torch.repeat_interleave(torch.arange(len(seqs)) + sent_offset, lens)
+    return tokens, sent
+
+
+def _unique_counts(keys):
+    return torch.unique(keys, return_counts=True)
+
+
+def ngram_stats(hyps, refs, max_n=4):
+    ''' Returns (clipped matches per order, hypothesis n-grams per order, hyp length, ref length). '''
+    assert len(hyps) == len(refs)
+    n_sent = len(hyps)
+    if n_sent == 0:
+        return [0] * max_n, [0] * max_n, 0, 0
+    hyp_tokens, hyp_sent = _flatten(hyps, 0)
+    ref_tokens, ref_sent = _flatten(refs, n_sent)
+    tokens = torch.cat([hyp_tokens, ref_tokens])
+    sent = torch.cat([hyp_sent, ref_sent])
+    n_vocab = int(tokens.max()) + 1 if tokens.numel() else 1
+
+    matches, totals = [0] * max_n, [0] * max_n
+    keys = tokens
+    for n in range(1, max_n + 1):
+        if n > 1:
+            # -- extend every (n-1)-gram by the following token, then renumber densely
+            keys = keys[:-1] * n_vocab + tokens[n - 1:]
+            _, keys = torch.unique(keys, return_inverse=True)
+        if keys.numel() == 0:
+            break
+
+        # -- an n-gram is valid when its first and last token belong to the same sentence
+        start_sent = sent[:keys.numel()]
+        valid = start_sent == sent[n - 1:]
+        gram, gram_sent = keys[valid], start_sent[valid]
+
+        is_ref = gram_sent >= n_sent
+        pair = gram_sent % n_sent
+        pair_keys = pair * (int(keys.max()) + 1) + gram
+        hyp_keys, hyp_counts = _unique_counts(pair_keys[~is_ref])
+        ref_keys, ref_counts = _unique_counts(pair_keys[is_ref])
+
+        totals[n - 1] = int(hyp_counts.sum())
+        if hyp_keys.numel() == 0 or ref_keys.numel() == 0:
+            continue
+        pos = torch.searchsorted(ref_keys, hyp_keys).clamp(max=ref_keys.numel() - 1)
+        found = ref_keys[pos] == hyp_keys
+        matches[n - 1] = int(torch.minimum(hyp_counts, ref_counts[pos])[found].sum())
+
+    return matches, totals, len(hyp_tokens), len(ref_tokens)
+
+
+def strip_specials(seq, specials):
+    ''' Drop BOS / PAD and cut at the first EOS. '''
+    out = []
+    for tok in seq:
+        if tok == specials['eos']:
+            break
+        if tok not in (specials['bos'], specials['pad']):
+            out.append(tok)
+    return out
+
+
+def corpus_bleu(hyps, refs, max_n=4):
+    ''' Corpus-level BLEU (x100) of token-id hypotheses against single references. '''
+    matches, totals, hyp_len, ref_len = ngram_stats(hyps, refs, max_n)
+    if hyp_len == 0 or min(matches) == 0:
+        return 0.0
+    log_precision = sum(math.log(m / t) for m, t in zip(matches, totals)) / max_n
+    brevity_penalty = min(0.0, 1 - ref_len / hyp_len)
+    return 100 * math.exp(brevity_penalty + log_precision)
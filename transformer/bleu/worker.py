@@ -0,0 +1,114 @@
+''' Background BLEU validation in a separate process.
+
+The training loop saves a snapshot checkpoint per epoch and submits its path;
+the worker process loads it, decodes the validation set in batches with
+Translator.translate_corpus and scores it with corpus_bleu. Results are
+collected with non-blocking polls, so training never waits on decoding. If
+the worker dies (OOM, a decode error, a killed process) the epochs it still
+owed are reported as lost and BLEU validation stops; training continues.
+'''
+import multiprocessing as mp
+import pickle
+import queue
+
+import torch
+import transformer.Constants as Constants
+from transformer.bleu.metric import corpus_bleu, strip_specials
+
+
+def _worker_loop(settings, tasks, results):
+    from transformer.checkpoint import build_translator, load_model
+
+    torch.set_num_threads(settings['threads'])
+    with open(settings['data_pkl'], 'rb') as f:
+        data = pickle.load(f)
+    src_insts = data['valid']['src']
+    trg_vocab = data['vocab']['trg']
+    specials = {
+        'bos': trg_vocab.stoi[Constants.BOS_WORD],
+        'eos': trg_vocab.stoi[Constants.EOS_WORD],
+        'pad': trg_vocab.stoi[Constants.PAD_WORD],
+    }
+    refs = [strip_specials(seq, specials) for seq in data['valid']['trg']]
+    del data
+
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        epoch, snapshot_path = task
+        model, _, _ = load_model(snapshot_path, settings['device'])
+        translator = build_translator(model, trg_vocab, settings['beam_size'], settings['max_seq_len'])
+        hyps = translator.translate_corpus(src_insts, settings['batch_size'], settings['decoding'])
+        bleu = corpus_bleu([strip_specials(seq, specials) for seq in hyps], refs)
+        results.put((epoch, bleu, snapshot_path))
+
+
+class BleuValidator():
+    ''' Owns the worker process and its task / result queues. '''
+
+    def __init__(self, data_pkl, device='cpu', threads=2, decoding='greedy',
+                 beam_size=5, max_seq_len=100, batch_size=64, liveness_interval=10.0):
+        settings = {
+            'data_pkl': data_pkl, 'device': device, 'threads': threads, 'decoding': decoding,
+            'beam_size': beam_size, 'max_seq_len': max_seq_len, 'batch_size': batch_size,
+        }
+        ctx = mp.get_context('spawn')
+        self.tasks = ctx.Queue()
+        self.results = ctx.Queue()
+        self.pending = []   # epochs submitted and not yet scored, in submit order
+        self.liveness_interval = liveness_interval
+        self.process = ctx.Process(target=_worker_loop, args=(settings, self.tasks, self.results), daemon=True)
+        self.process.start()
+
+    def submit(self, epoch, snapshot_path):
+        ''' Queue a snapshot for scoring; False if the worker is gone (the caller owns the snapshot then). '''
+        if not self.process.is_alive():
+            print(f'[Warning] BLEU worker is gone; epoch {epoch} is not scored')
+            return False
+        self.tasks.put((epoch, snapshot_path))
+        self.pending.append(epoch)
+        return True
+
+    def _receive(self, result, finished):
+        finished.append(result)
+        self.pending.remove(result[0])
+
+    def _drop_lost(self):
+        ''' Report the epochs a dead worker still owed and forget them. '''
+        print(f'[Warning] BLEU worker exited with code {self.process.exitcode}; '
+              f'no BLEU for epochs {self.pending} (their snapshots are kept)')
+        self.pending = []
+
+    def poll(self, block=False):
+        ''' Finished (epoch, bleu, snapshot_path) results; waits for all pending ones if block.
+
+        While waiting, the worker is checked every liveness_interval seconds, so a
+        dead worker ends the wait instead of blocking forever.
+        '''
+        finished = []
+        while self.pending:
+            try:
+                self._receive(self.results.get(block=block, timeout=self.liveness_interval), finished)
+                continue
+            except queue.Empty:
+                pass
+            if self.process.is_alive():
+                if not block:
+                    break
+                continue
+            # -- results put just before the worker died may still be in the pipe
+            try:
+                while self.pending:
+                    self._receive(self.results.get(timeout=1.0), finished)
+            except queue.Empty:
+                self._drop_lost()
+        return finished
+
+    def close(self):
+        ''' Wait for the pending snapshots, stop the worker and return their results. '''
+        finished = self.poll(block=True)
+        if self.process.is_alive():
+            self.tasks.put(None)
+            self.process.join()
+        return finished
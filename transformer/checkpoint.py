@@ -0,0 +1,70 @@
+''' Build models and translators from the checkpoints written by train_modern.py. '''
+import os
+
+import torch
+import transformer.Constants as Constants
+from transformer.Models import Transformer
+from transformer.Translator import Translator
+
+
+# Option names (as defined in train_modern.py) that determine the model architecture.
+MODEL_CONFIG_KEYS = (
+    'src_vocab_size', 'trg_vocab_size', 'src_pad_idx', 'trg_pad_idx',
+    'proj_share_weight', 'embs_share_weight',
+    'd_k', 'd_v', 'd_model', 'd_word_vec', 'd_inner_hid',
+    'n_layers', 'n_head', 'dropout', 'scale_emb_or_prj',
+)
+
+# Architecture options that older checkpoints (or train_modern.py) may not
+# define, with the value that reproduces the default architecture.
+OPTIONAL_CONFIG_KEYS = {
+    'head_counts': None,   # per-layer head counts of a head-pruned model
+    'n_enc_layers': None,  # encoder / decoder depth when they differ from n_layers
+    'n_dec_layers': None,
+    'layerdrop': 0.0,
+}
+
+
+def model_config(settings):
+    ''' Extract the architecture options from an argparse namespace or a dict. '''
+    if not isinstance(settings, dict):
+        settings = vars(settings)
+    config = {key: settings[key] for key in MODEL_CONFIG_KEYS}
+    config.update({key: settings.get(key, default) for key, default in OPTIONAL_CONFIG_KEYS.items()})
+    return config
+
+
+def build_model(config, device='cpu'):
+    ''' Instantiate an (untrained) Transformer from a model config dict. '''
+    return Transformer(
+        config['src_vocab_size'], config['trg_vocab_size'],
+        src_pad_idx=config['src_pad_idx'], trg_pad_idx=config['trg_pad_idx'],
+        trg_emb_prj_weight_sharing=config['proj_share_weight'],
+        emb_src_trg_weight_sharing=config['embs_share_weight'],
+        d_k=config['d_k'], d_v=config['d_v'], d_model=config['d_model'], d_word_vec=config['d_word_vec'],
+        d_inner=config['d_inner_hid'], n_layers=config['n_layers'], n_head=config['n_head'],
+        dropout=config['dropout'], scale_emb_or_prj=config['scale_emb_or_prj'],
+        head_counts=config.get('head_counts'), n_enc_layers=config.get('n_enc_layers'),
+        n_dec_layers=config.get('n_dec_layers'), layerdrop=config.get('layerdrop', 0.0)).to(device)
+
+
+def load_model(path, device='cpu'):
+    ''' Load a training checkpoint, or an inference export directory written by
+    transformer.fastload; returns (model, config, vocab). '''
+    if os.path.isdir(path):
+        from transformer.fastload import load_exported
+        return load_exported(path, device)
+    checkpoint = torch.load(path, map_location=device, weights_only=False)
+    config = model_config(checkpoint['settings'])
+    model = build_model(config, device)
+    model.load_state_dict(checkpoint['model'])
+    return model, config, checkpoint.get('vocab')
+
+
+def build_translator(model, trg_vocab, beam_size=5, max_seq_len=100, translator_cls=Translator, **kwargs):
+    ''' Wrap a model in a Translator using the special token ids of the target vocabulary. '''
+    return translator_cls(
+        model=model, beam_size=beam_size, max_seq_len=max_seq_len,
+        src_pad_idx=model.src_pad_idx, trg_pad_idx=model.trg_pad_idx,
+        trg_bos_idx=trg_vocab.stoi[Constants.BOS_WORD],
+        trg_eos_idx=trg_vocab.stoi[Constants.EOS_WORD], **kwargs).to(next(model.parameters()).device)
@@ -0,0 +1,12 @@
+from .artifacts import MODES, build_steps
+from .steps import DecoderStep, EncoderStep, init_self_cache
+from .translator import CachedTranslator
+
+__all__ = [
+    'MODES',
+    'build_steps',
+    'EncoderStep',
+    'DecoderStep',
+    'init_self_cache',
+    'CachedTranslator',
+]
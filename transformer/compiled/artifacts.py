@@ -0,0 +1,141 @@
+''' Build, persist and reload the encoder / decoder-step graphs.
+
+Modes:
+    'eager':   plain nn.Modules, no compilation.
+    'compile': torch.compile; the inductor cache is saved next to the artifacts
+               with torch.compiler.save_cache_artifacts() and preloaded at startup.
+    'export':  torch.export programs saved as .pt2 files (weights included).
+
+Any failure while compiling or loading falls back to eager mode with a warning.
+'''
+import hashlib
+import json
+import os
+import warnings
+
+import torch
+from transformer.Models import Transformer
+from transformer.compiled.steps import DecoderStep, EncoderStep, init_self_cache
+
+
+MODES = ('eager', 'compile', 'export')
+
+_META_FILE = 'meta.json'
+_COMPILE_CACHE_FILE = 'compile_cache.bin'
+_ENCODER_FILE = 'encoder.pt2'
+_DECODER_FILE = 'decoder_step.pt2'
+
+
+def model_fingerprint(model: Transformer):
+    ''' Cheap digest of the weights, used to invalidate stale artifacts. '''
+    digest = hashlib.sha1()
+    for name, tensor in model.state_dict().items():
+        digest.update(name.encode())
+        digest.update(str(tuple(tensor.shape)).encode())
+        digest.update(repr(float(tensor.double().sum())).encode())
+    return digest.hexdigest()
+
+
+def _example_inputs(model: Transformer, sz_b=2, len_src=8, max_len=16):
+    ''' Example arguments for tracing; sizes > 1 so no dimension gets specialized. '''
+    device = model.trg_word_prj.weight.device
+    src_seq = torch.randint(4, model.encoder.src_word_emb.num_embeddings, (sz_b, len_src), device=device)
+    with torch.no_grad():
+        src_mask, cross_k, cross_v = EncoderStep(model)(src_seq)
+    self_k, self_v = init_self_cache(model, sz_b, max_len)
+    trg_tok = torch.full((sz_b,), 2, dtype=torch.long, device=device)
+    pos = torch.ones(sz_b, dtype=torch.long, device=device)
+    return (src_seq,), (trg_tok, pos, self_k, self_v, cross_k, cross_v, src_mask)
+
+
+def _read_meta(artifact_dir):
+    path = os.path.join(artifact_dir, _META_FILE)
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def _write_meta(artifact_dir, meta):
+    with open(os.path.join(artifact_dir, _META_FILE), 'w') as f:
+        json.dump(meta, f, indent=2)
+
+
+def _build_compiled(model, artifact_dir):
+    cache_path = os.path.join(artifact_dir, _COMPILE_CACHE_FILE) if artifact_dir else None
+    if cache_path and os.path.exists(cache_path):
+        with open(cache_path, 'rb') as f:
+            torch.compiler.load_cache_artifacts(f.read())
+
+    encoder_step = torch.compile(EncoderStep(model), dynamic=True)
+    decoder_step = torch.compile(DecoderStep(model), dynamic=True)
+
+    # Compilation is lazy: run once so the graphs exist before serving traffic.
+    enc_args, dec_args = _example_inputs(model)
+    with torch.no_grad():
+        encoder_step(*enc_args)
+        decoder_step(*dec_args)
+
+    if cache_path:
+        saved = torch.compiler.save_cache_artifacts()
+        if saved is not None:
+            with open(cache_path, 'wb') as f:
+                f.write(saved[0])
+    return encoder_step, decoder_step
+
+
+def _export(model, artifact_dir):
+    encoder_path = os.path.join(artifact_dir, _ENCODER_FILE) if artifact_dir else None
+    decoder_path = os.path.join(artifact_dir, _DECODER_FILE) if artifact_dir else None
+    if encoder_path and decoder_path and os.path.exists(encoder_path) and os.path.exists(decoder_path):
+        return torch.export.load(encoder_path).module(), torch.export.load(decoder_path).module()
+
+    enc_args, dec_args = _example_inputs(model)
+    n_layers = len(dec_args[2])   # active decoder layers
+    auto = torch.export.Dim.AUTO
+    cache_dims = tuple({0: auto, 2: auto} for _ in range(n_layers))
+    enc_dynamic = ({0: auto, 1: auto},)
+    dec_dynamic = ({0: auto}, {0: auto}, cache_dims, cache_dims, cache_dims, cache_dims, {0: auto, 2: auto})
+
+    with torch.no_grad():
+        encoder_program = torch.export.export(EncoderStep(model), enc_args, dynamic_shapes=enc_dynamic)
+        decoder_program = torch.export.export(DecoderStep(model), dec_args, dynamic_shapes=dec_dynamic)
+
+    if encoder_path and decoder_path:
+        torch.export.save(encoder_program, encoder_path)
+        torch.export.save(decoder_program, decoder_path)
+    return encoder_program.module(), decoder_program.module()
+
+
+def build_steps(model: Transformer, mode='eager', artifact_dir=None):
+    ''' Return (encoder_step, decoder_step, mode_used) for a model in eval mode.
+
+    With an artifact_dir, compiled artifacts are reused when they were built
+    from the same weights, torch version and mode; otherwise they are rebuilt
+    and saved there.
+    '''
+    assert mode in MODES, f'Unknown mode {mode!r}, expected one of {MODES}'
+    model.eval()
+    if mode == 'eager':
+        return EncoderStep(model), DecoderStep(model), 'eager'
+
+    try:
+        if artifact_dir:
+            os.makedirs(artifact_dir, exist_ok=True)
+            meta = {
+                'mode': mode, 'torch': torch.__version__, 'fingerprint': model_fingerprint(model),
+                'active_layers': [model.encoder.active_layers, model.decoder.active_layers]}
+            if _read_meta(artifact_dir) != meta:
+                for name in (_COMPILE_CACHE_FILE, _ENCODER_FILE, _DECODER_FILE):
+                    if os.path.exists(os.path.join(artifact_dir, name)):
+                        os.remove(os.path.join(artifact_dir, name))
+                _write_meta(artifact_dir, meta)
+
+        if mode == 'compile':
+            encoder_step, decoder_step = _build_compiled(model, artifact_dir)
+        else:
+            encoder_step, decoder_step = _export(model, artifact_dir)
+        return encoder_step, decoder_step, mode
+    except Exception as e:
+        warnings.warn(f'[Warning] Building {mode!r} decoder graphs failed ({e}); falling back to eager mode.')
+        return EncoderStep(model), DecoderStep(model), 'eager'
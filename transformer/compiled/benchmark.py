@@ -0,0 +1,174 @@
+''' Startup-time and steady-state benchmark for the compiled decoding graphs.
+
+Usage:
+    python -m transformer.compiled.benchmark -checkpoint output/model.chkpt -artifact_dir output/compiled
+    python -m transformer.compiled.benchmark -modes eager compile export   # random weights
+
+Startup is measured in fresh processes, twice per mode: "cold" with an empty
+artifact directory and "warm" reusing the artifacts written by the cold run.
+Steady state is translated sentences/sec on random sources, compared with the
+plain Translator (full-prefix re-decoding). With -decode_telemetry every
+translator decodes the sources once more, untimed, with a DecodeTelemetry
+attached, and the per-step breakdowns are written as JSON.
+'''
+import argparse
+import json
+import multiprocessing as mp
+import os
+import shutil
+import tempfile
+import time
+
+import torch
+
+
+def _load(opt):
+    from transformer.Models import set_active_layers
+    from transformer.checkpoint import build_model, load_model
+
+    if opt.checkpoint:
+        model, _, _ = load_model(opt.checkpoint)
+    else:
+        torch.manual_seed(opt.seed)
+        model = build_model({
+            'src_vocab_size': opt.vocab_size, 'trg_vocab_size': opt.vocab_size,
+            'src_pad_idx': 0, 'trg_pad_idx': 0,
+            'proj_share_weight': True, 'embs_share_weight': True,
+            'd_k': opt.d_model // opt.n_head, 'd_v': opt.d_model // opt.n_head,
+            'd_model': opt.d_model, 'd_word_vec': opt.d_model, 'd_inner_hid': opt.d_model * 4,
+            'n_layers': opt.n_layers, 'n_head': opt.n_head, 'dropout': 0.1, 'scale_emb_or_prj': 'prj'})
+    set_active_layers(model, opt.enc_layers, opt.dec_layers)
+    return model.eval()
+
+
+def _startup_trial(opt, mode, artifact_dir, queue):
+    ''' Runs in a fresh process: time model loading and graph building. '''
+    from transformer.compiled.artifacts import build_steps
+
+    torch.set_num_threads(opt.threads)
+    start = time.perf_counter()
+    model = _load(opt)
+    loaded = time.perf_counter()
+    _, _, mode_used = build_steps(model, mode, artifact_dir)
+    built = time.perf_counter()
+    queue.put({'load_sec': loaded - start, 'build_sec': built - loaded, 'mode_used': mode_used})
+
+
+def measure_startup(opt, mode, artifact_dir):
+    ctx = mp.get_context('spawn')
+    results = {}
+    for phase in ('cold', 'warm'):
+        queue = ctx.Queue()
+        proc = ctx.Process(target=_startup_trial, args=(opt, mode, artifact_dir, queue))
+        proc.start()
+        results[phase] = queue.get()
+        proc.join()
+    return results
+
+
+def measure_steady_state(opt, translator, src_seqs):
+    for src_seq in src_seqs[:opt.warmup]:
+        translator.translate_sentence(src_seq)
+    start = time.perf_counter()
+    n_tokens = 0
+    for src_seq in src_seqs:
+        n_tokens += len(translator.translate_sentence(src_seq))
+    elapsed = time.perf_counter() - start
+    return {'sentences_per_sec': len(src_seqs) / elapsed, 'tokens_per_sec': n_tokens / elapsed}
+
+
+def collect_telemetry(opt, translator, src_seqs):
+    ''' Decode the sources with telemetry attached; kept apart from the timed run. '''
+    from transformer.decode_telemetry import DecodeTelemetry
+
+    translator.telemetry = DecodeTelemetry(opt.max_seq_len, device=translator.init_seq.device)
+    for src_seq in src_seqs:
+        translator.translate_sentence(src_seq)
+    telemetry, translator.telemetry = translator.telemetry, None
+    return dict(telemetry.summary(), sentences=telemetry.sentences)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark compiled encoder / decoder-step graphs')
+    parser.add_argument('-checkpoint', default=None, help='Trained checkpoint; random weights if omitted')
+    parser.add_argument('-modes', nargs='+', default=['eager', 'compile', 'export'])
+    parser.add_argument('-artifact_dir', default=None, help='Where artifacts are kept; a temp dir if omitted')
+    parser.add_argument('-n_sentences', type=int, default=50)
+    parser.add_argument('-src_len', type=int, default=12)
+    parser.add_argument('-beam_size', type=int, default=5)
+    parser.add_argument('-max_seq_len', type=int, default=32)
+    parser.add_argument('-warmup', type=int, default=3)
+    parser.add_argument('-threads', type=int, default=torch.get_num_threads())
+    parser.add_argument('-vocab_size', type=int, default=8000)
+    parser.add_argument('-d_model', type=int, default=512)
+    parser.add_argument('-n_head', type=int, default=8)
+    parser.add_argument('-n_layers', type=int, default=6)
+    parser.add_argument('-enc_layers', type=int, nargs='+', default=None,
+                        help='Run only these encoder layer indices (e.g. of a LayerDrop-trained model)')
+    parser.add_argument('-dec_layers', type=int, nargs='+', default=None,
+                        help='Run only these decoder layer indices')
+    parser.add_argument('-seed', type=int, default=1)
+    parser.add_argument('-output', default=None, help='Write the results as JSON')
+    parser.add_argument('-decode_telemetry', default=None,
+                        help='Write per-sentence / per-step decoding telemetry of every translator as JSON')
+    parser.add_argument('-runtime_config', default=None,
+                        help='Runtime config from transformer.autotune.tune; overrides -threads and -beam_size')
+    opt = parser.parse_args(argv)
+
+    if opt.runtime_config:
+        from transformer.autotune.config import apply_threads, load_runtime_config
+        config = load_runtime_config(opt.runtime_config)
+        apply_threads(config)
+        opt.threads, opt.beam_size = config['threads'], config['beam_size']
+
+    from transformer.Translator import Translator
+    from transformer.compiled.translator import CachedTranslator
+
+    torch.set_num_threads(opt.threads)
+    model = _load(opt)
+    translator_args = dict(
+        beam_size=opt.beam_size, max_seq_len=opt.max_seq_len,
+        src_pad_idx=model.src_pad_idx, trg_pad_idx=model.trg_pad_idx, trg_bos_idx=2, trg_eos_idx=3)
+    n_vocab = model.encoder.src_word_emb.num_embeddings
+    src_seqs = [torch.randint(4, n_vocab, (1, opt.src_len)) for _ in range(opt.n_sentences)]
+
+    baseline = Translator(model, **translator_args)
+    results = {
+        'settings': vars(opt),
+        'baseline': measure_steady_state(opt, baseline, src_seqs),
+        'modes': {},
+    }
+    telemetry = {}
+    if opt.decode_telemetry:
+        telemetry['baseline'] = collect_telemetry(opt, baseline, src_seqs)
+    print(f"[Info] baseline Translator: {results['baseline']['sentences_per_sec']:.2f} sent/s")
+
+    for mode in opt.modes:
+        artifact_root = opt.artifact_dir or tempfile.mkdtemp(prefix='compiled_bench_')
+        artifact_dir = os.path.join(artifact_root, mode)
+        shutil.rmtree(artifact_dir, ignore_errors=True)
+
+        startup = measure_startup(opt, mode, artifact_dir)
+        translator = CachedTranslator(model, mode=mode, artifact_dir=artifact_dir, **translator_args)
+        steady = measure_steady_state(opt, translator, src_seqs)
+        results['modes'][mode] = {'startup': startup, 'steady_state': steady, 'mode_used': translator.mode}
+        if opt.decode_telemetry:
+            telemetry[mode] = collect_telemetry(opt, translator, src_seqs)
+
+        if not opt.artifact_dir:
+            shutil.rmtree(artifact_root, ignore_errors=True)
+        print(f"[Info] {mode:8s} ({translator.mode}): "
+              f"cold start {startup['cold']['build_sec']:.2f}s, warm start {startup['warm']['build_sec']:.2f}s, "
+              f"{steady['sentences_per_sec']:.2f} sent/s")
+
+    if opt.output:
+        with open(opt.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    if opt.decode_telemetry:
+        with open(opt.decode_telemetry, 'w') as f:
+            json.dump(telemetry, f, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
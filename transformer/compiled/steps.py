@@ -0,0 +1,112 @@
+''' Encoder and single-step incremental decoder modules for low-overhead inference.
+
+Both modules share the parameters of a trained Transformer and reproduce the
+eager computation of Encoder/Decoder in eval mode. The decoder step keeps the
+self-attention keys/values of every previous position in a preallocated cache,
+so each call only runs the new token through the layer stack. All shapes are
+static for a given (batch, src_len, cache_len), which keeps them friendly to
+torch.compile and torch.export.
+'''
+import torch
+import torch.nn as nn
+from transformer.Models import Transformer, get_pad_mask, select_layers
+
+
+def _split_heads(x, n_head, d_head):
+    ''' b x l x (n*d) -> b x n x l x d '''
+    sz_b, len_x = x.size(0), x.size(1)
+    return x.view(sz_b, len_x, n_head, d_head).transpose(1, 2)
+
+
+def _attend(mha, residual, q, k, v, mask):
+    ''' The part of MultiHeadAttention.forward after the input projections. '''
+    sz_b, len_q = residual.size(0), residual.size(1)
+    output, _ = mha.attention(q, k, v, mask=mask.unsqueeze(1))
+    output = output.transpose(1, 2).contiguous().view(sz_b, len_q, -1)
+    output = mha.dropout(mha.fc(output))
+    output = output + residual
+    return mha.layer_norm(output)
+
+
+class EncoderStep(nn.Module):
+    ''' Encode a source batch and precompute the cross-attention keys/values of every active decoder layer. '''
+
+    def __init__(self, model: Transformer):
+        super().__init__()
+        self.model = model
+
+    def forward(self, src_seq):
+        model = self.model
+        src_mask = get_pad_mask(src_seq, model.src_pad_idx)
+        enc_output, *_ = model.encoder(src_seq, src_mask)
+
+        cross_k, cross_v = [], []
+        for dec_layer in select_layers(model.decoder.layer_stack, model.decoder.active_layers):
+            mha = dec_layer.enc_attn
+            cross_k.append(_split_heads(mha.w_ks(enc_output), mha.n_head, mha.d_k))
+            cross_v.append(_split_heads(mha.w_vs(enc_output), mha.n_head, mha.d_v))
+        return src_mask, tuple(cross_k), tuple(cross_v)
+
+
+class DecoderStep(nn.Module):
+    ''' Run one target token per sentence through the decoder, reusing cached keys/values.
+
+    Inputs:
+        trg_tok:   b          token fed at this step
+        pos:       b          its position (= number of tokens already cached)
+        self_k/v:  per active layer  b x n x max_len x d, filled up to pos - 1
+        cross_k/v: per active layer  b x n x len_src x d, from EncoderStep
+        src_mask:  b x 1 x len_src
+
+    Returns the next-word logits (b x n_trg_vocab) and the updated self-attention caches.
+    '''
+
+    def __init__(self, model: Transformer):
+        super().__init__()
+        self.model = model
+
+    def forward(self, trg_tok, pos, self_k, self_v, cross_k, cross_v, src_mask):
+        decoder = self.model.decoder
+
+        # -- Embedding, identical to Decoder.forward for a single position.
+        dec_output = decoder.trg_word_emb(trg_tok).unsqueeze(1)
+        if decoder.scale_emb:
+            dec_output = dec_output * decoder.d_model ** 0.5
+        dec_output = dec_output + decoder.position_enc.pos_table[0, pos].unsqueeze(1)
+        dec_output = decoder.layer_norm(decoder.dropout(dec_output))
+
+        # -- Cache slot written at this step, and the causal mask over the cache.
+        cache_pos = torch.arange(self_k[0].size(2), device=trg_tok.device).unsqueeze(0)
+        write_mask = (cache_pos == pos.unsqueeze(1))[:, None, :, None]   # b x 1 x max_len x 1
+        slf_attn_mask = (cache_pos <= pos.unsqueeze(1)).unsqueeze(1)      # b x 1 x max_len
+
+        new_k, new_v = [], []
+        for i, dec_layer in enumerate(select_layers(decoder.layer_stack, decoder.active_layers)):
+            mha = dec_layer.slf_attn
+            q = _split_heads(mha.w_qs(dec_output), mha.n_head, mha.d_k)
+            k = torch.where(write_mask, _split_heads(mha.w_ks(dec_output), mha.n_head, mha.d_k), self_k[i])
+            v = torch.where(write_mask, _split_heads(mha.w_vs(dec_output), mha.n_head, mha.d_v), self_v[i])
+            new_k.append(k)
+            new_v.append(v)
+            dec_output = _attend(mha, dec_output, q, k, v, slf_attn_mask)
+
+            mha = dec_layer.enc_attn
+            q = _split_heads(mha.w_qs(dec_output), mha.n_head, mha.d_k)
+            dec_output = _attend(mha, dec_output, q, cross_k[i], cross_v[i], src_mask)
+
+            dec_output = dec_layer.pos_ffn(dec_output)
+
+        return self.model.trg_word_prj(dec_output[:, 0]), tuple(new_k), tuple(new_v)
+
+
+def init_self_cache(model: Transformer, sz_b, max_len, device=None, dtype=None):
+    ''' Empty self-attention key/value caches for DecoderStep. '''
+    weight = model.trg_word_prj.weight
+    device = weight.device if device is None else device
+    dtype = weight.dtype if dtype is None else dtype
+    self_k, self_v = [], []
+    for dec_layer in select_layers(model.decoder.layer_stack, model.decoder.active_layers):
+        mha = dec_layer.slf_attn
+        self_k.append(torch.zeros(sz_b, mha.n_head, max_len, mha.d_k, device=device, dtype=dtype))
+        self_v.append(torch.zeros(sz_b, mha.n_head, max_len, mha.d_v, device=device, dtype=dtype))
+    return tuple(self_k), tuple(self_v)
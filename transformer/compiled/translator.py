@@ -0,0 +1,61 @@
+''' Beam search on top of the (optionally compiled) encoder / decoder-step graphs. '''
+import torch.nn.functional as F
+from transformer.Models import Transformer
+from transformer.Translator import Translator
+from transformer.compiled.artifacts import build_steps
+from transformer.compiled.steps import init_self_cache
+
+
+class CachedTranslator(Translator):
+    ''' A Translator that decodes one token per step with cached keys/values.
+
+    The search itself is inherited from Translator; only the decoding state
+    hooks are replaced. `mode` and `artifact_dir` are passed to build_steps.
+    '''
+
+    def __init__(
+            self, model: Transformer, beam_size, max_seq_len,
+            src_pad_idx, trg_pad_idx, trg_bos_idx, trg_eos_idx,
+            mode='eager', artifact_dir=None, max_len_a=None, max_len_b=0):
+
+        super().__init__(
+            model, beam_size, max_seq_len,
+            src_pad_idx, trg_pad_idx, trg_bos_idx, trg_eos_idx,
+            max_len_a=max_len_a, max_len_b=max_len_b)
+
+        self.encoder_step, self.decoder_step, self.mode = build_steps(model, mode, artifact_dir)
+
+
+    def _init_decode_state(self, src_seq, src_mask, max_len):
+        src_mask, cross_k, cross_v = self.encoder_step(src_seq)
+        self_k, self_v = init_self_cache(self.model, src_seq.size(0), max_len)
+        return self_k, self_v, cross_k, cross_v, src_mask
+
+
+    def _expand_decode_state(self, state, n_repeat):
+        return tuple(
+            tuple(t.repeat(n_repeat, *([1] * (t.dim() - 1))) for t in part) if isinstance(part, tuple)
+            else part.repeat(n_repeat, 1, 1)
+            for part in state)
+
+
+    def _reorder_decode_state(self, state, beam_idx):
+        self_k, self_v, cross_k, cross_v, src_mask = state
+        self_k = tuple(k.index_select(0, beam_idx) for k in self_k)
+        self_v = tuple(v.index_select(0, beam_idx) for v in self_v)
+        return self_k, self_v, cross_k, cross_v, src_mask
+
+
+    def _select_decode_state(self, state, row_idx):
+        return tuple(
+            tuple(t.index_select(0, row_idx) for t in part) if isinstance(part, tuple)
+            else part.index_select(0, row_idx)
+            for part in state)
+
+
+    def _step_probs(self, gen_seq, step, state):
+        self_k, self_v, cross_k, cross_v, src_mask = state
+        trg_tok = gen_seq[:, step - 1]
+        pos = trg_tok.new_full(trg_tok.size(), step - 1)
+        logits, self_k, self_v = self.decoder_step(trg_tok, pos, self_k, self_v, cross_k, cross_v, src_mask)
+        return F.softmax(logits, dim=-1), (self_k, self_v, cross_k, cross_v, src_mask)
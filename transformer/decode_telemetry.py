@@ -0,0 +1,152 @@
+''' Opt-in per-sentence beam-search instrumentation for Translator.translate_sentence.
+
+Assign a DecodeTelemetry to `translator.telemetry` to enable it. For every
+sentence it records the encoder time, the number of decode steps, the
+decoder / projection / topk time of every step, the step at which each final
+beam emitted EOS and why decoding stopped ('eos': every beam finished,
+'max_len': the length budget ran out). Records are aggregated into
+histograms and exported as JSON.
+
+With `translator.telemetry = None` (the default) the search only pays a few
+`is not None` checks per step. When enabled on CUDA every lap synchronizes the
+device, so the timings are exact but decoding is slightly slower.
+
+Backends whose decoder step also applies the output projection (e.g. the
+CachedTranslator graphs) report it under 'decoder'.
+'''
+import bisect
+import json
+import time
+from collections import Counter
+
+import torch
+
+
+STEP_PHASES = ('decoder', 'projection', 'topk')
+
+
+def _ms_edges():
+    ''' 10 us to ~10 s in factors of two. '''
+    return [0.01 * 2 ** i for i in range(21)]
+
+
+class Histogram():
+    ''' Counts over fixed upper bucket edges (plus an overflow bucket) with exact count / sum / min / max. '''
+
+    def __init__(self, edges):
+        self.edges = list(edges)
+        self.counts = [0] * (len(self.edges) + 1)
+        self.count, self.total = 0, 0.0
+        self.min = self.max = None
+
+    def add(self, value):
+        self.counts[bisect.bisect_left(self.edges, value)] += 1
+        self.count += 1
+        self.total += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+    def quantile(self, q):
+        ''' Upper edge of the bucket holding the q-quantile (the max for the overflow bucket). '''
+        if self.count == 0:
+            return None
+        rank, seen = q * self.count, 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if seen >= rank and n:
+                return self.edges[i] if i < len(self.edges) else self.max
+        return self.max
+
+    def to_dict(self):
+        return {
+            'count': self.count,
+            'mean': self.total / self.count if self.count else None,
+            'min': self.min, 'max': self.max,
+            'p50': self.quantile(0.5), 'p90': self.quantile(0.9), 'p99': self.quantile(0.99),
+            'edges': self.edges, 'counts': self.counts,
+        }
+
+
+class DecodeTelemetry():
+    ''' Collect per-sentence decoding records and their histograms. '''
+
+    def __init__(self, max_seq_len, device=None, keep_sentences=True):
+        step_edges = list(range(1, max_seq_len + 1))
+        self.sync_cuda = device is not None and torch.device(device).type == 'cuda'
+        self.keep_sentences = keep_sentences
+        self.sentences = []
+        self.stop_reasons = Counter()
+        self._record = None
+        self.histograms = {
+            'sentence_ms': Histogram(_ms_edges()),
+            'encoder_ms': Histogram(_ms_edges()),
+            'n_steps': Histogram(step_edges),
+            'beam_finish_step': Histogram(step_edges),
+        }
+        for phase in STEP_PHASES:
+            self.histograms[f'step_{phase}_ms'] = Histogram(_ms_edges())
+
+    def _now(self):
+        if self.sync_cuda:
+            torch.cuda.synchronize()
+        return time.perf_counter()
+
+    # -- called by the Translator
+
+    def start_sentence(self, src_len, max_len):
+        self._record = {
+            'src_len': src_len, 'max_len': max_len, 'encoder_ms': 0.0,
+            **{f'{phase}_ms': [] for phase in STEP_PHASES}}
+        self._step = dict.fromkeys(STEP_PHASES, 0.0)
+        self._start = self._mark = self._now()
+
+    def lap(self, phase):
+        ''' Charge the time since the previous lap to `phase` ('encoder' or one of STEP_PHASES).
+        Outside start_sentence / end_sentence (e.g. batched greedy decoding) it does nothing. '''
+        if self._record is None:
+            return
+        now = self._now()
+        elapsed_ms = 1e3 * (now - self._mark)
+        self._mark = now
+        if phase == 'encoder':
+            self._record['encoder_ms'] += elapsed_ms
+        else:
+            self._step[phase] += elapsed_ms
+
+    def end_step(self):
+        for phase, elapsed_ms in self._step.items():
+            self._record[f'{phase}_ms'].append(elapsed_ms)
+            self.histograms[f'step_{phase}_ms'].add(elapsed_ms)
+        self._step = dict.fromkeys(STEP_PHASES, 0.0)
+
+    def end_sentence(self, stop_reason, beam_finish_steps):
+        ''' beam_finish_steps: per final beam, the step that emitted EOS (None if it never did). '''
+        record = self._record
+        record['total_ms'] = 1e3 * (self._now() - self._start)
+        record['n_steps'] = len(record['decoder_ms'])
+        record['stop_reason'] = stop_reason
+        record['beam_finish_steps'] = beam_finish_steps
+
+        self.stop_reasons[stop_reason] += 1
+        self.histograms['sentence_ms'].add(record['total_ms'])
+        self.histograms['encoder_ms'].add(record['encoder_ms'])
+        self.histograms['n_steps'].add(record['n_steps'])
+        for step in beam_finish_steps:
+            if step is not None:
+                self.histograms['beam_finish_step'].add(step)
+        if self.keep_sentences:
+            self.sentences.append(record)
+        self._record = None
+
+    # -- reporting
+
+    def summary(self):
+        return {
+            'n_sentences': sum(self.stop_reasons.values()),
+            'stop_reasons': dict(self.stop_reasons),
+            'histograms': {name: hist.to_dict() for name, hist in self.histograms.items()},
+        }
+
+    def save(self, path):
+        with open(path, 'w') as f:
+            json.dump(dict(self.summary(), sentences=self.sentences), f, indent=2)
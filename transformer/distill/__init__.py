@@ -0,0 +1,7 @@
+from .corpus import build_distilled_data
+from .teacher import decode_training_set
+
+__all__ = [
+    'build_distilled_data',
+    'decode_training_set',
+]
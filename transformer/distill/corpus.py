@@ -0,0 +1,70 @@
+''' Merge the teacher shards into a distilled dataset in the preprocess_modern.py format.
+
+Usage:
+    python -m transformer.distill.corpus -data_pkl m30k.pkl -work_dir distill -save m30k_distill.pkl
+
+The training targets are replaced by the teacher translations (wrapped in
+BOS / EOS like preprocess_modern.py does); vocabularies, settings and the
+validation set are kept, so models trained on either file are comparable.
+'''
+import argparse
+import pickle
+
+import transformer.Constants as Constants
+from transformer.bleu.metric import strip_specials
+from transformer.distill.teacher import load_meta, n_shards, pending_shards, shard_path
+
+
+def build_distilled_data(data, work_dir, shard_size, keep_original=False):
+    ''' Returns (distilled data dict, number of dropped pairs). '''
+    train_src = data['train']['src']
+    missing = pending_shards(work_dir, n_shards(len(train_src), shard_size))
+    if missing:
+        raise RuntimeError(f'{len(missing)} teacher shards are missing (e.g. {missing[:5]}); finish decoding first')
+
+    trg_vocab = data['vocab']['trg']
+    bos, eos = trg_vocab.stoi[Constants.BOS_WORD], trg_vocab.stoi[Constants.EOS_WORD]
+    specials = {'bos': bos, 'eos': eos, 'pad': trg_vocab.stoi[Constants.PAD_WORD]}
+
+    src_insts, trg_insts = [], []
+    if keep_original:
+        src_insts += train_src
+        trg_insts += data['train']['trg']
+
+    n_dropped = 0
+    for index in range(n_shards(len(train_src), shard_size)):
+        with open(shard_path(work_dir, index), 'rb') as f:
+            shard = pickle.load(f)
+        for offset, hyp in enumerate(shard['hyps']):
+            tokens = strip_specials(hyp, specials)
+            if not tokens:
+                n_dropped += 1
+                continue
+            src_insts.append(train_src[shard['begin'] + offset])
+            trg_insts.append([bos] + tokens + [eos])
+
+    distilled = dict(data, train={'src': src_insts, 'trg': trg_insts})
+    return distilled, n_dropped
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Build a distilled dataset from teacher shards')
+    parser.add_argument('-data_pkl', required=True)
+    parser.add_argument('-work_dir', required=True)
+    parser.add_argument('-save', required=True)
+    parser.add_argument('-keep_original', action='store_true', help='Train on original + distilled pairs')
+    opt = parser.parse_args(argv)
+
+    with open(opt.data_pkl, 'rb') as f:
+        data = pickle.load(f)
+    shard_size = load_meta(opt.work_dir)['shard_size']
+    distilled, n_dropped = build_distilled_data(data, opt.work_dir, shard_size, opt.keep_original)
+    with open(opt.save, 'wb') as f:
+        pickle.dump(distilled, f)
+    print(f"[Info] {len(distilled['train']['src'])} training pairs saved to {opt.save} "
+          f"({n_dropped} empty teacher outputs dropped)")
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,59 @@
+''' Sequence-level knowledge distillation end to end: teacher decoding, distilled
+dataset, student training.
+
+Usage:
+    python -m transformer.distill.pipeline -model output/model.chkpt -data_pkl m30k.pkl \
+        -work_dir distill -save_data m30k_distill.pkl -n_procs 4 \
+        -- -n_layers 3 -d_model 256 -d_inner_hid 1024 -output_dir output_student
+
+Arguments after `--` are passed to train_modern.py, together with
+-data_pkl <save_data>. Every step is resumable: finished teacher shards are
+skipped, and a student run can be continued with train_modern's -checkpoint.
+'''
+import argparse
+import os
+import pickle
+import subprocess
+import sys
+
+from transformer.distill.corpus import build_distilled_data
+from transformer.distill.teacher import add_decode_args, decode_training_set
+
+
+TRAIN_SCRIPT = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))), 'train_modern.py')
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    train_args = []
+    if '--' in argv:
+        split = argv.index('--')
+        argv, train_args = argv[:split], argv[split + 1:]
+
+    parser = argparse.ArgumentParser(description='Distill a teacher into a smaller student (args after -- go to train_modern.py)')
+    add_decode_args(parser)
+    parser.add_argument('-save_data', required=True, help='Distilled dataset (preprocessed pkl format)')
+    parser.add_argument('-keep_original', action='store_true', help='Train on original + distilled pairs')
+    parser.add_argument('-skip_train', action='store_true', help='Stop after writing the distilled dataset')
+    opt = parser.parse_args(argv)
+
+    print('[Info] Decoding the training sources with the teacher...')
+    decode_training_set(vars(opt))
+
+    with open(opt.data_pkl, 'rb') as f:
+        data = pickle.load(f)
+    distilled, n_dropped = build_distilled_data(data, opt.work_dir, opt.shard_size, opt.keep_original)
+    with open(opt.save_data, 'wb') as f:
+        pickle.dump(distilled, f)
+    print(f"[Info] {len(distilled['train']['src'])} training pairs saved to {opt.save_data} "
+          f"({n_dropped} empty teacher outputs dropped)")
+    del data, distilled
+
+    if opt.skip_train:
+        return 0
+    print('[Info] Training the student...')
+    return subprocess.run([sys.executable, TRAIN_SCRIPT, '-data_pkl', opt.save_data] + train_args).returncode
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
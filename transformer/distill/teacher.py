@@ -0,0 +1,155 @@
+''' Sharded, resumable re-translation of the training sources by a teacher model.
+
+Usage:
+    python -m transformer.distill.teacher -model output/model.chkpt -data_pkl m30k.pkl -work_dir distill -n_procs 4
+
+The training sources are cut into shards of -shard_size sentences. Each of the
+-n_procs spawned processes decodes the shards i with i % n_procs == rank in
+length-sorted batches (Translator.translate_corpus) and writes every finished
+shard atomically as shard_XXXXX.pkl. Rerunning the same command skips the
+finished shards, so an interrupted run resumes where it stopped. meta.json
+pins the settings a work_dir was started with. A -runtime_config from
+transformer.autotune.tune sets the process count (its workers), the thread
+pools, batch / beam size and decoding.
+'''
+import argparse
+import json
+import multiprocessing as mp
+import os
+import pickle
+
+import torch
+from transformer.autotune.config import load_runtime_config
+
+
+DECODE_KEYS = ('model', 'data_pkl', 'shard_size', 'decoding', 'beam_size', 'max_seq_len', 'max_len_a', 'max_len_b')
+
+
+def shard_path(work_dir, index):
+    return os.path.join(work_dir, f'shard_{index:05d}.pkl')
+
+
+def n_shards(n_sentences, shard_size):
+    return (n_sentences + shard_size - 1) // shard_size
+
+
+def pending_shards(work_dir, total):
+    return [i for i in range(total) if not os.path.exists(shard_path(work_dir, i))]
+
+
+def _decode_worker(settings, rank, shards):
+    from transformer.checkpoint import build_translator, load_model
+
+    torch.set_num_threads(settings['threads'])
+    if settings['interop_threads'] > 0:
+        torch.set_num_interop_threads(settings['interop_threads'])
+    with open(settings['data_pkl'], 'rb') as f:
+        data = pickle.load(f)
+    src_insts = data['train']['src']
+    trg_vocab = data['vocab']['trg']
+    del data
+
+    devices = settings['devices']
+    model, _, _ = load_model(settings['model'], devices[rank % len(devices)])
+    translator = build_translator(
+        model.eval(), trg_vocab, settings['beam_size'], settings['max_seq_len'],
+        max_len_a=settings['max_len_a'], max_len_b=settings['max_len_b'])
+
+    shard_size = settings['shard_size']
+    for index in shards:
+        begin = index * shard_size
+        hyps = translator.translate_corpus(
+            src_insts[begin:begin + shard_size], settings['batch_size'], settings['decoding'])
+        path = shard_path(settings['work_dir'], index)
+        with open(path + '.tmp', 'wb') as f:
+            pickle.dump({'begin': begin, 'hyps': hyps}, f)
+        os.replace(path + '.tmp', path)
+        print(f'    - [Info] worker {rank}: shard {index} done '
+              f"({translator.corpus_stats['dedupe_ratio']:.1%} duplicate sources)")
+
+
+def load_meta(work_dir):
+    ''' The decoding settings a work_dir was started with. '''
+    with open(os.path.join(work_dir, 'meta.json')) as f:
+        return json.load(f)
+
+
+def apply_runtime_config(settings):
+    ''' Override the process layout and decoding settings with a tuned runtime config, if one is given. '''
+    if not settings.get('runtime_config'):
+        return settings
+    config = load_runtime_config(settings['runtime_config'])
+    return dict(
+        settings, n_procs=config['workers'], threads=config['threads'],
+        interop_threads=config['interop_threads'], batch_size=config['batch_size'],
+        beam_size=config['beam_size'], decoding=config['decoding'])
+
+
+def decode_training_set(settings):
+    ''' Decode every pending shard with settings['n_procs'] processes; returns the number of shards. '''
+    settings = apply_runtime_config(settings)
+    os.makedirs(settings['work_dir'], exist_ok=True)
+    meta_path = os.path.join(settings['work_dir'], 'meta.json')
+    meta = {key: settings[key] for key in DECODE_KEYS}
+    if os.path.exists(meta_path):
+        started_with = load_meta(settings['work_dir'])
+        if started_with != meta:
+            raise ValueError(f'{settings["work_dir"]} was started with different settings: {started_with}')
+    else:
+        with open(meta_path, 'w') as f:
+            json.dump(meta, f, indent=2)
+
+    with open(settings['data_pkl'], 'rb') as f:
+        total = n_shards(len(pickle.load(f)['train']['src']), settings['shard_size'])
+    pending = pending_shards(settings['work_dir'], total)
+    print(f'[Info] {total - len(pending)}/{total} shards already decoded')
+    if not pending:
+        return total
+
+    ctx = mp.get_context('spawn')
+    n_procs = min(settings['n_procs'], len(pending))
+    procs = [
+        ctx.Process(target=_decode_worker, args=(settings, rank, pending[rank::n_procs]))
+        for rank in range(n_procs)]
+    for proc in procs:
+        proc.start()
+    for proc in procs:
+        proc.join()
+
+    missing = pending_shards(settings['work_dir'], total)
+    if missing:
+        raise RuntimeError(f'{len(missing)} shards failed (e.g. {missing[:5]}); rerun to resume')
+    return total
+
+
+def add_decode_args(parser):
+    parser.add_argument('-model', required=True, help='Teacher checkpoint or fastload export directory')
+    parser.add_argument('-data_pkl', required=True)
+    parser.add_argument('-work_dir', required=True, help='Shards and meta.json; reuse it to resume')
+    parser.add_argument('-n_procs', type=int, default=1)
+    parser.add_argument('-devices', nargs='+', default=['cpu'], help='Assigned to the processes round-robin')
+    parser.add_argument('-threads', type=int, default=1, help='torch threads per process')
+    parser.add_argument('-interop_threads', type=int, default=0, help='torch inter-op threads per process (0: default)')
+    parser.add_argument('-shard_size', type=int, default=2000)
+    parser.add_argument('-batch_size', type=int, default=64)
+    parser.add_argument('-decoding', choices=['beam', 'greedy'], default='beam')
+    parser.add_argument('-beam_size', type=int, default=5)
+    parser.add_argument('-max_seq_len', type=int, default=100)
+    parser.add_argument('-max_len_a', type=float, default=None,
+                        help='Per-sentence output budget max_len_a * src_len + max_len_b (default: max_seq_len)')
+    parser.add_argument('-max_len_b', type=int, default=10)
+    parser.add_argument('-runtime_config', default=None,
+                        help='Runtime config from transformer.autotune.tune (CPU decoding); overrides -n_procs '
+                             '(its workers), -threads, -interop_threads, batch / beam size and decoding')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Re-translate the training sources with a teacher model')
+    add_decode_args(parser)
+    opt = parser.parse_args(argv)
+    decode_training_set(vars(opt))
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,6 @@
+from .quality import evaluate, pair_batches
+
+__all__ = [
+    'evaluate',
+    'pair_batches',
+]
@@ -0,0 +1,52 @@
+''' Validation-subset quality and speed of a model, shared by the model-compression tools. '''
+import math
+import time
+
+import torch
+import torch.nn.functional as F
+import transformer.Constants as Constants
+from transformer.SubLayers import MultiHeadAttention
+from transformer.bleu.metric import corpus_bleu, strip_specials
+from transformer.checkpoint import build_translator
+from transformer.modern_data import collate_fn
+
+
+def pair_batches(src_insts, trg_insts, batch_size, src_pad_idx, trg_pad_idx):
+    ''' Padded (src_seq, trg_seq) batches of consecutive sentence pairs. '''
+    pairs = list(zip(src_insts, trg_insts))
+    return [
+        collate_fn(pairs[begin:begin + batch_size], src_pad_idx, trg_pad_idx)
+        for begin in range(0, len(pairs), batch_size)]
+
+
+def evaluate(model, trg_vocab, src_insts, trg_insts, device,
+             batch_size=64, decoding='greedy', beam_size=5, max_seq_len=100):
+    ''' Teacher-forced loss, BLEU and decoding speed of a model on a validation subset. '''
+    specials = {
+        'bos': trg_vocab.stoi[Constants.BOS_WORD],
+        'eos': trg_vocab.stoi[Constants.EOS_WORD],
+        'pad': trg_vocab.stoi[Constants.PAD_WORD],
+    }
+    total_loss, n_word = 0.0, 0
+    with torch.no_grad():
+        for src_seq, trg_seq in pair_batches(src_insts, trg_insts, batch_size, model.src_pad_idx, model.trg_pad_idx):
+            src_seq, trg_seq = src_seq.to(device), trg_seq.to(device)
+            gold = trg_seq[:, 1:].contiguous().view(-1)
+            pred = model(src_seq, trg_seq[:, :-1])
+            total_loss += F.cross_entropy(pred, gold, ignore_index=model.trg_pad_idx, reduction='sum').item()
+            n_word += gold.ne(model.trg_pad_idx).sum().item()
+
+    translator = build_translator(model, trg_vocab, beam_size, max_seq_len)
+    translator.translate_corpus(src_insts[:batch_size], batch_size, decoding)   # warm-up
+    start = time.perf_counter()
+    hyps = translator.translate_corpus(src_insts, batch_size, decoding)
+    elapsed = time.perf_counter() - start
+
+    refs = [strip_specials(seq, specials) for seq in trg_insts]
+    return {
+        'n_heads': sum(m.n_head for m in model.modules() if isinstance(m, MultiHeadAttention)),
+        'n_params': sum(p.numel() for p in model.parameters()),
+        'valid_ppl': math.exp(min(total_loss / n_word, 100)),
+        'bleu': corpus_bleu([strip_specials(seq, specials) for seq in hyps], refs),
+        'sentences_per_sec': len(src_insts) / elapsed,
+    }
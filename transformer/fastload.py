@@ -0,0 +1,159 @@
+''' Memory-mappable inference export of a trained model.
+
+An export directory holds two files:
+
+    weights.bin   8-byte little-endian header length, a JSON header (model
+                  config, per-tensor dtype / shape / offset, tied-weight map)
+                  and the raw tensor bytes, each aligned to ALIGNMENT bytes
+    vocab.npz     every vocabulary as one UTF-8 byte array plus int64 offsets
+
+Loading maps weights.bin with torch.from_file(shared=False): no unpickling, no
+copy, and processes serving the same export share the weights through the
+page cache. The model is built on the meta device and the mapped tensors are
+assigned into it.
+
+    python -m transformer.fastload -checkpoint output/model.chkpt -save_dir output/model_export
+'''
+import argparse
+import json
+import os
+import struct
+
+import numpy as np
+import torch
+from transformer.averaging import tied_groups
+from transformer.checkpoint import build_model, model_config
+from transformer.modern_data import Vocabulary
+
+
+FORMAT_VERSION = 1
+ALIGNMENT = 64
+WEIGHTS_FILE = 'weights.bin'
+VOCAB_FILE = 'vocab.npz'
+
+
+def _aligned(n):
+    return (n + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def save_weights(path, state_dict, config):
+    ''' Write state_dict as one flat file; aliased entries are stored once and recorded in `tied`. '''
+    tensors, tied = {}, tied_groups(state_dict)
+    offset = 0
+    for name, tensor in state_dict.items():
+        if name in tied:
+            continue
+        nbytes = tensor.numel() * tensor.element_size()
+        tensors[name] = {
+            'dtype': str(tensor.dtype).replace('torch.', ''),
+            'shape': list(tensor.shape),
+            'offset': offset,
+            'nbytes': nbytes,
+        }
+        offset = _aligned(offset + nbytes)
+
+    header = json.dumps({
+        'version': FORMAT_VERSION,
+        'config': config,
+        'tensors': tensors,
+        'tied': tied,
+    }).encode('utf-8')
+    data_start = _aligned(8 + len(header))
+
+    with open(path, 'wb') as f:
+        f.write(struct.pack('<Q', len(header)))
+        f.write(header)
+        for name, meta in tensors.items():
+            f.write(b'\0' * (data_start + meta['offset'] - f.tell()))
+            tensor = state_dict[name].detach().cpu().contiguous()
+            f.write(tensor.reshape(-1).view(torch.uint8).numpy().tobytes())
+
+
+def load_weights(path):
+    ''' Returns (state_dict of tensors mapped from `path`, config, tied map). '''
+    with open(path, 'rb') as f:
+        header_len, = struct.unpack('<Q', f.read(8))
+        header = json.loads(f.read(header_len).decode('utf-8'))
+    if header['version'] != FORMAT_VERSION:
+        raise ValueError(f'{path}: unsupported format version {header["version"]}')
+
+    data_start = _aligned(8 + header_len)
+    buffer = torch.from_file(path, shared=False, size=os.path.getsize(path), dtype=torch.uint8)
+    state_dict = {}
+    for name, meta in header['tensors'].items():
+        start = data_start + meta['offset']
+        raw = buffer[start:start + meta['nbytes']]
+        state_dict[name] = raw.view(getattr(torch, meta['dtype'])).view(meta['shape'])
+    for alias, source in header['tied'].items():
+        state_dict[alias] = state_dict[source]
+    return state_dict, header['config'], header['tied']
+
+
+def save_vocab(path, vocab):
+    ''' vocab: {'src': Vocabulary, 'trg': Vocabulary}; a shared vocabulary is stored once. '''
+    arrays = {}
+    names = ['src'] if vocab['src'] is vocab['trg'] else ['src', 'trg']
+    for name in names:
+        encoded = [tok.encode('utf-8') for tok in vocab[name].itos]
+        arrays[f'{name}_bytes'] = np.frombuffer(b''.join(encoded), dtype=np.uint8)
+        arrays[f'{name}_offsets'] = np.cumsum([0] + [len(tok) for tok in encoded], dtype=np.int64)
+    np.savez(path, **arrays)
+
+
+def load_vocab(path):
+    vocab = {}
+    with np.load(path, allow_pickle=False) as arrays:
+        for name in ('src', 'trg'):
+            if f'{name}_bytes' not in arrays:
+                continue
+            data, offsets = arrays[f'{name}_bytes'].tobytes(), arrays[f'{name}_offsets'].tolist()
+            itos = [data[offsets[i]:offsets[i + 1]].decode('utf-8') for i in range(len(offsets) - 1)]
+            vocab[name] = Vocabulary({tok: i for i, tok in enumerate(itos)}, itos)
+    vocab.setdefault('trg', vocab['src'])
+    return vocab
+
+
+def export_model(save_dir, state_dict, config, vocab=None):
+    os.makedirs(save_dir, exist_ok=True)
+    save_weights(os.path.join(save_dir, WEIGHTS_FILE), state_dict, config)
+    if vocab is not None:
+        save_vocab(os.path.join(save_dir, VOCAB_FILE), vocab)
+
+
+def _retie(model, tied):
+    ''' Make aliased entries share one Parameter again, as Transformer.__init__ does. '''
+    for alias, source in tied.items():
+        src_module, _, src_attr = source.rpartition('.')
+        dst_module, _, dst_attr = alias.rpartition('.')
+        setattr(model.get_submodule(dst_module), dst_attr,
+                getattr(model.get_submodule(src_module), src_attr))
+
+
+def load_exported(save_dir, device='cpu'):
+    ''' Same contract as transformer.checkpoint.load_model: returns (model, config, vocab). '''
+    state_dict, config, tied = load_weights(os.path.join(save_dir, WEIGHTS_FILE))
+    with torch.device('meta'):
+        model = build_model(config, 'meta')
+    model.load_state_dict(state_dict, assign=True)
+    _retie(model, tied)
+    model = model.to(device)
+
+    vocab_path = os.path.join(save_dir, VOCAB_FILE)
+    vocab = load_vocab(vocab_path) if os.path.exists(vocab_path) else None
+    return model, config, vocab
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Export a training checkpoint to the mmap-able inference format')
+    parser.add_argument('-checkpoint', required=True)
+    parser.add_argument('-save_dir', required=True)
+    opt = parser.parse_args(argv)
+
+    checkpoint = torch.load(opt.checkpoint, map_location='cpu', mmap=True, weights_only=False)
+    export_model(opt.save_dir, checkpoint['model'], model_config(checkpoint['settings']), checkpoint.get('vocab'))
+    print(f'[Info] Inference export written to {opt.save_dir}')
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
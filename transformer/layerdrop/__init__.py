@@ -0,0 +1,5 @@
+from .depth import sweep_depths
+
+__all__ = [
+    'sweep_depths',
+]
@@ -0,0 +1,77 @@
+''' Sweep reduced-depth inference of one trained model to pick a latency / quality point.
+
+Usage:
+    python -m transformer.layerdrop.depth -model output/model.chkpt -data_pkl m30k.pkl -enc_keep 6 4 3 -dec_keep 6 3 2 1
+
+Every (encoder, decoder) depth pair runs evenly spaced layers of the stacks
+(evenly_spaced_layers, always including the top layer) through
+set_active_layers; no weights are changed. Models trained with -layerdrop
+degrade gracefully under this; others usually do not. The layer indices of
+every point are reported so they can be passed to -enc_layers / -dec_layers
+of the inference tools.
+'''
+import argparse
+import json
+import pickle
+
+import torch
+from transformer.Models import evenly_spaced_layers, set_active_layers
+from transformer.checkpoint import load_model
+from transformer.evaluation.quality import evaluate
+
+
+def sweep_depths(model, trg_vocab, src_insts, trg_insts, device, enc_keep=None, dec_keep=None, **eval_kwargs):
+    ''' evaluate() for every (encoder, decoder) depth pair (default: full depth); the model runs all layers afterwards. '''
+    n_enc, n_dec = len(model.encoder.layer_stack), len(model.decoder.layer_stack)
+    results = []
+    for n_enc_keep in enc_keep or [n_enc]:
+        for n_dec_keep in dec_keep or [n_dec]:
+            enc_layers, dec_layers = evenly_spaced_layers(n_enc, n_enc_keep), evenly_spaced_layers(n_dec, n_dec_keep)
+            set_active_layers(model, enc_layers, dec_layers)
+            r = evaluate(model, trg_vocab, src_insts, trg_insts, device, **eval_kwargs)
+            results.append(dict(r, enc_layers=enc_layers, dec_layers=dec_layers))
+    set_active_layers(model)
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Evaluate a model with fewer encoder / decoder layers')
+    parser.add_argument('-model', required=True, help='Checkpoint or fastload export directory')
+    parser.add_argument('-data_pkl', required=True)
+    parser.add_argument('-enc_keep', type=int, nargs='+', default=None, help='Encoder depths (default: full)')
+    parser.add_argument('-dec_keep', type=int, nargs='+', default=None, help='Decoder depths (default: full)')
+    parser.add_argument('-n_sentences', type=int, default=500)
+    parser.add_argument('-batch_size', type=int, default=64)
+    parser.add_argument('-decoding', choices=['beam', 'greedy'], default='greedy')
+    parser.add_argument('-beam_size', type=int, default=5)
+    parser.add_argument('-max_seq_len', type=int, default=100)
+    parser.add_argument('-no_cuda', action='store_true')
+    parser.add_argument('-output', default=None, help='Write the results as JSON')
+    opt = parser.parse_args(argv)
+
+    device = torch.device('cuda' if torch.cuda.is_available() and not opt.no_cuda else 'cpu')
+    model, _, vocab = load_model(opt.model, device)
+    model.eval()
+    with open(opt.data_pkl, 'rb') as f:
+        data = pickle.load(f)
+    vocab = vocab or data['vocab']
+    src_insts = data['valid']['src'][:opt.n_sentences]
+    trg_insts = data['valid']['trg'][:opt.n_sentences]
+    del data
+
+    results = sweep_depths(
+        model, vocab['trg'], src_insts, trg_insts, device, opt.enc_keep, opt.dec_keep,
+        batch_size=opt.batch_size, decoding=opt.decoding, beam_size=opt.beam_size, max_seq_len=opt.max_seq_len)
+    print(f"  {'enc':>3s} {'dec':>3s} {'ppl':>8s} {'BLEU':>6s} {'sent/s':>8s}")
+    for r in results:
+        print(f"  {len(r['enc_layers']):3d} {len(r['dec_layers']):3d} {r['valid_ppl']:8.3f} "
+              f"{r['bleu']:6.2f} {r['sentences_per_sec']:8.2f}")
+
+    if opt.output:
+        with open(opt.output, 'w') as f:
+            json.dump({'settings': vars(opt), 'results': results}, f, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
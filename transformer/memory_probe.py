@@ -0,0 +1,122 @@
+''' Find the largest -max_tokens a training run can use without running out of memory.
+
+Every trial builds the model and its Adam optimizer in a freshly spawned
+process and runs two forward / backward / optimizer steps on a synthetic
+worst-case batch: rows x longest sentence of the corpus, all real tokens,
+rows = max_tokens // longest. The TokenBatchSampler never builds a batch with
+more padded tokens than max_tokens, and memory per token grows with the
+sentence length (attention), so this batch bounds every batch of the run.
+The trials run with LayerDrop disabled for the same reason: a training step
+may keep every layer.
+
+Peak memory is the process's peak RSS on CPU and the peak allocated memory on
+CUDA. A budget is safe when its peak stays below (1 - safety_margin) of the
+memory limit; the rows are doubled until a trial is unsafe or fails, then
+bisected.
+'''
+import multiprocessing as mp
+import os
+
+import torch
+from transformer.checkpoint import build_model
+from transformer.telemetry import peak_rss_mb
+
+
+def memory_limit_mb(device):
+    ''' Total memory of a CUDA device, or the RAM currently available on CPU. '''
+    if torch.device(device).type == 'cuda':
+        return torch.cuda.get_device_properties(torch.device(device)).total_memory / 2 ** 20
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return os.sysconf('SC_PHYS_PAGES') * os.sysconf('SC_PAGE_SIZE') / 2 ** 20
+
+
+def _trial(settings, rows, results):
+    ''' Runs in a fresh process, so ru_maxrss only reflects this trial. '''
+    device = torch.device(settings['device'])
+    config, longest = settings['config'], settings['longest']
+    torch.manual_seed(1)
+    model = build_model(config, device)
+    if settings['attn_q_chunk'] > 0:
+        from transformer.Modules import set_attention_chunking
+        set_attention_chunking(model, settings['attn_q_chunk'], settings['attn_k_chunk'])
+    optimizer = torch.optim.Adam(model.parameters(), betas=(0.9, 0.98), eps=1e-09)
+
+    # -- 4 is the first non-special token id of a preprocess_modern.py vocabulary
+    src_seq = torch.randint(4, config['src_vocab_size'], (rows, longest), device=device)
+    trg_seq = torch.randint(4, config['trg_vocab_size'], (rows, longest), device=device)
+    gold = trg_seq[:, 1:].contiguous().view(-1)
+
+    if device.type == 'cuda':
+        torch.cuda.reset_peak_memory_stats(device)
+    for _ in range(2):   # Adam allocates its state on the first step
+        optimizer.zero_grad()
+        loss = settings['loss_fn'](model(src_seq, trg_seq[:, :-1]), gold)
+        loss.backward()
+        optimizer.step()
+    if device.type == 'cuda':
+        peak_mb = torch.cuda.max_memory_allocated(device) / 2 ** 20
+    else:
+        peak_mb = peak_rss_mb()
+    results.put(peak_mb)
+
+
+def measure_peak_mb(settings, rows):
+    ''' Peak memory of a training step on `rows` worst-case rows; None if the trial failed (e.g. OOM). '''
+    ctx = mp.get_context('spawn')
+    results = ctx.Queue()
+    proc = ctx.Process(target=_trial, args=(settings, rows, results))
+    proc.start()
+    proc.join()
+    if proc.exitcode != 0 or results.empty():
+        return None
+    return results.get()
+
+
+def find_max_tokens(config, lengths, loss_fn, device='cpu', safety_margin=0.15, limit_mb=0,
+                    attn_q_chunk=0, attn_k_chunk=0, max_rows=None):
+    ''' Largest safe token budget (a multiple of the longest sentence length).
+
+    lengths: per training pair, the length of its longer side (as TokenBatchSampler counts it).
+    loss_fn(pred, gold): the training loss; must be picklable (a module-level function or a partial of one).
+    '''
+    longest = max(lengths)
+    max_rows = max_rows or len(lengths)
+    budget_mb = (1 - safety_margin) * (limit_mb or memory_limit_mb(device))
+    # -- LayerDrop would skip random layers in the trials; a real step may run them all
+    settings = {
+        'config': dict(config, layerdrop=0.0), 'longest': longest, 'loss_fn': loss_fn, 'device': str(device),
+        'attn_q_chunk': attn_q_chunk, 'attn_k_chunk': attn_k_chunk}
+    print(f'[Info] Probing max tokens: longest sentence {longest}, memory budget {budget_mb:.0f} MB')
+
+    def is_safe(rows):
+        peak_mb = measure_peak_mb(settings, rows)
+        safe = peak_mb is not None and peak_mb <= budget_mb
+        peak = 'failed' if peak_mb is None else f'{peak_mb:.0f} MB'
+        print(f'    - {rows:6d} rows ({rows * longest:8d} tokens): peak {peak} -> {"safe" if safe else "unsafe"}')
+        return safe
+
+    safe_rows, unsafe_rows = 0, None
+    rows = 1
+    while rows <= max_rows:
+        if not is_safe(rows):
+            unsafe_rows = rows
+            break
+        safe_rows, rows = rows, rows * 2
+    if unsafe_rows is None:
+        unsafe_rows = max_rows + 1
+    while unsafe_rows - safe_rows > max(1, safe_rows // 16):   # stop within ~6% of the boundary
+        rows = (safe_rows + unsafe_rows) // 2
+        if is_safe(rows):
+            safe_rows = rows
+        else:
+            unsafe_rows = rows
+
+    if safe_rows == 0:
+        raise RuntimeError(f'A single row of {longest} tokens exceeds the memory budget of {budget_mb:.0f} MB')
+    return safe_rows * longest
@@ -1,5 +1,7 @@
+import random
+
 import torch
-from torch.utils.data import Dataset
+from torch.utils.data import Dataset, Sampler
 
 class TransformerDataset(Dataset):
     def __init__(self, src_insts, trg_insts):
@@ -13,6 +15,51 @@ class TransformerDataset(Dataset):
     def __getitem__(self, idx):
         return self.src_insts[idx], self.trg_insts[idx]
 
+class TokenBatchSampler(Sampler):
+    ''' Batches of indices whose padded size, rows x longest pair, stays within max_tokens.
+
+    lengths[i] is the length of the longer side of pair i. Pairs are sorted by
+    length (ties in random order when shuffling) and cut greedily into batches;
+    with shuffle the batch order is drawn anew every epoch. A pair longer than
+    max_tokens forms a batch of its own.
+    '''
+
+    def __init__(self, lengths, max_tokens, shuffle=False, seed=0):
+        self.lengths = lengths
+        self.max_tokens = max_tokens
+        self.shuffle = shuffle
+        self.rng = random.Random(seed)
+        self.n_batches = len(self._batches(sorted(range(len(lengths)), key=lengths.__getitem__)))
+
+    def _batches(self, order):
+        batches, batch, longest = [], [], 0
+        for i in order:
+            if batch and max(longest, self.lengths[i]) * (len(batch) + 1) > self.max_tokens:
+                batches.append(batch)
+                batch, longest = [], 0
+            batch.append(i)
+            longest = max(longest, self.lengths[i])
+        if batch:
+            batches.append(batch)
+        return batches
+
+    def __iter__(self):
+        order = list(range(len(self.lengths)))
+        if self.shuffle:
+            self.rng.shuffle(order)
+        order.sort(key=self.lengths.__getitem__)   # stable: ties keep the shuffled order
+        batches = self._batches(order)
+        if self.shuffle:
+            self.rng.shuffle(batches)
+        return iter(batches)
+
+    def __len__(self):
+        return self.n_batches
+
+def pair_lengths(src_insts, trg_insts):
+    ''' Per pair, the length of its longer side: the unit of TokenBatchSampler and the max-tokens probe. '''
+    return [max(len(s), len(t)) for s, t in zip(src_insts, trg_insts)]
+
 def collate_fn(insts, src_pad_idx, trg_pad_idx):
     src_insts, trg_insts = list(zip(*insts))
     
@@ -25,6 +72,57 @@ def collate_fn(insts, src_pad_idx, trg_pad_idx):
     
     return torch.LongTensor(src_batch), torch.LongTensor(trg_batch)
 
+def pack_rows(insts, max_len):
+    ''' First-fit decreasing assignment of sentence pairs to rows of at most
+    max_len source and max_len target-input tokens; longer pairs get a row of their own. '''
+    order = sorted(range(len(insts)), key=lambda i: -max(len(insts[i][0]), len(insts[i][1]) - 1))
+    rows, used = [], []
+    for i in order:
+        n_src, n_trg = len(insts[i][0]), len(insts[i][1]) - 1
+        for r, (src_used, trg_used) in enumerate(used):
+            if src_used + n_src <= max_len and trg_used + n_trg <= max_len:
+                rows[r].append(i)
+                used[r] = (src_used + n_src, trg_used + n_trg)
+                break
+        else:
+            rows.append([i])
+            used.append((n_src, n_trg))
+    return rows
+
+def collate_fn_packed(insts, src_pad_idx, trg_pad_idx, max_len):
+    ''' Pack several sentence pairs per row to avoid padding.
+
+    Returns (src_seq, trg_seq, gold, src_seg, trg_seg). The target is shifted
+    per sentence (trg_seq holds t[:-1], gold holds t[1:]) so no prediction
+    crosses a sentence boundary; segment ids number the sentences of a row
+    from 1 and are 0 on padding.
+    '''
+    rows = pack_rows(insts, max_len)
+    src_rows, trg_rows, gold_rows, src_segs, trg_segs = [], [], [], [], []
+    for row in rows:
+        src, trg, gold, src_seg, trg_seg = [], [], [], [], []
+        for seg_id, i in enumerate(row, 1):
+            s, t = insts[i]
+            src += s
+            trg += t[:-1]
+            gold += t[1:]
+            src_seg += [seg_id] * len(s)
+            trg_seg += [seg_id] * (len(t) - 1)
+        src_rows.append(src)
+        trg_rows.append(trg)
+        gold_rows.append(gold)
+        src_segs.append(src_seg)
+        trg_segs.append(trg_seg)
+
+    max_src_len = max(len(s) for s in src_rows)
+    max_trg_len = max(len(t) for t in trg_rows)
+
+    def pad(seqs, length, value):
+        return torch.LongTensor([seq + [value] * (length - len(seq)) for seq in seqs])
+
+    return (pad(src_rows, max_src_len, src_pad_idx), pad(trg_rows, max_trg_len, trg_pad_idx),
+            pad(gold_rows, max_trg_len, trg_pad_idx), pad(src_segs, max_src_len, 0), pad(trg_segs, max_trg_len, 0))
+
 class Vocabulary:
     def __init__(self, stoi, itos):
         self.stoi = stoi
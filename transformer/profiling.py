@@ -0,0 +1,148 @@
+''' Opt-in training instrumentation: per-layer timing hooks and a torch.profiler window.
+
+Nothing here is active unless explicitly created: with instrumentation
+disabled no hook is registered and no profiler runs, so the model executes
+exactly the uninstrumented code path.
+'''
+import json
+import os
+import time
+from collections import defaultdict
+
+import torch
+import torch.nn as nn
+from transformer.Layers import DecoderLayer, EncoderLayer
+from transformer.SubLayers import MultiHeadAttention, PositionwiseFeedForward
+
+
+_TIMED_TYPES = (EncoderLayer, DecoderLayer, MultiHeadAttention, PositionwiseFeedForward)
+
+
+def _first_tensor(x):
+    if isinstance(x, torch.Tensor):
+        return x
+    if isinstance(x, (tuple, list)) and x and isinstance(x[0], torch.Tensor):
+        return x[0]
+    return None
+
+
+class LayerTimer():
+    ''' Forward / backward wall-clock time per EncoderLayer / DecoderLayer, per sublayer
+    (attention, FFN) and for the output projection.
+
+    Forward time is measured between forward pre- and post-hooks. Backward time
+    runs from the moment the gradient of a module's output arrives to the moment
+    the gradient of its (first) input is ready, using tensor hooks, which also
+    works for modules whose output is later modified in place.
+    '''
+
+    def __init__(self, model: nn.Module, sync_cuda=True):
+        self.modules = [
+            (name, module) for name, module in model.named_modules()
+            if isinstance(module, _TIMED_TYPES) or name == 'trg_word_prj']
+        self.sync_cuda = sync_cuda and torch.cuda.is_available()
+        self.handles = []
+        self.reset()
+
+    def _now(self):
+        if self.sync_cuda:
+            torch.cuda.synchronize()
+        return time.perf_counter()
+
+    def reset(self):
+        self.forward_sec = defaultdict(float)
+        self.backward_sec = defaultdict(float)
+        self.calls = defaultdict(int)
+        self._fwd_start = {}
+
+    def attach(self):
+        for name, module in self.modules:
+            self.handles.append(module.register_forward_pre_hook(self._make_pre_hook(name)))
+            self.handles.append(module.register_forward_hook(self._make_post_hook(name)))
+        return self
+
+    def detach(self):
+        for handle in self.handles:
+            handle.remove()
+        self.handles = []
+
+    def _make_pre_hook(self, name):
+        def hook(module, inputs):
+            self._fwd_start[name] = self._now()
+        return hook
+
+    def _make_post_hook(self, name):
+        def hook(module, inputs, output):
+            self.forward_sec[name] += self._now() - self._fwd_start.pop(name)
+            self.calls[name] += 1
+
+            out, inp = _first_tensor(output), _first_tensor(inputs)
+            if out is None or inp is None or not (out.requires_grad and inp.requires_grad):
+                return
+            bwd_start = []
+
+            def on_output_grad(grad):
+                bwd_start.append(self._now())
+
+            def on_input_grad(grad):
+                if bwd_start:
+                    self.backward_sec[name] += self._now() - bwd_start.pop()
+
+            out.register_hook(on_output_grad)
+            inp.register_hook(on_input_grad)
+        return hook
+
+    def summary(self):
+        ''' {module name: {'calls', 'forward_ms', 'backward_ms'}} in model order. '''
+        return {
+            name: {
+                'calls': self.calls[name],
+                'forward_ms': 1e3 * self.forward_sec[name],
+                'backward_ms': 1e3 * self.backward_sec[name],
+            }
+            for name, _ in self.modules if self.calls[name]}
+
+    def format_table(self):
+        lines = [f"    {'module':40s} {'calls':>7s} {'forward ms':>12s} {'backward ms':>12s}"]
+        for name, row in self.summary().items():
+            lines.append(
+                f"    {name:40s} {row['calls']:7d} {row['forward_ms']:12.1f} {row['backward_ms']:12.1f}")
+        return '\n'.join(lines)
+
+    def write(self, path, epoch):
+        ''' Append this epoch's summary as one JSON line. '''
+        with open(path, 'a') as f:
+            f.write(json.dumps({'epoch': epoch, 'layers': self.summary()}) + '\n')
+
+
+def build_profiler(output_dir, start_step, num_steps, completed_steps=0):
+    ''' A torch.profiler over global training steps [start_step, start_step + num_steps),
+    exported as a Chrome trace into output_dir. Call .step() once per training step.
+
+    completed_steps is the optimizer step count of a resumed run: the profiler
+    only sees the steps of this process, so the schedule is offset by it. At
+    least one step is always spent warming up, so the recorded window never
+    contains the one-time CUDA / cuDNN initialization of the first step; a
+    window that starts earlier is moved to the first step that allows it.
+    '''
+    activities = [torch.profiler.ProfilerActivity.CPU]
+    if torch.cuda.is_available():
+        activities.append(torch.profiler.ProfilerActivity.CUDA)
+
+    warmup = 1
+    local_start = max(start_step - completed_steps, warmup)
+    if local_start != start_step - completed_steps:
+        print(f'[Warning] Profiling window moved from step {start_step} to step {completed_steps + local_start}')
+    start_step = completed_steps + local_start
+    trace_path = os.path.join(output_dir, f'trace_steps_{start_step}-{start_step + num_steps - 1}.json')
+
+    def on_trace_ready(prof):
+        prof.export_chrome_trace(trace_path)
+        print(f'    - [Info] Profiler trace written to {trace_path}')
+
+    return torch.profiler.profile(
+        activities=activities,
+        schedule=torch.profiler.schedule(wait=local_start - warmup, warmup=warmup, active=num_steps, repeat=1),
+        on_trace_ready=on_trace_ready,
+        record_shapes=True,
+        profile_memory=True)
@@ -0,0 +1,9 @@
+from .heads import attention_modules, head_counts, head_importance, prune_heads, select_heads
+
+__all__ = [
+    'attention_modules',
+    'head_counts',
+    'head_importance',
+    'prune_heads',
+    'select_heads',
+]
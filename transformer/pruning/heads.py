@@ -0,0 +1,80 @@
+''' Attention head importance scoring and structured head pruning.
+
+Importance is the head-mask gradient criterion: every MultiHeadAttention gets
+a gate of ones on its head outputs and |d loss / d gate| of the
+teacher-forced validation loss is summed over batches. Scores are
+L2-normalized per attention module so that modules are comparable, and the
+globally least important heads are removed by slicing w_qs / w_ks / w_vs / fc.
+'''
+import torch
+import torch.nn.functional as F
+from transformer.Models import Transformer
+from transformer.SubLayers import MultiHeadAttention
+
+
+def attention_modules(model: Transformer):
+    ''' (name, module) of every MultiHeadAttention, in a stable order. '''
+    return [(name, module) for name, module in model.named_modules() if isinstance(module, MultiHeadAttention)]
+
+
+def head_counts(model: Transformer):
+    ''' The per-layer head counts, in the format of the 'head_counts' model config option. '''
+    return {
+        'encoder': [layer.slf_attn.n_head for layer in model.encoder.layer_stack],
+        'decoder': [[layer.slf_attn.n_head, layer.enc_attn.n_head] for layer in model.decoder.layer_stack],
+    }
+
+
+def head_importance(model: Transformer, batches, trg_pad_idx, device):
+    ''' {module name: n_head importance scores} from padded (src_seq, trg_seq) batches. '''
+    modules = attention_modules(model)
+    scores = {name: torch.zeros(mha.n_head, device=device) for name, mha in modules}
+    params = list(model.parameters())
+    requires_grad = [p.requires_grad for p in params]
+    was_training = model.training
+    model.eval()
+    for p in params:
+        p.requires_grad_(False)
+    for _, mha in modules:
+        mha.head_mask = torch.ones(mha.n_head, device=device, requires_grad=True)
+    try:
+        for src_seq, trg_seq in batches:
+            src_seq, trg_seq = src_seq.to(device), trg_seq.to(device)
+            pred = model(src_seq, trg_seq[:, :-1])
+            loss = F.cross_entropy(pred, trg_seq[:, 1:].contiguous().view(-1), ignore_index=trg_pad_idx)
+            grads = torch.autograd.grad(loss, [mha.head_mask for _, mha in modules])
+            for (name, _), grad in zip(modules, grads):
+                scores[name] += grad.abs()
+    finally:
+        for _, mha in modules:
+            mha.head_mask = None
+        for p, flag in zip(params, requires_grad):
+            p.requires_grad_(flag)
+        model.train(was_training)
+    return {name: score / score.norm().clamp_min(1e-12) for name, score in scores.items()}
+
+
+def select_heads(importance, ratio, min_heads=1):
+    ''' {module name: head indices} for the `ratio` least important heads overall,
+    leaving at least min_heads heads in every module. '''
+    ranked = sorted(
+        (float(score), name, head) for name, scores in importance.items() for head, score in enumerate(scores))
+    n_prune = int(ratio * len(ranked))
+    remaining = {name: len(scores) for name, scores in importance.items()}
+    to_prune = {}
+    for _, name, head in ranked:
+        if n_prune == 0:
+            break
+        if remaining[name] <= min_heads:
+            continue
+        to_prune.setdefault(name, []).append(head)
+        remaining[name] -= 1
+        n_prune -= 1
+    return to_prune
+
+
+def prune_heads(model: Transformer, to_prune):
+    ''' Remove the selected heads in place; returns the new per-layer head counts. '''
+    for name, heads in to_prune.items():
+        model.get_submodule(name).prune_heads(heads)
+    return head_counts(model)
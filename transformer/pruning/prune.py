@@ -0,0 +1,99 @@
+''' Prune the least important attention heads of a trained model and report the tradeoff.
+
+Usage:
+    python -m transformer.pruning.prune -model output/model.chkpt -data_pkl m30k.pkl -ratio 0.25 -save output/model_pruned.chkpt
+
+Head importance is scored on the first -score_sentences validation pairs and
+the report (validation perplexity, BLEU and translation speed of the original and
+the pruned model) on the next -n_sentences, so the two sets do not overlap.
+The saved checkpoint records the per-layer head counts in its settings and
+loads with transformer.checkpoint.load_model like any other.
+'''
+import argparse
+import json
+import os
+import pickle
+
+import torch
+from transformer.checkpoint import load_model
+from transformer.evaluation.quality import evaluate, pair_batches
+from transformer.pruning.heads import head_importance, prune_heads, select_heads
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Prune the least important attention heads of a model')
+    parser.add_argument('-model', required=True, help='Checkpoint or fastload export directory')
+    parser.add_argument('-data_pkl', required=True)
+    parser.add_argument('-save', required=True, help='Output (inference-only) checkpoint')
+    parser.add_argument('-ratio', type=float, default=0.25, help='Share of all attention heads to remove')
+    parser.add_argument('-min_heads', type=int, default=1, help='Heads kept in every attention module')
+    parser.add_argument('-score_sentences', type=int, default=1000)
+    parser.add_argument('-n_sentences', type=int, default=500, help='Validation pairs for the report')
+    parser.add_argument('-batch_size', type=int, default=64)
+    parser.add_argument('-decoding', choices=['beam', 'greedy'], default='greedy')
+    parser.add_argument('-beam_size', type=int, default=5)
+    parser.add_argument('-max_seq_len', type=int, default=100)
+    parser.add_argument('-no_cuda', action='store_true')
+    parser.add_argument('-report', default=None, help='Write the importance scores and the report as JSON')
+    opt = parser.parse_args(argv)
+
+    device = torch.device('cuda' if torch.cuda.is_available() and not opt.no_cuda else 'cpu')
+    model, config, vocab = load_model(opt.model, device)
+    model.eval()
+    with open(opt.data_pkl, 'rb') as f:
+        data = pickle.load(f)
+    vocab = vocab or data['vocab']
+    valid_src, valid_trg = data['valid']['src'], data['valid']['trg']
+    del data
+    score_src, score_trg = valid_src[:opt.score_sentences], valid_trg[:opt.score_sentences]
+    end = opt.score_sentences + opt.n_sentences
+    report_src, report_trg = valid_src[opt.score_sentences:end], valid_trg[opt.score_sentences:end]
+    if not report_src:
+        print('[Warning] No validation pairs left after scoring; reporting on the scoring pairs')
+        report_src, report_trg = score_src, score_trg
+
+    print('[Info] Evaluating the original model')
+    eval_args = (device, opt.batch_size, opt.decoding, opt.beam_size, opt.max_seq_len)
+    before = evaluate(model, vocab['trg'], report_src, report_trg, *eval_args)
+
+    print(f'[Info] Scoring heads on {len(score_src)} validation pairs')
+    importance = head_importance(
+        model, pair_batches(score_src, score_trg, opt.batch_size, model.src_pad_idx, model.trg_pad_idx),
+        model.trg_pad_idx, device)
+    to_prune = select_heads(importance, opt.ratio, opt.min_heads)
+    config = dict(config, head_counts=prune_heads(model, to_prune))
+    for name, heads in sorted(to_prune.items()):
+        print(f'    - {name}: pruned heads {sorted(heads)}')
+
+    print('[Info] Evaluating the pruned model')
+    after = evaluate(model, vocab['trg'], report_src, report_trg, *eval_args)
+
+    torch.save({
+        'settings': config,
+        'model': model.state_dict(),
+        'vocab': vocab,
+        'pruned_from': os.path.basename(opt.model),
+    }, opt.save)
+
+    print(f"  {'':10s} {'heads':>6s} {'params':>11s} {'ppl':>8s} {'BLEU':>6s} {'sent/s':>8s}")
+    for label, r in (('original', before), ('pruned', after)):
+        print(f"  {label:10s} {r['n_heads']:6d} {r['n_params']:11d} {r['valid_ppl']:8.3f} "
+              f"{r['bleu']:6.2f} {r['sentences_per_sec']:8.2f}")
+    print(f"[Info] Speedup x{after['sentences_per_sec'] / before['sentences_per_sec']:.2f}, "
+          f"BLEU {after['bleu'] - before['bleu']:+.2f}; pruned model saved to {opt.save}")
+
+    if opt.report:
+        with open(opt.report, 'w') as f:
+            json.dump({
+                'settings': vars(opt),
+                'importance': {name: scores.tolist() for name, scores in importance.items()},
+                'pruned': to_prune,
+                'head_counts': config['head_counts'],
+                'original': before,
+                'pruned_model': after,
+            }, f, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,5 @@
+from .engine import ContinuousBatchingEngine
+
+__all__ = [
+    'ContinuousBatchingEngine',
+]
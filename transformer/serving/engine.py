@@ -0,0 +1,178 @@
+''' Iteration-level (continuous) batching of greedy decoding on the compiled decoder-step graphs.
+
+Each call to step() first admits queued requests, encoding them together with
+EncoderStep, and then advances every active sequence by one token with a
+single DecoderStep call; sequences that emit EOS or reach their length budget
+leave the batch in the same step. The per-sequence state is the cached
+cross-attention keys/values of its source and its self-attention cache. Rows
+are kept compact: joining concatenates the new rows, leaving selects the
+survivors, and the source / cache widths are padded or trimmed to the longest
+active sequence.
+
+Admission control: a request waits in the FIFO queue while admitting it would
+exceed max_slots active sequences or max_cache_tokens cached positions
+(rows x (cache width + source width), the size of the padded cache tensors).
+'''
+import itertools
+from collections import deque
+
+import torch
+from transformer.Models import Transformer
+from transformer.compiled.artifacts import build_steps
+from transformer.compiled.steps import init_self_cache
+
+
+def _pad_dim(t, dim, size, value=0):
+    ''' Pad t with `value` along dim up to size, or cut it down to size. '''
+    if t.size(dim) >= size:
+        return t.narrow(dim, 0, size)
+    shape = list(t.shape)
+    shape[dim] = size - t.size(dim)
+    return torch.cat([t, t.new_full(shape, value)], dim)
+
+
+class ContinuousBatchingEngine():
+    ''' Serve greedy translation requests with sequences joining and leaving the batch at every step. '''
+
+    def __init__(
+            self, model: Transformer, trg_bos_idx, trg_eos_idx, max_seq_len=100,
+            max_slots=64, max_cache_tokens=0, max_len_a=None, max_len_b=0,
+            mode='eager', artifact_dir=None):
+
+        self.model = model.eval()
+        self.trg_bos_idx = trg_bos_idx
+        self.trg_eos_idx = trg_eos_idx
+        self.max_seq_len = max_seq_len
+        self.max_slots = max_slots
+        self.max_cache_tokens = max_cache_tokens
+        self.max_len_a = max_len_a
+        self.max_len_b = max_len_b
+        self.device = model.trg_word_prj.weight.device
+        self.encoder_step, self.decoder_step, self.mode = build_steps(model, mode, artifact_dir)
+
+        self.queue = deque()
+        self._ids = itertools.count()
+        # -- per active row: request id, source length, length budget and tokens so far
+        self.req_ids, self.src_lens, self.budgets, self.tokens = [], [], [], []
+        self.state = None   # (self_k, self_v, cross_k, cross_v, src_mask) of the active rows
+
+    def length_budget(self, src_len):
+        ''' Maximum output length (BOS included), as Translator._length_budget. '''
+        if self.max_len_a is None:
+            return self.max_seq_len
+        return min(self.max_seq_len, max(2, int(self.max_len_a * src_len + self.max_len_b)))
+
+    def submit(self, src_ids, request_id=None):
+        ''' Queue a source sentence (a list of token ids); returns its request id. '''
+        request_id = next(self._ids) if request_id is None else request_id
+        self.queue.append((request_id, list(src_ids)))
+        return request_id
+
+    @property
+    def n_active(self):
+        return len(self.req_ids)
+
+    def has_work(self):
+        return bool(self.queue) or self.n_active > 0
+
+    def _admit(self):
+        ''' Pop the queued requests that fit, in FIFO order. '''
+        admitted = []
+        n_rows = self.n_active
+        cache_len = max(self.budgets, default=0)
+        src_len = max(self.src_lens, default=0)
+        while self.queue and n_rows < self.max_slots:
+            request_id, src_ids = self.queue[0]
+            new_cache_len = max(cache_len, self.length_budget(len(src_ids)))
+            new_src_len = max(src_len, len(src_ids))
+            if (self.max_cache_tokens and n_rows > 0
+                    and (n_rows + 1) * (new_cache_len + new_src_len) > self.max_cache_tokens):
+                break   # an empty engine always admits, so an oversized request cannot block the queue
+            self.queue.popleft()
+            admitted.append((request_id, src_ids))
+            n_rows, cache_len, src_len = n_rows + 1, new_cache_len, new_src_len
+        return admitted
+
+    def _join(self, admitted):
+        ''' Encode the admitted sources and append their rows to the active state. '''
+        src_lens = [len(src_ids) for _, src_ids in admitted]
+        budgets = [self.length_budget(n) for n in src_lens]
+        src_seq = torch.full(
+            (len(admitted), max(src_lens)), self.model.src_pad_idx, dtype=torch.long, device=self.device)
+        for row, (_, src_ids) in enumerate(admitted):
+            src_seq[row, :len(src_ids)] = torch.tensor(src_ids, device=self.device)
+        src_mask, cross_k, cross_v = self.encoder_step(src_seq)
+        self_k, self_v = init_self_cache(self.model, len(admitted), max(budgets))
+        new_state = (self_k, self_v, cross_k, cross_v, src_mask)
+
+        self.req_ids += [request_id for request_id, _ in admitted]
+        self.src_lens += src_lens
+        self.budgets += budgets
+        self.tokens += [[self.trg_bos_idx] for _ in admitted]
+        if self.state is None:
+            self.state = new_state
+            return
+
+        cache_len, src_len = max(self.budgets), max(self.src_lens)
+        widths = (cache_len, cache_len, src_len, src_len)
+        joined = []
+        for old, new, width in zip(self.state[:4], new_state[:4], widths):
+            joined.append(tuple(
+                torch.cat([_pad_dim(o, 2, width), _pad_dim(n, 2, width)]) for o, n in zip(old, new)))
+        src_mask = torch.cat([_pad_dim(self.state[4], 2, src_len, False), _pad_dim(src_mask, 2, src_len, False)])
+        self.state = (*joined, src_mask)
+
+    def _leave(self, keep):
+        ''' Keep only the given rows and trim the widths to the longest survivor. '''
+        if not keep:
+            self.req_ids, self.src_lens, self.budgets, self.tokens = [], [], [], []
+            self.state = None
+            return
+        self.req_ids = [self.req_ids[row] for row in keep]
+        self.src_lens = [self.src_lens[row] for row in keep]
+        self.budgets = [self.budgets[row] for row in keep]
+        self.tokens = [self.tokens[row] for row in keep]
+
+        rows = torch.tensor(keep, device=self.device)
+        cache_len, src_len = max(self.budgets), max(self.src_lens)
+        widths = (cache_len, cache_len, src_len, src_len)
+        parts = [
+            tuple(_pad_dim(t.index_select(0, rows), 2, width) for t in part)
+            for part, width in zip(self.state[:4], widths)]
+        self.state = (*parts, _pad_dim(self.state[4].index_select(0, rows), 2, src_len))
+
+    def step(self):
+        ''' Admit, decode one token for every active sequence, and return the finished
+        (request_id, token ids with BOS / EOS) pairs. '''
+        with torch.no_grad():
+            admitted = self._admit()
+            if admitted:
+                self._join(admitted)
+            if self.n_active == 0:
+                return []
+
+            self_k, self_v, cross_k, cross_v, src_mask = self.state
+            trg_tok = torch.tensor([seq[-1] for seq in self.tokens], device=self.device)
+            pos = torch.tensor([len(seq) - 1 for seq in self.tokens], device=self.device)
+            logits, self_k, self_v = self.decoder_step(trg_tok, pos, self_k, self_v, cross_k, cross_v, src_mask)
+            self.state = (self_k, self_v, cross_k, cross_v, src_mask)
+
+            finished, keep = [], []
+            for row, tok in enumerate(logits.argmax(-1).tolist()):
+                seq = self.tokens[row]
+                seq.append(tok)
+                if tok == self.trg_eos_idx or len(seq) >= self.budgets[row]:
+                    finished.append((self.req_ids[row], seq))
+                else:
+                    keep.append(row)
+            if finished:
+                self._leave(keep)
+        return finished
+
+    def translate(self, src_insts):
+        ''' Decode a list of sources to completion; results keep the input order. '''
+        ids = [self.submit(src_ids) for src_ids in src_insts]
+        results = {}
+        while self.has_work():
+            results.update(self.step())
+        return [results[request_id] for request_id in ids]
@@ -0,0 +1,194 @@
+''' Load generator: continuous batching against static batching under Poisson traffic.
+
+Usage:
+    python -m transformer.serving.loadgen -checkpoint output/model.chkpt -data_pkl m30k.pkl -rates 5 20 50
+    python -m transformer.serving.loadgen -rates 10 40   # random weights and random-length sources
+
+For every arrival rate the same request trace (exponential inter-arrival
+times, fixed seed) is replayed in real time against
+    static:     requests are collected until -batch_size are waiting or the
+                oldest has waited -max_wait_ms, then the batch is decoded with
+                CachedTranslator.greedy_decode and all its results return together;
+    continuous: ContinuousBatchingEngine, new requests join at the next step
+                and finished ones return immediately.
+Latency is measured from a request's arrival to the return of its result.
+'''
+import argparse
+import json
+import random
+import time
+
+import torch
+
+
+def _load(opt):
+    from transformer.Models import set_active_layers
+    from transformer.checkpoint import build_model, load_model
+
+    if opt.checkpoint:
+        model, _, _ = load_model(opt.checkpoint)
+    else:
+        torch.manual_seed(opt.seed)
+        model = build_model({
+            'src_vocab_size': opt.vocab_size, 'trg_vocab_size': opt.vocab_size,
+            'src_pad_idx': 0, 'trg_pad_idx': 0,
+            'proj_share_weight': True, 'embs_share_weight': True,
+            'd_k': opt.d_model // opt.n_head, 'd_v': opt.d_model // opt.n_head,
+            'd_model': opt.d_model, 'd_word_vec': opt.d_model, 'd_inner_hid': opt.d_model * 4,
+            'n_layers': opt.n_layers, 'n_head': opt.n_head, 'dropout': 0.1, 'scale_emb_or_prj': 'prj'})
+    set_active_layers(model, opt.enc_layers, opt.dec_layers)
+    return model.eval()
+
+
+def _sources(opt, model):
+    if opt.data_pkl:
+        import pickle
+
+        with open(opt.data_pkl, 'rb') as f:
+            return pickle.load(f)['valid']['src'][:opt.n_requests]
+    rng = random.Random(opt.seed)
+    n_vocab = model.encoder.src_word_emb.num_embeddings
+    return [
+        [rng.randrange(4, n_vocab) for _ in range(rng.randint(opt.min_src_len, opt.max_src_len))]
+        for _ in range(opt.n_requests)]
+
+
+def arrival_times(n, rate, seed):
+    rng = random.Random(seed)
+    times, t = [], 0.0
+    for _ in range(n):
+        t += rng.expovariate(rate)
+        times.append(t)
+    return times
+
+
+def _percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def _report(latencies, n_tokens, elapsed):
+    return {
+        'sentences_per_sec': len(latencies) / elapsed,
+        'tokens_per_sec': n_tokens / elapsed,
+        'p50_latency_ms': 1e3 * _percentile(latencies, 0.5),
+        'p90_latency_ms': 1e3 * _percentile(latencies, 0.9),
+        'p99_latency_ms': 1e3 * _percentile(latencies, 0.99),
+    }
+
+
+def run_continuous(engine, src_insts, arrivals):
+    latencies, n_tokens, n_next = [], 0, 0
+    start = time.perf_counter()
+    while len(latencies) < len(src_insts):
+        now = time.perf_counter() - start
+        while n_next < len(src_insts) and arrivals[n_next] <= now:
+            engine.submit(src_insts[n_next], request_id=n_next)
+            n_next += 1
+        if not engine.has_work():
+            time.sleep(arrivals[n_next] - now)
+            continue
+        for request_id, hyp in engine.step():
+            latencies.append(time.perf_counter() - start - arrivals[request_id])
+            n_tokens += len(hyp)
+    return _report(latencies, n_tokens, time.perf_counter() - start)
+
+
+def run_static(translator, src_insts, arrivals, batch_size, max_wait):
+    pad_idx = translator.src_pad_idx
+    latencies, n_tokens, n_next, waiting = [], 0, 0, []
+    start = time.perf_counter()
+    while len(latencies) < len(src_insts):
+        now = time.perf_counter() - start
+        while n_next < len(src_insts) and arrivals[n_next] <= now:
+            waiting.append(n_next)
+            n_next += 1
+        no_more = n_next == len(src_insts)
+        if not waiting or (len(waiting) < batch_size and not no_more and now - arrivals[waiting[0]] < max_wait):
+            wake = arrivals[waiting[0]] + max_wait if waiting else arrivals[n_next]
+            time.sleep(max(0.0, min(wake, arrivals[n_next]) - now))
+            continue
+
+        batch, waiting = waiting[:batch_size], waiting[batch_size:]
+        max_len = max(len(src_insts[i]) for i in batch)
+        src_seq = torch.LongTensor([
+            src_insts[i] + [pad_idx] * (max_len - len(src_insts[i])) for i in batch
+        ]).to(translator.init_seq.device)
+        hyps = translator.greedy_decode(src_seq)
+        done = time.perf_counter() - start
+        latencies += [done - arrivals[i] for i in batch]
+        n_tokens += sum(len(hyp) for hyp in hyps)
+    return _report(latencies, n_tokens, time.perf_counter() - start)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Continuous vs static batching under Poisson request traffic')
+    parser.add_argument('-checkpoint', default=None, help='Checkpoint or fastload export directory; random weights if omitted')
+    parser.add_argument('-data_pkl', default=None, help='Take the sources from the validation set; random if omitted')
+    parser.add_argument('-rates', type=float, nargs='+', default=[5, 20, 50], help='Arrival rates (requests/sec)')
+    parser.add_argument('-n_requests', type=int, default=200)
+    parser.add_argument('-min_src_len', type=int, default=3)
+    parser.add_argument('-max_src_len', type=int, default=40)
+    parser.add_argument('-mode', choices=['eager', 'compile', 'export'], default='eager')
+    parser.add_argument('-artifact_dir', default=None)
+    parser.add_argument('-max_seq_len', type=int, default=100)
+    parser.add_argument('-max_len_a', type=float, default=1.5,
+                        help='Per-request output budget max_len_a * src_len + max_len_b, as served')
+    parser.add_argument('-max_len_b', type=int, default=5)
+    parser.add_argument('-batch_size', type=int, default=32, help='Static batch size and continuous slot count')
+    parser.add_argument('-max_wait_ms', type=float, default=50, help='Static batching: longest wait for a full batch')
+    parser.add_argument('-max_cache_tokens', type=int, default=0,
+                        help='Continuous batching: admission limit on cached positions (0: slots only)')
+    parser.add_argument('-threads', type=int, default=torch.get_num_threads())
+    parser.add_argument('-vocab_size', type=int, default=8000)
+    parser.add_argument('-d_model', type=int, default=512)
+    parser.add_argument('-n_head', type=int, default=8)
+    parser.add_argument('-n_layers', type=int, default=6)
+    parser.add_argument('-enc_layers', type=int, nargs='+', default=None,
+                        help='Run only these encoder layer indices (e.g. of a LayerDrop-trained model)')
+    parser.add_argument('-dec_layers', type=int, nargs='+', default=None,
+                        help='Run only these decoder layer indices')
+    parser.add_argument('-seed', type=int, default=1)
+    parser.add_argument('-output', default=None, help='Write the results as JSON')
+    opt = parser.parse_args(argv)
+
+    from transformer.compiled.translator import CachedTranslator
+    from transformer.serving.engine import ContinuousBatchingEngine
+
+    torch.set_num_threads(opt.threads)
+    model = _load(opt)
+    src_insts = _sources(opt, model)
+    # -- ids 2 / 3 are BOS / EOS in a preprocess_modern.py vocabulary
+    budget = {'max_seq_len': opt.max_seq_len, 'max_len_a': opt.max_len_a, 'max_len_b': opt.max_len_b}
+    translator = CachedTranslator(
+        model, beam_size=1, src_pad_idx=model.src_pad_idx, trg_pad_idx=model.trg_pad_idx,
+        trg_bos_idx=2, trg_eos_idx=3, mode=opt.mode, artifact_dir=opt.artifact_dir, **budget)
+    engine = ContinuousBatchingEngine(
+        model, trg_bos_idx=2, trg_eos_idx=3, max_slots=opt.batch_size, max_cache_tokens=opt.max_cache_tokens,
+        mode=opt.mode, artifact_dir=opt.artifact_dir, **budget)
+
+    # -- warm up both paths (and compile / load the graphs) outside the timed runs
+    warmup = src_insts[:opt.batch_size]
+    translator.translate_corpus(warmup, opt.batch_size)
+    engine.translate(warmup)
+
+    results = {'settings': vars(opt), 'mode_used': engine.mode, 'rates': {}}
+    print(f"  {'rate':>6s} {'method':>10s} {'sent/s':>8s} {'p50 ms':>9s} {'p90 ms':>9s} {'p99 ms':>9s}")
+    for rate in opt.rates:
+        arrivals = arrival_times(len(src_insts), rate, opt.seed)
+        results['rates'][rate] = {
+            'static': run_static(translator, src_insts, arrivals, opt.batch_size, opt.max_wait_ms / 1e3),
+            'continuous': run_continuous(engine, src_insts, arrivals),
+        }
+        for method, r in results['rates'][rate].items():
+            print(f"  {rate:6.1f} {method:>10s} {r['sentences_per_sec']:8.2f} {r['p50_latency_ms']:9.1f} "
+                  f"{r['p90_latency_ms']:9.1f} {r['p99_latency_ms']:9.1f}")
+
+    if opt.output:
+        with open(opt.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
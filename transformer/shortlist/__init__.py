@@ -0,0 +1,8 @@
+from .table import Shortlist, build_table
+from .translator import ShortlistTranslator
+
+__all__ = [
+    'Shortlist',
+    'build_table',
+    'ShortlistTranslator',
+]
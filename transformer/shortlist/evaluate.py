@@ -0,0 +1,109 @@
+''' Measure the speed gain of the shortlist against agreement with the full projection.
+
+Usage:
+    python -m transformer.shortlist.evaluate -model output/model.chkpt -data_pkl m30k.pkl -shortlist shortlist.npz
+
+Both translators decode the same validation sources; agreement is the share of
+sentences whose output is identical, plus the share of full-projection output
+tokens that are covered by the batch shortlist.
+'''
+import argparse
+import json
+import pickle
+import time
+
+import torch
+from transformer.autotune.config import apply_threads, load_runtime_config
+from transformer.Models import set_active_layers
+from transformer.checkpoint import build_translator, load_model
+from transformer.shortlist.table import Shortlist
+from transformer.shortlist.translator import ShortlistTranslator
+
+
+def _batches(insts, batch_size, pad_idx):
+    for begin in range(0, len(insts), batch_size):
+        batch = insts[begin:begin + batch_size]
+        max_len = max(len(inst) for inst in batch)
+        yield torch.LongTensor([inst + [pad_idx] * (max_len - len(inst)) for inst in batch])
+
+
+def _run(translator, batches, decoding):
+    outputs = []
+    start = time.perf_counter()
+    for src_seq in batches:
+        outputs += translator.translate_batch(src_seq, decoding=decoding)
+    return outputs, time.perf_counter() - start
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Evaluate a lexical shortlist against the full projection')
+    parser.add_argument('-model', required=True)
+    parser.add_argument('-data_pkl', required=True)
+    parser.add_argument('-shortlist', required=True)
+    parser.add_argument('-decoding', choices=['beam', 'greedy'], default='greedy')
+    parser.add_argument('-beam_size', type=int, default=5)
+    parser.add_argument('-max_seq_len', type=int, default=100)
+    parser.add_argument('-max_len_a', type=float, default=None,
+                        help='Per-sentence output budget max_len_a * src_len + max_len_b (default: max_seq_len)')
+    parser.add_argument('-max_len_b', type=int, default=10)
+    parser.add_argument('-batch_size', type=int, default=32)
+    parser.add_argument('-enc_layers', type=int, nargs='+', default=None,
+                        help='Run only these encoder layer indices (e.g. of a LayerDrop-trained model)')
+    parser.add_argument('-dec_layers', type=int, nargs='+', default=None,
+                        help='Run only these decoder layer indices')
+    parser.add_argument('-n_sentences', type=int, default=1000)
+    parser.add_argument('-no_cuda', action='store_true')
+    parser.add_argument('-output', default=None, help='Write the results as JSON')
+    parser.add_argument('-runtime_config', default=None,
+                        help='Runtime config from transformer.autotune.tune; overrides threads, batch / beam size and decoding')
+    opt = parser.parse_args(argv)
+
+    if opt.runtime_config:
+        config = load_runtime_config(opt.runtime_config)
+        apply_threads(config)
+        opt.batch_size, opt.beam_size, opt.decoding = config['batch_size'], config['beam_size'], config['decoding']
+
+    device = torch.device('cuda' if torch.cuda.is_available() and not opt.no_cuda else 'cpu')
+    model, _, vocab = load_model(opt.model, device)
+    set_active_layers(model, opt.enc_layers, opt.dec_layers)
+    with open(opt.data_pkl, 'rb') as f:
+        src_insts = pickle.load(f)['valid']['src'][:opt.n_sentences]
+    batches = [src_seq.to(device) for src_seq in _batches(src_insts, opt.batch_size, model.src_pad_idx)]
+    shortlist = Shortlist.load(opt.shortlist)
+
+    budget = {'max_len_a': opt.max_len_a, 'max_len_b': opt.max_len_b}
+    full = build_translator(model, vocab['trg'], opt.beam_size, opt.max_seq_len, **budget)
+    restricted = build_translator(
+        model, vocab['trg'], opt.beam_size, opt.max_seq_len,
+        translator_cls=ShortlistTranslator, shortlist=shortlist, **budget)
+
+    full_out, full_sec = _run(full, batches, opt.decoding)
+    short_out, short_sec = _run(restricted, batches, opt.decoding)
+
+    n_covered, n_tokens, cand_sizes = 0, 0, []
+    for i, src_seq in enumerate(batches):
+        cand = set(shortlist.select(src_seq).tolist())
+        cand_sizes.append(len(cand))
+        for out in full_out[i * opt.batch_size:(i + 1) * opt.batch_size]:
+            n_covered += sum(tok in cand for tok in out)
+            n_tokens += len(out)
+
+    results = {
+        'n_sentences': len(src_insts),
+        'full_sec': full_sec,
+        'shortlist_sec': short_sec,
+        'speedup': full_sec / short_sec,
+        'exact_match': sum(a == b for a, b in zip(full_out, short_out)) / len(full_out),
+        'token_coverage': n_covered / n_tokens,
+        'mean_candidates': sum(cand_sizes) / len(cand_sizes),
+        'vocab_size': model.trg_word_prj.weight.size(0),
+    }
+    print(json.dumps(results, indent=2))
+    if opt.output:
+        with open(opt.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,125 @@
+''' Source-to-target lexical shortlist built from the preprocessed training data.
+
+For every source word we keep the `top_k` target words with the highest Dice
+association score, 2 * c(s, t) / (c(s) + c(t)), where counts are sentence-level
+co-occurrences. The `n_frequent` most frequent target words (and the special
+tokens) are always candidates, which covers function words.
+
+Usage:
+    python -m transformer.shortlist.table -data_pkl m30k.pkl -save shortlist.npz
+'''
+import argparse
+import pickle
+
+import numpy as np
+import torch
+
+
+N_SPECIALS = 4   # <blank>, <unk>, <s>, </s> are the first ids of every Vocabulary.
+
+
+def _merge_counts(keys, counts, new_keys, new_counts):
+    keys = np.concatenate([keys, new_keys])
+    counts = np.concatenate([counts, new_counts])
+    keys, inverse = np.unique(keys, return_inverse=True)
+    merged = np.zeros(len(keys), dtype=np.int64)
+    np.add.at(merged, inverse, counts)
+    return keys, merged
+
+
+def count_cooccurrences(src_insts, trg_insts, n_src_vocab, n_trg_vocab, chunk_size=10000):
+    ''' Sentence-level counts.
+
+    Returns the sorted co-occurrence keys (src * n_trg_vocab + trg) with their
+    counts, and the number of sentences containing each source / target word.
+    '''
+    keys = np.zeros(0, dtype=np.int64)
+    counts = np.zeros(0, dtype=np.int64)
+    src_df = np.zeros(n_src_vocab, dtype=np.int64)
+    trg_df = np.zeros(n_trg_vocab, dtype=np.int64)
+    for begin in range(0, len(src_insts), chunk_size):
+        chunk_keys = []
+        for src, trg in zip(src_insts[begin:begin + chunk_size], trg_insts[begin:begin + chunk_size]):
+            src_ids = np.unique(np.asarray(src, dtype=np.int64))
+            trg_ids = np.unique(np.asarray(trg, dtype=np.int64))
+            src_df[src_ids] += 1
+            trg_df[trg_ids] += 1
+            chunk_keys.append(np.add.outer(src_ids * n_trg_vocab, trg_ids).ravel())
+        if chunk_keys:
+            new_keys, new_counts = np.unique(np.concatenate(chunk_keys), return_counts=True)
+            keys, counts = _merge_counts(keys, counts, new_keys, new_counts)
+    return keys, counts, src_df, trg_df
+
+
+def build_table(src_insts, trg_insts, n_src_vocab, n_trg_vocab, top_k=50, n_frequent=500):
+    ''' Returns (candidates: n_src_vocab x top_k padded with -1, frequent: target ids always kept). '''
+    keys, counts, src_df, trg_df = count_cooccurrences(src_insts, trg_insts, n_src_vocab, n_trg_vocab)
+    src_ids, trg_ids = keys // n_trg_vocab, keys % n_trg_vocab
+    dice = 2.0 * counts / (src_df[src_ids] + trg_df[trg_ids])
+
+    # Rank targets within each source word by descending score.
+    order = np.lexsort((-dice, src_ids))
+    src_sorted, trg_sorted = src_ids[order], trg_ids[order]
+    group_start = np.searchsorted(src_sorted, np.arange(n_src_vocab))
+    rank = np.arange(len(order)) - group_start[src_sorted]
+    keep = rank < top_k
+
+    candidates = np.full((n_src_vocab, top_k), -1, dtype=np.int32)
+    candidates[src_sorted[keep], rank[keep]] = trg_sorted[keep]
+
+    by_freq = np.argsort(-trg_df, kind='stable')
+    frequent = by_freq[by_freq >= N_SPECIALS][:n_frequent]
+    frequent = np.concatenate([np.arange(N_SPECIALS), frequent]).astype(np.int32)
+    return candidates, frequent
+
+
+class Shortlist():
+    ''' Lookup of the plausible target ids for a batch of source sentences. '''
+
+    def __init__(self, candidates, frequent):
+        self.candidates = torch.as_tensor(candidates, dtype=torch.long)
+        self.frequent = torch.as_tensor(frequent, dtype=torch.long)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as f:
+            return cls(f['candidates'], f['frequent'])
+
+    def save(self, path):
+        np.savez(path, candidates=self.candidates.int().numpy(), frequent=self.frequent.int().numpy())
+
+    def to(self, device):
+        self.candidates = self.candidates.to(device)
+        self.frequent = self.frequent.to(device)
+        return self
+
+    def select(self, src_seq):
+        ''' Sorted union of the candidate target ids of every word in the batch. '''
+        cand = self.candidates.index_select(0, src_seq.reshape(-1)).view(-1)
+        cand = torch.cat([cand[cand >= 0], self.frequent])
+        return torch.unique(cand)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Build a lexical shortlist from preprocessed data')
+    parser.add_argument('-data_pkl', required=True)
+    parser.add_argument('-save', required=True, help='Output .npz file')
+    parser.add_argument('-top_k', type=int, default=50, help='Candidates kept per source word')
+    parser.add_argument('-n_frequent', type=int, default=500, help='Most frequent target words always kept')
+    opt = parser.parse_args(argv)
+
+    with open(opt.data_pkl, 'rb') as f:
+        data = pickle.load(f)
+
+    print('[Info] Counting co-occurrences...')
+    candidates, frequent = build_table(
+        data['train']['src'], data['train']['trg'],
+        len(data['vocab']['src']), len(data['vocab']['trg']),
+        top_k=opt.top_k, n_frequent=opt.n_frequent)
+    Shortlist(candidates, frequent).save(opt.save)
+    print(f'[Info] Shortlist saved to {opt.save}')
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
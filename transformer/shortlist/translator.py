@@ -0,0 +1,46 @@
+''' Translator whose output projection is restricted to a per-batch lexical shortlist. '''
+import torch.nn.functional as F
+from transformer.Models import Transformer, get_subsequent_mask
+from transformer.Translator import Translator
+from transformer.shortlist.table import Shortlist
+
+
+class ShortlistTranslator(Translator):
+    ''' Project only onto the shortlisted target words of the current batch.
+
+    The projection rows of the candidate ids are gathered once per batch; the
+    search runs over indices into that candidate set and _vocab_ids maps the
+    chosen indices back to full-vocabulary ids.
+    '''
+
+    def __init__(
+            self, model: Transformer, beam_size, max_seq_len,
+            src_pad_idx, trg_pad_idx, trg_bos_idx, trg_eos_idx,
+            shortlist: Shortlist, max_len_a=None, max_len_b=0):
+
+        super().__init__(
+            model, beam_size, max_seq_len,
+            src_pad_idx, trg_pad_idx, trg_bos_idx, trg_eos_idx,
+            max_len_a=max_len_a, max_len_b=max_len_b)
+
+        self.shortlist = shortlist.to(model.trg_word_prj.weight.device)
+        self.cand_ids = None
+        self.cand_weight = None
+
+
+    def _init_decode_state(self, src_seq, src_mask, max_len):
+        self.cand_ids = self.shortlist.select(src_seq)
+        self.cand_weight = self.model.trg_word_prj.weight.index_select(0, self.cand_ids)
+        return super()._init_decode_state(src_seq, src_mask, max_len)
+
+
+    def _step_probs(self, gen_seq, step, state):
+        enc_output, src_mask = state
+        trg_seq = gen_seq[:, :step]
+        trg_mask = get_subsequent_mask(trg_seq)
+        dec_output, *_ = self.model.decoder(trg_seq, trg_mask, enc_output, src_mask)
+        return F.softmax(F.linear(dec_output[:, -1, :], self.cand_weight), dim=-1), state
+
+
+    def _vocab_ids(self, idx):
+        return self.cand_ids[idx]
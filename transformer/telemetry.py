@@ -0,0 +1,112 @@
+''' Step-level training throughput telemetry.
+
+Every `interval` optimizer steps one record is emitted with token throughput,
+padding share, the split between waiting on the DataLoader, forward/backward
+compute and the optimizer step, and peak memory. On CUDA every timestamp
+synchronizes the device, so the laps hold the kernel time rather than only
+the launches. Records are appended as JSON
+lines to a structured log and, when a SummaryWriter is given, logged to
+TensorBoard under `telemetry/`.
+'''
+import json
+import time
+
+import torch
+
+try:
+    import resource
+except ImportError:   # not available on Windows
+    resource = None
+
+
+def peak_rss_mb():
+    ''' Peak resident set size of this process in MB (ru_maxrss is in KB on Linux). '''
+    if resource is None:
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class StepTelemetry():
+    ''' Accumulate per-step timings and token counts; flush one record per interval. '''
+
+    def __init__(self, log_path, interval, src_pad_idx, trg_pad_idx, tb_writer=None, device=None):
+        self.log_path = log_path
+        self.interval = interval
+        self.src_pad_idx = src_pad_idx
+        self.trg_pad_idx = trg_pad_idx
+        self.tb_writer = tb_writer
+        self.sync_cuda = device is not None and torch.device(device).type == 'cuda'
+        self._reset_window()
+        self._last_step_end = time.perf_counter()
+
+    def _now(self):
+        if self.sync_cuda:
+            torch.cuda.synchronize()
+        return time.perf_counter()
+
+    def _reset_window(self):
+        self.n_steps = 0
+        self.src_tokens = self.trg_tokens = self.pad_tokens = self.total_tokens = 0
+        self.data_wait_sec = self.compute_sec = self.optim_sec = 0.0
+        self.window_start = time.perf_counter()
+
+    def epoch_start(self):
+        ''' Start the clocks; the first batch of an epoch includes worker start-up. '''
+        self._last_step_end = time.perf_counter()
+        if self.n_steps == 0:
+            self.window_start = self._last_step_end
+
+    def batch_ready(self, src_seq, trg_seq):
+        now = self._now()
+        self.data_wait_sec += now - self._last_step_end
+        self._compute_start = now
+
+        n_src = int((src_seq != self.src_pad_idx).sum())
+        n_trg = int((trg_seq != self.trg_pad_idx).sum())
+        self.src_tokens += n_src
+        self.trg_tokens += n_trg
+        self.total_tokens += src_seq.numel() + trg_seq.numel()
+        self.pad_tokens += src_seq.numel() + trg_seq.numel() - n_src - n_trg
+
+    def compute_done(self):
+        now = self._now()
+        self.compute_sec += now - self._compute_start
+        self._optim_start = now
+
+    def step_done(self, global_step):
+        now = self._now()
+        self.optim_sec += now - self._optim_start
+        self._last_step_end = now
+        self.n_steps += 1
+        if self.n_steps >= self.interval:
+            self.flush(global_step)
+
+    def flush(self, global_step):
+        if self.n_steps == 0:
+            return
+        elapsed = time.perf_counter() - self.window_start
+        record = {
+            'step': global_step,
+            'steps': self.n_steps,
+            'src_tokens_per_sec': self.src_tokens / elapsed,
+            'trg_tokens_per_sec': self.trg_tokens / elapsed,
+            'padding_ratio': self.pad_tokens / max(self.total_tokens, 1),
+            'data_wait_sec': self.data_wait_sec,
+            'compute_sec': self.compute_sec,
+            'optim_sec': self.optim_sec,
+            'data_wait_share': self.data_wait_sec / elapsed,
+            'peak_rss_mb': peak_rss_mb(),
+        }
+        if torch.cuda.is_available():
+            record['peak_cuda_allocated_mb'] = torch.cuda.max_memory_allocated() / 2 ** 20
+            torch.cuda.reset_peak_memory_stats()
+
+        with open(self.log_path, 'a') as f:
+            f.write(json.dumps(record) + '\n')
+
+        if self.tb_writer is not None:
+            for key, value in record.items():
+                if key not in ('step', 'steps') and value is not None:
+                    self.tb_writer.add_scalar(f'telemetry/{key}', value, global_step)
+
+        self._reset_window()
@@ -0,0 +1,6 @@
+from .loss import cal_loss, cal_performance
+
+__all__ = [
+    'cal_loss',
+    'cal_performance',
+]